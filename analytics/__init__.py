@@ -0,0 +1,20 @@
+# Session history as NumPy arrays, converted once from a
+# tools/export_sessions.py export:
+#
+#     sessions = analytics.from_export('export/', 'columns/')  # later: analytics.load_sessions('columns/')
+#     sweep = analytics.OccupancySweep(sessions.for_site('default'))
+#     peak, peak_time = sweep.peak()
+#     hours, cars = sweep.mean_occupancy(start_time, end_time, 3600)
+#     counts, minutes = analytics.dwell_histogram(sessions, bin_minutes=15)
+#     regulars = analytics.top_plates(analytics.plate_aggregates(sessions), 'visits')
+from .columns import OPEN, Sessions, create_columns, from_export, load_sessions, write_labels
+from .occupancy import OccupancySweep
+from .summaries import (
+    arrivals_by_hour,
+    dwell_histogram,
+    dwell_percentiles,
+    dwell_seconds,
+    fee_totals,
+    plate_aggregates,
+    top_plates
+)
@@ -0,0 +1,137 @@
+import glob
+import os
+
+import numpy as np
+
+# Sessions are stored one .npy file per column, so they can be memory mapped
+# and an analysis only reads the pages of the columns it uses. Plates and
+# sites are int32 codes into the labels in plates.npy and sites.npy.
+COLUMNS = {
+    'EntryTime': np.int64,
+    'ExitTime': np.int64,
+    'DurationHours': np.int32,
+    'PaymentDue': np.float64,
+    'PlateIndex': np.int32,
+    'SiteIndex': np.int32
+}
+LABELS = ('plates', 'sites')
+
+# ExitTime of sessions that were still open when exported.
+OPEN = -1
+
+DEFAULT_SITE = 'default'  # as in lambda/sites.py
+NON_PLATE_CHARS = '[^A-Z0-9]'  # as in lambda/plates.py
+
+class Sessions:
+    def __init__(self, columns, plates, sites):
+        self.entry_time = columns['EntryTime']
+        self.exit_time = columns['ExitTime']
+        self.duration_hours = columns['DurationHours']
+        self.payment_due = columns['PaymentDue']
+        self.plate_index = columns['PlateIndex']
+        self.site_index = columns['SiteIndex']
+        self.plates = plates
+        self.sites = sites
+
+    def __len__(self):
+        return len(self.entry_time)
+
+    def columns(self):
+        return {
+            'EntryTime': self.entry_time,
+            'ExitTime': self.exit_time,
+            'DurationHours': self.duration_hours,
+            'PaymentDue': self.payment_due,
+            'PlateIndex': self.plate_index,
+            'SiteIndex': self.site_index
+        }
+
+    def closed(self):
+        return self.exit_time != OPEN
+
+    def select(self, rows):
+        # rows is a boolean mask, an index array or a slice. Slices of memory
+        # mapped columns stay mapped; masks and index arrays copy.
+        return Sessions({name: column[rows] for name, column in self.columns().items()}, self.plates, self.sites)
+
+    def for_site(self, site_id):
+        matches = np.flatnonzero(self.sites == site_id)
+        if not len(matches):
+            return self.select(slice(0, 0))
+        return self.select(self.site_index == matches[0])
+
+def create_columns(directory, count):
+    # Returns writable memory mapped columns of count rows, to be filled in
+    # chunks and followed by write_labels.
+    os.makedirs(directory, exist_ok=True)
+    return {
+        name: np.lib.format.open_memmap(os.path.join(directory, f"{name}.npy"), mode='w+', dtype=dtype, shape=(count,))
+        for name, dtype in COLUMNS.items()
+    }
+
+def write_labels(directory, plates, sites):
+    # Labels are fixed width strings, so loading them needs no pickle.
+    np.save(os.path.join(directory, 'plates.npy'), np.asarray(plates, dtype=str))
+    np.save(os.path.join(directory, 'sites.npy'), np.asarray(sites, dtype=str))
+
+def load_sessions(directory, mmap=True):
+    mmap_mode = 'r' if mmap else None
+    columns = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode) for name in COLUMNS}
+    labels = [np.load(os.path.join(directory, f"{name}.npy")) for name in LABELS]
+    return Sessions(columns, *labels)
+
+def export_files(export_directory):
+    # The day-partitioned files written by tools/export_sessions.py, and
+    # their format.
+    for extension, file_format in (('parquet', 'parquet'), ('arrow', 'feather')):
+        paths = sorted(glob.glob(os.path.join(export_directory, 'day=*', f"*.{extension}")))
+        if paths:
+            return paths, file_format
+    raise ValueError(f"No exported sessions in {export_directory}")
+
+def from_export(export_directory, directory):
+    # Converts a session export to columns, one record batch at a time, so
+    # memory stays bounded by the batch and the plate and site labels.
+    # pyarrow is only needed here.
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    paths, file_format = export_files(export_directory)
+    dataset = ds.dataset(paths, format=file_format)
+    names = ['EntryTime', 'ExitTime', 'DurationHours', 'PaymentDue', 'PlateKey', 'CarRegistration', 'SiteID']
+
+    def keys(batch):
+        # Sessions recorded before PlateKey existed fall back to their
+        # normalised registration.
+        registrations = pc.replace_substring_regex(pc.utf8_upper(batch['CarRegistration']), NON_PLATE_CHARS, '')
+        plates = pc.coalesce(batch['PlateKey'], registrations, '')
+        return plates, pc.fill_null(batch['SiteID'], DEFAULT_SITE)
+
+    # The first pass collects the labels, the second writes the rows.
+    plate_labels = set()
+    site_labels = set()
+    for batch in dataset.to_batches(columns=names):
+        plates, sites = keys(batch)
+        plate_labels.update(pc.unique(plates).to_pylist())
+        site_labels.update(pc.unique(sites).to_pylist())
+    plate_labels = pa.array(sorted(plate_labels), pa.string())
+    site_labels = pa.array(sorted(site_labels), pa.string())
+
+    columns = create_columns(directory, dataset.count_rows())
+    start = 0
+    for batch in dataset.to_batches(columns=names):
+        plates, sites = keys(batch)
+        end = start + batch.num_rows
+        columns['EntryTime'][start:end] = batch['EntryTime'].to_numpy(zero_copy_only=False)
+        columns['ExitTime'][start:end] = pc.fill_null(batch['ExitTime'], OPEN).to_numpy(zero_copy_only=False)
+        columns['DurationHours'][start:end] = pc.fill_null(batch['DurationHours'], 0).to_numpy(zero_copy_only=False)
+        columns['PaymentDue'][start:end] = pc.fill_null(batch['PaymentDue'], 0.0).to_numpy(zero_copy_only=False)
+        columns['PlateIndex'][start:end] = pc.index_in(plates, value_set=plate_labels).to_numpy(zero_copy_only=False)
+        columns['SiteIndex'][start:end] = pc.index_in(sites, value_set=site_labels).to_numpy(zero_copy_only=False)
+        start = end
+
+    for column in columns.values():
+        column.flush()
+    write_labels(directory, plate_labels.to_pylist(), site_labels.to_pylist())
+    return load_sessions(directory)
@@ -0,0 +1,64 @@
+import numpy as np
+
+from .columns import OPEN
+
+class OccupancySweep:
+    # Occupancy from the sorted entry and exit times. A car is parked from its
+    # entry time up to, but not including, its exit time, so the cars parked
+    # at t are the entries at or before t less the exits at or before t, two
+    # binary searches. Sessions still open are parked until as_of, which
+    # defaults to the last time in the data; those that entered after as_of
+    # are not counted at all.
+    def __init__(self, sessions, as_of=None):
+        entries = np.sort(sessions.entry_time)
+        exits = np.asarray(sessions.exit_time)
+        if as_of is None:
+            as_of = int(max(entries[-1], exits.max())) if len(entries) else 0
+        exits = np.maximum(np.where(exits == OPEN, as_of, exits), sessions.entry_time)
+        exits.sort()
+
+        # Times are kept relative to the first entry so the running sums
+        # below stay well inside int64.
+        self.origin = int(entries[0]) if len(entries) else 0
+        self.as_of = as_of
+        self.entries = entries - self.origin
+        self.exits = exits - self.origin
+        self.entry_sums = np.concatenate(([0], np.cumsum(self.entries)))
+        self.exit_sums = np.concatenate(([0], np.cumsum(self.exits)))
+
+    def offsets(self, times):
+        return np.asarray(times, dtype=np.int64) - self.origin
+
+    def at(self, times):
+        times = self.offsets(times)
+        return np.searchsorted(self.entries, times, 'right') - np.searchsorted(self.exits, times, 'right')
+
+    def curve(self, start, end, step):
+        # Cars parked at every step from start up to end.
+        times = np.arange(start, end, step, dtype=np.int64)
+        return times, self.at(times)
+
+    def peak(self):
+        # Occupancy only rises at an entry, so the peak is the largest count
+        # just after one. Returns (cars, time).
+        if not len(self.entries):
+            return 0, None
+        counts = np.arange(1, len(self.entries) + 1) - np.searchsorted(self.exits, self.entries, 'right')
+        index = int(np.argmax(counts))
+        return int(counts[index]), int(self.entries[index]) + self.origin
+
+    def parked_seconds_before(self, times):
+        # Car-seconds parked before each time: every earlier entry adds the
+        # time since it, and every earlier exit takes the time since it away.
+        times = self.offsets(times)
+        entered = np.searchsorted(self.entries, times, 'right')
+        exited = np.searchsorted(self.exits, times, 'right')
+        return (entered - exited) * times - self.entry_sums[entered] + self.exit_sums[exited]
+
+    def mean_occupancy(self, start, end, step):
+        # Mean cars parked over each step from start up to end. Divided by the
+        # bays, this is the utilisation.
+        edges = np.arange(start, end + step, step, dtype=np.int64)
+        edges[-1] = min(edges[-1], end)
+        parked = np.diff(self.parked_seconds_before(edges))
+        return edges[:-1], parked / np.diff(edges)
@@ -0,0 +1,66 @@
+import numpy as np
+
+SECONDS_PER_DAY = 86400
+
+def dwell_seconds(sessions):
+    # Lengths of the closed sessions.
+    closed = sessions.closed()
+    return np.maximum(sessions.exit_time[closed] - sessions.entry_time[closed], 0)
+
+def dwell_histogram(sessions, bin_minutes=15, max_hours=24):
+    # Counts of closed sessions by length, in bin_minutes bins. The last bin
+    # holds every session of max_hours or longer. Returns (counts, bin starts
+    # in minutes).
+    bins = max_hours * 60 // bin_minutes
+    indexes = np.minimum(dwell_seconds(sessions) // (bin_minutes * 60), bins)
+    return np.bincount(indexes, minlength=bins + 1), np.arange(bins + 1) * bin_minutes
+
+def dwell_percentiles(sessions, percentiles=(50, 90, 99)):
+    dwell = dwell_seconds(sessions)
+    if not len(dwell):
+        return {}
+    return dict(zip(percentiles, np.percentile(dwell, percentiles).tolist()))
+
+def arrivals_by_hour(sessions, utc_offset_minutes=0):
+    hours = (sessions.entry_time + utc_offset_minutes * 60) % SECONDS_PER_DAY // 3600
+    return np.bincount(hours, minlength=24)
+
+def fee_totals(sessions, period=SECONDS_PER_DAY):
+    # Fees and closed sessions by the period they ended in, UTC days by
+    # default. Returns (period starts, fees, sessions).
+    closed = sessions.closed()
+    exit_time = sessions.exit_time[closed]
+    if not len(exit_time):
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64)
+    first = int(exit_time.min()) // period
+    periods = exit_time // period - first
+    fees = np.bincount(periods, weights=sessions.payment_due[closed])
+    counts = np.bincount(periods, minlength=len(fees))
+    return (np.arange(len(fees)) + first) * period, fees, counts
+
+def plate_aggregates(sessions):
+    # Visits, time parked, billed hours, fees and last entry for each plate,
+    # as arrays indexed like sessions.plates. Open sessions count as visits
+    # but add no time or fees until they close.
+    plates = len(sessions.plates)
+    index = sessions.plate_index
+    closed = sessions.closed()
+    dwell = np.where(closed, np.maximum(sessions.exit_time - sessions.entry_time, 0), 0)
+    last_entry = np.full(plates, np.iinfo(np.int64).min)
+    np.maximum.at(last_entry, index, sessions.entry_time)
+    return {
+        'visits': np.bincount(index, minlength=plates),
+        'dwell_seconds': np.bincount(index, weights=dwell, minlength=plates),
+        'billed_hours': np.bincount(index, weights=np.where(closed, sessions.duration_hours, 0), minlength=plates),
+        'fees': np.bincount(index, weights=np.where(closed, sessions.payment_due, 0.0), minlength=plates),
+        'last_entry': last_entry
+    }
+
+def top_plates(aggregates, key='visits', count=10):
+    # Plate indexes with the largest values of one aggregate, largest first.
+    values = aggregates[key]
+    count = min(count, len(values))
+    if not count:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(values, len(values) - count)[-count:]
+    return top[np.argsort(values[top], kind='stable')[::-1]]
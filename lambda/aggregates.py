@@ -0,0 +1,219 @@
+import json
+import os
+import time
+import zlib
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+from clients import get_client
+from metrics import count, instrumented, stage
+from sites import DEFAULT_SITE
+from tables import deserialize_item, get_table, serialize_item
+
+STATS_TABLE = os.environ.get('STATS_TABLE', 'CarParkStats')
+COUNTER_SHARDS = int(os.environ.get('COUNTER_SHARDS', '10'))
+# Markers outlive the stream's 24 hour retention, after which no record they
+# cover can be delivered again.
+APPLIED_MARKER_TTL = int(os.environ.get('APPLIED_MARKER_TTL', str(2 * 86400)))
+
+# TransactWriteItems takes up to 100 actions, one of them the marker.
+TRANSACT_WRITE_SIZE = 100
+
+# Counters are stored as one item per (Counter, Shard). Writes for a session
+# always land on the same shard, so hot counters such as occupancy spread
+# their writes, while reading a counter is a single query over its shards.
+def occupancy_counter(site_id):
+    return f"occupancy#{site_id}"
+
+def hour_counter(site_id, timestamp):
+    return f"hour#{site_id}#{datetime.fromtimestamp(timestamp, timezone.utc):%Y-%m-%dT%H}"
+
+def day_counter(site_id, timestamp):
+    return f"day#{site_id}#{datetime.fromtimestamp(timestamp, timezone.utc):%Y-%m-%d}"
+
+def session_deltas(old_image, new_image):
+    # Returns (counter, attribute, delta) triples for one change to a session.
+    # An old_image of None means the session is new, which is also how items
+    # from a table export are replayed.
+    if not new_image:
+        return []
+
+    site_id = new_image.get('SiteID', DEFAULT_SITE)
+    deltas = []
+
+    if old_image is None:
+        entry_time = int(new_image['EntryTime'])
+        deltas.append((occupancy_counter(site_id), 'Value', 1))
+        deltas.append((hour_counter(site_id, entry_time), 'Entries', 1))
+        deltas.append((day_counter(site_id, entry_time), 'Entries', 1))
+
+    if 'ExitTime' in new_image and (old_image is None or 'ExitTime' not in old_image):
+        exit_time = int(new_image['ExitTime'])
+        revenue = Decimal(str(new_image.get('PaymentDue', 0)))
+        deltas.append((occupancy_counter(site_id), 'Value', -1))
+        for counter in (hour_counter(site_id, exit_time), day_counter(site_id, exit_time)):
+            deltas.append((counter, 'Exits', 1))
+            deltas.append((counter, 'Revenue', revenue))
+
+    return deltas
+
+def shard_for(session_id):
+    return zlib.crc32(session_id.encode()) % COUNTER_SHARDS
+
+def deserialize_image(image):
+    if image is None:
+        return None
+    return deserialize_item(image)
+
+def record_deltas(record):
+    # Returns (shard, deltas) for one stream record, with no deltas for
+    # removals and malformed records.
+    if record['eventName'] not in ('INSERT', 'MODIFY'):
+        return None, []
+    try:
+        old_image = deserialize_image(record['dynamodb'].get('OldImage'))
+        new_image = deserialize_image(record['dynamodb'].get('NewImage'))
+        return shard_for(new_image['SessionID']), session_deltas(old_image, new_image)
+    except (KeyError, TypeError, ValueError) as e:
+        print(f"Skipping malformed stream record {record['dynamodb'].get('SequenceNumber')}: {str(e)}")
+        return None, []
+
+def add_deltas(totals, shard, deltas):
+    for counter, attribute, delta in deltas:
+        counter_totals = totals.setdefault((counter, shard), {})
+        counter_totals[attribute] = counter_totals.get(attribute, 0) + delta
+
+def collect_deltas(records):
+    # Deltas are summed per counter shard first, so a batch costs one write
+    # per shard it touches rather than one per record.
+    totals = {}
+    for record in records:
+        add_deltas(totals, *record_deltas(record))
+    return totals
+
+def next_chunk(records):
+    # The longest run of records from the start whose deltas touch few
+    # enough shards to apply in one transaction. Returns (run length, totals).
+    totals = {}
+    for length, record in enumerate(records):
+        shard, deltas = record_deltas(record)
+        keys = {(counter, shard) for counter, _, _ in deltas}
+        if length and len(totals.keys() | keys) >= TRANSACT_WRITE_SIZE:
+            return length, totals
+        add_deltas(totals, shard, deltas)
+    return len(records), totals
+
+def sequence_number(record):
+    return int(record['dynamodb']['SequenceNumber'])
+
+def applied_marker_key(record):
+    # Event IDs are unique across the stream's shards, where sequence numbers
+    # are only ordered within one.
+    return {'Counter': f"applied#{record['eventID']}", 'Shard': 0}
+
+def apply_chunk(records, totals):
+    # Applies a run of records' deltas together with a marker naming the last
+    # record applied. Returns that record's sequence number when an earlier
+    # delivery already applied the run, else None.
+    actions = []
+    for (counter, shard), attributes in totals.items():
+        names = {f"#a{i}": name for i, name in enumerate(attributes)}
+        values = {f":v{i}": delta for i, delta in enumerate(attributes.values())}
+        actions.append({
+            'Update': {
+                'TableName': STATS_TABLE,
+                'Key': serialize_item({'Counter': counter, 'Shard': shard}),
+                'UpdateExpression': 'ADD ' + ', '.join(f"{name} {value}" for name, value in zip(names, values)),
+                'ExpressionAttributeNames': names,
+                'ExpressionAttributeValues': serialize_item(values)
+            }
+        })
+    marker = dict(
+        applied_marker_key(records[0]),
+        LastSequenceNumber=records[-1]['dynamodb']['SequenceNumber'],
+        ExpiresAt=int(time.time()) + APPLIED_MARKER_TTL
+    )
+    actions.append({
+        'Put': {
+            'TableName': STATS_TABLE,
+            'Item': serialize_item(marker),
+            'ConditionExpression': 'attribute_not_exists(#counter)',
+            'ExpressionAttributeNames': {'#counter': 'Counter'}
+        }
+    })
+
+    try:
+        get_client('dynamodb').transact_write_items(TransactItems=actions)
+    except ClientError as e:
+        # Reasons come in the order of the actions, with a Message beside
+        # each Code, and the marker is the last action.
+        reasons = e.response.get('CancellationReasons', [])
+        if e.response['Error']['Code'] != 'TransactionCanceledException' or not reasons \
+                or reasons[-1].get('Code') != 'ConditionalCheckFailed':
+            raise
+        # A marker is only written with its run's deltas, so finding one
+        # means the run, up to the sequence number it names, is applied.
+        applied = get_table(STATS_TABLE).get_item(Key=applied_marker_key(records[0]), ConsistentRead=True)
+        return int(applied['Item']['LastSequenceNumber'])
+    return None
+
+def read_counter(counter):
+    response = get_table(STATS_TABLE).query(
+        KeyConditionExpression='#counter = :counter',
+        ExpressionAttributeNames={'#counter': 'Counter'},
+        ExpressionAttributeValues={':counter': counter}
+    )
+
+    totals = {}
+    for item in response['Items']:
+        for name, value in item.items():
+            if name not in ('Counter', 'Shard'):
+                totals[name] = totals.get(name, 0) + value
+    return totals
+
+def get_occupancy(site_id=DEFAULT_SITE):
+    return read_counter(occupancy_counter(site_id)).get('Value', 0)
+
+def get_hourly_totals(site_id, timestamp):
+    return read_counter(hour_counter(site_id, timestamp))
+
+def get_daily_totals(site_id, timestamp):
+    return read_counter(day_counter(site_id, timestamp))
+
+@instrumented('aggregates')
+def main(event, context):
+    # Records are applied in order, in runs that each commit atomically with
+    # a marker, so a redelivered batch skips what was applied and the first
+    # record of a run that failed is where the retry starts.
+    pending = event['Records']
+    updated = 0
+    with stage('CounterWrite'):
+        while pending:
+            length, totals = next_chunk(pending)
+            if not totals:
+                pending = pending[length:]
+                continue
+            try:
+                applied = apply_chunk(pending[:length], totals)
+            except Exception as e:
+                print(f"Error updating {len(totals)} counter shards: {str(e)}")
+                count('CounterShardsUpdated', updated)
+                return {
+                    'batchItemFailures': [{'itemIdentifier': pending[0]['dynamodb']['SequenceNumber']}]
+                }
+            if applied is None:
+                updated += len(totals)
+                pending = pending[length:]
+            else:
+                count('RecordsAlreadyApplied', sum(1 for record in pending if sequence_number(record) <= applied))
+                pending = [record for record in pending if sequence_number(record) > applied]
+    count('CounterShardsUpdated', updated)
+
+    print(f"Updated {updated} counter shards from {len(event['Records'])} records")
+    return {
+        'statusCode': 200,
+        'body': json.dumps('Counters updated successfully'),
+        'batchItemFailures': []
+    }
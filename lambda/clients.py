@@ -0,0 +1,68 @@
+import os
+import threading
+
+import botocore.session
+from botocore.config import Config
+
+import metrics
+
+# Clients are created once per container and reused by every invocation.
+# Only botocore is loaded, and only for the services a handler calls.
+CLIENT_CONFIG = Config(
+    max_pool_connections=int(os.environ.get('MAX_POOL_CONNECTIONS', '25')),
+    connect_timeout=3,
+    read_timeout=10,
+    tcp_keepalive=True,
+    retries={
+        'max_attempts': int(os.environ.get('MAX_ATTEMPTS', '4')),
+        'mode': 'adaptive'
+    }
+)
+
+# Rekognition throttling is paced and retried by throttling.call_with_backoff,
+# so botocore makes a single attempt. Its max_attempts counts retries after
+# the first, so total_max_attempts is set instead: a retry of botocore's own
+# would not take a token from the limiter.
+SERVICE_CONFIGS = {
+    'rekognition': CLIENT_CONFIG.merge(Config(retries={'total_max_attempts': 1, 'mode': 'standard'}))
+}
+
+_lock = threading.RLock()
+_session = None
+_clients = {}
+
+def get_session():
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                session = botocore.session.Session()
+                metrics.register_hooks(session)
+                _session = session
+    return _session
+
+def get_client(service_name):
+    client = _clients.get(service_name)
+    if client is None:
+        with _lock:
+            client = _clients.get(service_name)
+            if client is None:
+                config = SERVICE_CONFIGS.get(service_name, CLIENT_CONFIG)
+                client = get_session().create_client(service_name, config=config)
+                _clients[service_name] = client
+    return client
+
+def set_client(service_name, client):
+    # Lets the offline harness in tools/ substitute a stand-in for a service.
+    with _lock:
+        _clients[service_name] = client
+
+def reset_clients(session=True):
+    # Lets the offline harness in tools/ start again from a cold container.
+    # The session, with the service models it has loaded, is kept unless
+    # session is False.
+    global _session
+    with _lock:
+        _clients.clear()
+        if not session:
+            _session = None
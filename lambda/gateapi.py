@@ -0,0 +1,129 @@
+import base64
+import binascii
+import json
+import time
+
+from imaging import MAX_IMAGE_BYTES
+from metrics import count, instrumented, stage
+from plates import normalise_plate
+from recognition import recognise_image
+from sessions import find_open_session
+from sites import DEFAULT_SITE, is_entry_gate, is_exit_gate, valid_id
+from tariff import get_tariff
+from throttling import ENTRY_PRIORITY, EXIT_PRIORITY, Deferred, admission, deadline_for
+
+HEADERS = {
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization, X-Amz-Date, X-Amz-Security-Token',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Credentials': 'true',
+    'Content-Type': 'application/json'
+}
+
+def respond(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': HEADERS,
+        'body': json.dumps(body)
+    }
+
+def lookup_open_session(plate, site_id):
+    # A consistent read of the plate's pointer, so a car back soon after it
+    # left is priced from its new stay. A cached pointer could only be trusted
+    # after the same read.
+    with stage('SessionLookup'):
+        pointer = find_open_session(plate, site_id)
+    if pointer is None or 'ExitTime' in pointer:
+        return None
+    return pointer
+
+def read_plate(body, site_id, gate_id, priority, context):
+    # Returns the plate sent by the gate or read from its image, or None.
+    plate = body.get('plate')
+    if plate is not None and not isinstance(plate, str):
+        raise ValueError('plate must be a string')
+    if not plate and body.get('image'):
+        try:
+            data = base64.b64decode(body['image'], validate=True)
+        except (binascii.Error, TypeError, ValueError):
+            raise ValueError('image must be base64 encoded')
+        if len(data) > MAX_IMAGE_BYTES:
+            raise ValueError(f"image is larger than {MAX_IMAGE_BYTES} bytes")
+
+        with stage('OCR'), admission(priority, deadline_for(context)):
+            plate = recognise_image(data, f"{site_id}/{gate_id}")
+    return plate.strip() if plate and normalise_plate(plate) else None
+
+def decide(body, context):
+    # Exits get the barrier decision with the amount due now. The session is
+    # still closed, and the charge recorded, by the image processing function
+    # when the exit image is uploaded. A request without a direction from a
+    # gate not configured as an entry or exit is an exit when the plate has an
+    # open session, as s3getpassrek decides for its images.
+    site_id = DEFAULT_SITE
+    if body.get('siteId') is not None:
+        site_id = valid_id(body['siteId'])
+        if site_id is None:
+            return respond(400, {'message': 'Invalid siteId'})
+    gate_id = valid_id(body.get('gateId'))
+
+    direction = body.get('direction')
+    if not direction:
+        if is_exit_gate(site_id, gate_id):
+            direction = 'exit'
+        elif is_entry_gate(site_id, gate_id):
+            direction = 'entry'
+    elif direction not in ('entry', 'exit'):
+        return respond(400, {'message': 'direction must be entry or exit'})
+    priority = EXIT_PRIORITY if direction == 'exit' else ENTRY_PRIORITY
+
+    try:
+        plate = read_plate(body, site_id, gate_id, priority, context)
+    except ValueError as e:
+        return respond(400, {'message': str(e)})
+    except Deferred as e:
+        count('Deferred')
+        return respond(503, {'decision': 'refer', 'reason': str(e)})
+
+    result = {'direction': direction, 'siteId': site_id, 'plate': plate}
+    if not plate:
+        count('Unread')
+        return respond(200, dict(result, decision='refer', reason='No registration plate read'))
+    if direction == 'entry':
+        return respond(200, dict(result, decision='open'))
+
+    pointer = lookup_open_session(plate, site_id)
+    if direction is None:
+        if pointer is None:
+            return respond(200, dict(result, direction='entry', decision='open'))
+        result['direction'] = 'exit'
+    if pointer is None:
+        count('NoSession')
+        return respond(200, dict(result, decision='refer', reason='No open session for this plate'))
+
+    now = int(time.time())
+    entry_time = int(pointer['EntryTime'])
+    with stage('Pricing'):
+        amount_due = get_tariff(site_id).price(entry_time, now)
+    return respond(200, dict(
+        result,
+        decision='open',
+        sessionId=pointer['SessionID'],
+        entryTime=entry_time,
+        durationMinutes=max(0, now - entry_time) // 60,
+        amountDue=str(amount_due)
+    ))
+
+@instrumented('gateapi')
+def main(event, context):
+    # Invoked by API Gateway for barrier decisions.
+    body = event.get('body') or '{}'
+    try:
+        if event.get('isBase64Encoded'):
+            body = base64.b64decode(body)
+        body = json.loads(body)
+    except (binascii.Error, ValueError):
+        return respond(400, {'message': 'Body must be JSON'})
+    if not isinstance(body, dict):
+        return respond(400, {'message': 'Body must be a JSON object'})
+    return decide(body, context)
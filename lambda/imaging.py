@@ -0,0 +1,346 @@
+import io
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from cache import MISSING
+from clients import get_client
+from plates import PLATE_ASPECT_RATIO
+
+# Camera frames are cropped to the plate and downscaled before OCR, so the
+# recognition call gets a small grayscale JPEG inline instead of reading the
+# full-resolution frame from S3. Pillow is optional: without it frames are
+# passed to the backend by reference as before.
+MAX_IMAGE_BYTES = int(os.environ.get('MAX_IMAGE_BYTES', str(10 * 1024 * 1024)))
+DECODE_WIDTH = int(os.environ.get('DECODE_WIDTH', '1280'))
+PLATE_CROP_WIDTH = int(os.environ.get('PLATE_CROP_WIDTH', '640'))
+FRAME_MAX_WIDTH = int(os.environ.get('FRAME_MAX_WIDTH', '1280'))
+MIN_REGION_CONTRAST = float(os.environ.get('MIN_REGION_CONTRAST', '2'))
+JPEG_QUALITY = int(os.environ.get('JPEG_QUALITY', '85'))
+READ_CHUNK_BYTES = 256 * 1024
+
+# The edge map is searched on a coarse grid of square cells. Candidate
+# windows have a plate's shape and span these fractions of the frame width.
+GRID_WIDTH = 64
+WINDOW_WIDTHS = (0.1, 0.15, 0.22, 0.3)
+# The edge filter runs on the frame reduced to this many pixels per cell.
+CELL_PIXELS = 8
+# Margin added around a window, as a fraction of its width and height.
+CROP_MARGIN = (0.35, 0.6)
+# Plate-like signs and bodywork can outscore the plate, so the best few
+# separate windows are all sent.
+MAX_REGIONS = int(os.environ.get('MAX_PLATE_REGIONS', '4'))
+STRIP_GAP = 8
+# Frames are matched on their plate regions reduced by MATCH_SCALE, allowing
+# the car to move MATCH_REACH reduced pixels either way. A pixel counts as
+# changed when it differs by at least MATCH_LEVELS grey levels, which sensor
+# noise does not reach and a different character on the plate does.
+MATCH_SCALE = 2
+MATCH_REACH = 8
+MATCH_LEVELS = 64
+
+_pillow = None
+
+def get_pillow():
+    # Returns (Image, ImageChops, ImageFilter), or None when Pillow is not
+    # installed. Imported on first use to keep it out of cold starts.
+    global _pillow
+    if _pillow is None:
+        try:
+            from PIL import Image, ImageChops, ImageFilter
+        except ImportError:
+            print('Pillow is not installed, images are not preprocessed')
+            _pillow = False
+        else:
+            _pillow = (Image, ImageChops, ImageFilter)
+    return _pillow or None
+
+class PreparedFrame:
+    # The frame's candidate plate regions, stacked into one small image so a
+    # single OCR call reads them all. Without candidates the whole frame is
+    # sent, downscaled.
+    def __init__(self, image, regions, object_bytes):
+        Image, _, _ = get_pillow()
+        self.image = image
+        self.regions = regions
+        self.object_bytes = object_bytes
+
+        if regions:
+            crops = [image.crop(region) for region in regions]
+            crops = [resize_to_width(crop, PLATE_CROP_WIDTH) for crop in crops]
+            composite = Image.new('L', (
+                max(crop.size[0] for crop in crops),
+                sum(crop.size[1] for crop in crops) + STRIP_GAP * (len(crops) - 1)
+            ), 255)
+            self.strips = []
+            top = 0
+            for region, crop in zip(regions, crops):
+                composite.paste(crop, (0, top))
+                self.strips.append((region, top, crop.size))
+                top += crop.size[1] + STRIP_GAP
+        else:
+            composite = resize_to_width(image, FRAME_MAX_WIDTH)
+            self.strips = []
+        self.data = encode_jpeg(composite)
+        self.size = composite.size
+        self.templates = [(region, image.crop(region).reduce(MATCH_SCALE)) for region in regions]
+        self._areas = {}
+
+    @property
+    def cropped(self):
+        return bool(self.regions)
+
+    def frame_data(self):
+        # The whole frame, for when OCR finds nothing in the crops.
+        return encode_jpeg(resize_to_width(self.image, FRAME_MAX_WIDTH))
+
+    def changed_share(self, region, template):
+        # The smallest share of the template's pixels that changed in this
+        # frame at the same region, over the alignments the car may have
+        # moved to. Searched along each axis and then around the best of
+        # both, rather than at every offset.
+        area = self._areas.get(region)
+        if area is None:
+            left, top, right, bottom = region
+            margin = MATCH_REACH * MATCH_SCALE
+            area = self._areas[region] = self.image.crop(
+                (left - margin, top - margin, right + margin, bottom + margin)
+            ).reduce(MATCH_SCALE)
+        _, ImageChops, _ = get_pillow()
+        width, height = template.size
+        reach = 2 * MATCH_REACH
+
+        def changed(x, y):
+            histogram = ImageChops.difference(template, area.crop((x, y, x + width, y + height))).histogram()
+            return sum(histogram[MATCH_LEVELS:]) / (width * height)
+
+        x = min(range(reach + 1), key=lambda x: changed(x, MATCH_REACH))
+        y = min(range(reach + 1), key=lambda y: changed(x, y))
+        return min(
+            changed(near_x, near_y)
+            for near_x in range(max(0, x - 1), min(reach, x + 1) + 1)
+            for near_y in range(max(0, y - 1), min(reach, y + 1) + 1)
+        )
+
+    def shows(self, image_size, templates, max_change):
+        # Whether this frame shows the same plates as the frame the templates
+        # came from. Only plate regions are compared, since the background of
+        # a camera's frames is the same whichever car is in them.
+        return bool(templates) and image_size == self.image.size and all(
+            self.changed_share(region, template) <= max_change for region, template in templates
+        )
+
+    def to_frame(self, detections):
+        # Maps bounding boxes from the composite back to fractions of the
+        # frame, which is what detection scoring expects. Detections that do
+        # not fall within a single strip are dropped.
+        if not self.regions:
+            return detections
+        width, height = self.image.size
+        composite_width, composite_height = self.size
+        mapped = []
+        for detection in detections:
+            box = detection.get('Geometry', {}).get('BoundingBox')
+            if not box:
+                continue
+            left = box.get('Left', 0) * composite_width
+            top = box.get('Top', 0) * composite_height
+            box_width = box.get('Width', 0) * composite_width
+            box_height = box.get('Height', 0) * composite_height
+            centre = top + box_height / 2
+            for region, strip_top, (strip_width, strip_height) in self.strips:
+                if strip_top <= centre < strip_top + strip_height:
+                    scale = (region[2] - region[0]) / strip_width
+                    box['Left'] = (region[0] + left * scale) / width
+                    box['Top'] = (region[1] + (top - strip_top) * scale) / height
+                    box['Width'] = box_width * scale / width
+                    box['Height'] = box_height * scale / height
+                    mapped.append(detection)
+                    break
+        return mapped
+
+def read_object(bucket, key):
+    # Streams the object in chunks and gives up on anything too large to be
+    # worth decoding here; those frames are read by the backend instead.
+    response = get_client('s3').get_object(Bucket=bucket, Key=key)
+    body = response['Body']
+    if response.get('ContentLength', 0) > MAX_IMAGE_BYTES:
+        body.close()
+        return None
+    data = bytearray()
+    for chunk in iter(lambda: body.read(READ_CHUNK_BYTES), b''):
+        data.extend(chunk)
+        if len(data) > MAX_IMAGE_BYTES:
+            body.close()
+            return None
+    return bytes(data)
+
+def decode(data):
+    Image, _, _ = get_pillow()
+    image = Image.open(io.BytesIO(data))
+    # JPEGs decode directly at 1/2, 1/4 or 1/8 scale, which is far cheaper
+    # than decoding at full size and resizing.
+    width, height = image.size
+    if width > DECODE_WIDTH:
+        image.draft('L', (DECODE_WIDTH, DECODE_WIDTH * height // width))
+    return image.convert('L')
+
+def edge_grid(image):
+    # Vertical edge strength averaged over square cells. Characters give a
+    # plate far more vertical edges than bodywork, road or sky.
+    Image, ImageChops, ImageFilter = get_pillow()
+    factor = image.size[0] // (GRID_WIDTH * CELL_PIXELS)
+    if factor > 1:
+        image = image.reduce(factor)
+    width, height = image.size
+    rising = image.filter(ImageFilter.Kernel((3, 3), (-1, 0, 1, -2, 0, 2, -1, 0, 1), scale=1))
+    falling = image.filter(ImageFilter.Kernel((3, 3), (1, 0, -1, 2, 0, -2, 1, 0, -1), scale=1))
+    # The filters treat the frame's border as an edge, so it is dropped.
+    edges = ImageChops.lighter(rising, falling).crop((1, 1, width - 1, height - 1))
+    grid_width = min(GRID_WIDTH, width)
+    grid_height = max(1, round(grid_width * height / width))
+    cells = edges.resize((grid_width, grid_height), Image.BOX)
+    return cells.tobytes(), grid_width, grid_height
+
+def find_plate_regions(image):
+    # Returns up to MAX_REGIONS separate (left, top, right, bottom) boxes in
+    # image pixels, best first. Empty when nothing plate-shaped stands out
+    # from the rest of the frame.
+    values, grid_width, grid_height = edge_grid(image)
+    mean = sum(values) / len(values)
+    if not mean:
+        return []
+
+    # Summed-area table, so every window sum is four lookups.
+    sums = [[0] * (grid_width + 1) for _ in range(grid_height + 1)]
+    for y in range(grid_height):
+        row_total = 0
+        row, above = sums[y + 1], sums[y]
+        for x in range(grid_width):
+            row_total += values[y * grid_width + x]
+            row[x + 1] = above[x + 1] + row_total
+
+    # A window's score is its edge energy above the frame average, divided by
+    # the square root of its area. Windows larger than the plate add only
+    # background and windows smaller than it lose part of the text, so the
+    # score peaks on a window that just covers the plate.
+    windows = []
+    for fraction in WINDOW_WIDTHS:
+        window_width = max(2, round(grid_width * fraction))
+        window_height = max(1, round(window_width / PLATE_ASPECT_RATIO))
+        if window_width > grid_width or window_height > grid_height:
+            continue
+        area = window_width * window_height
+        threshold = mean * MIN_REGION_CONTRAST * area
+        expected = mean * area
+        scale = math.sqrt(area)
+        for top in range(grid_height - window_height + 1):
+            upper, lower = sums[top], sums[top + window_height]
+            bottom = top + window_height
+            for left in range(grid_width - window_width + 1):
+                right = left + window_width
+                total = lower[right] - upper[right] - lower[left] + upper[left]
+                if total >= threshold:
+                    windows.append(((total - expected) / scale, left, top, right, bottom))
+
+    windows.sort(reverse=True)
+    chosen = []
+    for _, left, top, right, bottom in windows:
+        margin_x = (right - left) * CROP_MARGIN[0]
+        margin_y = (bottom - top) * CROP_MARGIN[1]
+        box = (left - margin_x, top - margin_y, right + margin_x, bottom + margin_y)
+        if any(box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3] for other in chosen):
+            continue
+        chosen.append(box)
+        if len(chosen) == MAX_REGIONS:
+            break
+
+    # Stacked in reading order rather than by score, so frames of the same
+    # scene give the same composite.
+    chosen.sort(key=lambda box: (box[1], box[0]))
+    cell = image.size[0] / grid_width
+    return [(
+        max(0, int(left * cell)),
+        max(0, int(top * cell)),
+        min(image.size[0], math.ceil(right * cell)),
+        min(image.size[1], math.ceil(bottom * cell))
+    ) for left, top, right, bottom in chosen]
+
+def resize_to_width(image, max_width):
+    Image, _, _ = get_pillow()
+    width, height = image.size
+    if width <= max_width:
+        return image
+    return image.resize((max_width, max(1, round(height * max_width / width))), Image.BILINEAR)
+
+def encode_jpeg(image):
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=JPEG_QUALITY)
+    return output.getvalue()
+
+def prepare_image(data):
+    # Returns a PreparedFrame, or None when the bytes are not an image Pillow
+    # can decode.
+    if get_pillow() is None:
+        return None
+    try:
+        image = decode(data)
+    except (OSError, ValueError, SyntaxError) as e:
+        print(f"Could not decode image: {e}")
+        return None
+    return PreparedFrame(image, find_plate_regions(image), len(data))
+
+def prepare_frame(bucket, key):
+    if get_pillow() is None:
+        return None
+    data = read_object(bucket, key)
+    if data is None:
+        return None
+    return prepare_image(data)
+
+class RecentFrameCache:
+    # Recent frames from each camera with the plate read from them. A camera
+    # takes several frames of every car, so a frame whose plate regions have
+    # barely changed from those of one seen in the last ttl seconds shows the
+    # same car and reuses its read instead of another OCR call. Frames with
+    # no plate region are never matched.
+    def __init__(self, max_size, ttl, max_change):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_change = max_change
+        self.hits = 0
+        self.misses = 0
+        self._frames = {}
+        self._lock = threading.Lock()
+
+    def get(self, camera, frame):
+        now = time.monotonic()
+        with self._lock:
+            frames = self._frames.get(camera)
+            while frames and frames[0][0] <= now:
+                frames.popleft()
+            recent = list(reversed(frames or ()))
+        # Compared outside the lock, which would otherwise serialise every
+        # frame of the container behind a few milliseconds of image work.
+        for _, image_size, templates, plate in recent:
+            if frame.shows(image_size, templates, self.max_change):
+                with self._lock:
+                    self.hits += 1
+                return plate
+        with self._lock:
+            self.misses += 1
+        return MISSING
+
+    def add(self, camera, frame, plate):
+        if not frame.templates:
+            return
+        with self._lock:
+            frames = self._frames.get(camera)
+            if frames is None:
+                frames = self._frames[camera] = deque(maxlen=self.max_size)
+            frames.append((time.monotonic() + self.ttl, frame.image.size, frame.templates, plate))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cameras': len(self._frames)}
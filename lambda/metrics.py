@@ -0,0 +1,151 @@
+import functools
+import json
+import os
+import random
+import threading
+import time
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+# Every invocation prints its counts, so Count metrics sum to the true
+# totals. Only METRICS_SAMPLE_RATE of invocations also time their stages;
+# timings are averaged rather than summed, so a sample describes them, and
+# the line carries the rate as SampleRate.
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '1'))
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'CarPark')
+
+class NoopStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NOOP_STAGE = NoopStage()
+
+class Stage:
+    __slots__ = ('metrics', 'name', 'started')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_time(self.name, time.perf_counter() - self.started)
+        return False
+
+class InvocationMetrics:
+    # Handlers fan work out to thread pools, so stage times are summed across
+    # threads and can add up to more than the invocation's duration.
+    def __init__(self, function_name, timed=True):
+        self.function_name = function_name
+        self.timed = timed
+        self.lock = threading.Lock()
+        self.times = {}
+        self.counts = {}
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.times[name] = self.times.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def to_emf(self, duration, context):
+        # CloudWatch embedded metric format: the log line itself is turned
+        # into metrics, so no PutMetricData calls are made.
+        values = {'Duration': (duration * 1000, 'Milliseconds')} if self.timed else {}
+        for name, seconds in self.times.items():
+            values[f"{name}Time"] = (seconds * 1000, 'Milliseconds')
+        for name, value in self.counts.items():
+            values[name] = (value, 'Count')
+
+        line = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Function']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in values.items()]
+                }]
+            },
+            'Function': self.function_name,
+            'SampleRate': METRICS_SAMPLE_RATE
+        }
+        request_id = getattr(context, 'aws_request_id', None)
+        if request_id:
+            line['RequestId'] = request_id
+        for name, (value, _) in values.items():
+            line[name] = round(value, 3)
+        return json.dumps(line)
+
+# A container runs one invocation at a time, so the invocation being measured
+# is shared by every thread rather than kept per thread.
+_current = None
+
+def stage(name):
+    current = _current
+    if current is None or not current.timed:
+        return NOOP_STAGE
+    return Stage(current, name)
+
+def count(name, value=1):
+    current = _current
+    if current is not None:
+        current.count(name, value)
+
+def instrumented(function_name):
+    # Wraps a Lambda handler so that each invocation prints one metrics line,
+    # with stage times for a sample of them. With metrics disabled the
+    # handler is returned unchanged and stage() and count() reduce to a
+    # global lookup.
+    def decorator(handler):
+        if not METRICS_ENABLED:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            global _current
+            metrics = _current = InvocationMetrics(function_name, random.random() < METRICS_SAMPLE_RATE)
+            started = time.perf_counter()
+            try:
+                return handler(event, context)
+            except Exception:
+                metrics.count('Errors')
+                raise
+            finally:
+                _current = None
+                print(metrics.to_emf(time.perf_counter() - started, context))
+        return wrapper
+    return decorator
+
+def count_backend_call(model, **kwargs):
+    current = _current
+    if current is not None:
+        current.count('BackendCalls')
+        current.count(f"{model.service_model.service_name}Calls")
+
+def count_backend_response(http_response, parsed, **kwargs):
+    current = _current
+    if current is None:
+        return
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if retries:
+        current.count('BackendRetries', retries)
+    if http_response.status_code >= 300:
+        current.count('BackendErrors')
+
+def count_backend_failure(exception, **kwargs):
+    # Connection errors and timeouts that outlived the retries.
+    count('BackendErrors')
+
+def register_hooks(session):
+    if not METRICS_ENABLED:
+        return
+    session.register('before-call', count_backend_call)
+    session.register('after-call', count_backend_response)
+    session.register('after-call-error', count_backend_failure)
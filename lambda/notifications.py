@@ -1,13 +1,62 @@
 import json
-import boto3
 import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 
-sns = boto3.client('sns')
-dynamodb = boto3.resource('dynamodb')
+from botocore.exceptions import ClientError
+
+from cache import MISSING, TTLCache
+from clients import get_client
+from metrics import count, instrumented, stage
+from plates import normalise_plate, plate_owner_key
+from tables import backoff_delay, deserialize_item, get_table, serialize_item
 
 SNS_TOPIC_ARN = os.environ.get('SNS_TOPIC_ARN')
 USERS_TABLE = os.environ.get('USERS_TABLE', 'CarParkUsers')
+NOTIFICATIONS_TABLE = os.environ.get('NOTIFICATIONS_TABLE', 'NotificationLog')
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '8'))
+PUBLISH_BATCH_SIZE = 10
+BATCH_GET_SIZE = 100
+# Unprocessed keys are retried with the same backoff as batch writes. Plates
+# still unread after BATCH_GET_RETRIES retries fail their records, which the
+# stream delivers again.
+BATCH_GET_RETRIES = int(os.environ.get('BATCH_GET_RETRIES', '5'))
+
+# Every notified session is claimed in NotificationLog before it is sent, so
+# stream redeliveries do not notify twice. A claim is Pending until its
+# message is published and then Sent; a retried record sends a Pending claim
+# again once no other delivery holds it. Claims expire after
+# NOTIFICATION_LOG_TTL seconds, well beyond the stream's retention.
+DEDUPE_NOTIFICATIONS = os.environ.get('DEDUPE_NOTIFICATIONS', 'true').lower() == 'true'
+NOTIFICATION_LOG_TTL = int(os.environ.get('NOTIFICATION_LOG_TTL', str(7 * 86400)))
+# In digest mode the claims also queue the sessions, and send_digests sends
+# each user one summary of the sessions that ended in the windows of
+# DIGEST_WINDOW seconds since the last run.
+NOTIFICATION_MODE = os.environ.get('NOTIFICATION_MODE', 'immediate')
+DIGEST_WINDOW = int(os.environ.get('DIGEST_WINDOW', '3600'))
+DIGEST_LOOKBACK = int(os.environ.get('DIGEST_LOOKBACK', '24'))
+PENDING = 'Pending'
+SENT = 'Sent'
+# An immediate-mode claim is leased to the invocation that took it for
+# CLAIM_LEASE seconds, the function's timeout, so of two overlapping
+# deliveries only one publishes. The other fails its records, which are
+# retried once the claim is Sent, released after a failed publish or left by
+# an invocation that timed out.
+CLAIM_LEASE = int(os.environ.get('CLAIM_LEASE', '15'))
+
+class ClaimHeld(Exception):
+    pass
+
+# Plates resolve to the same users many times a day, so lookups are cached per
+# container. Unregistered plates are cached for a shorter time so that a newly
+# registered plate starts receiving notifications quickly.
+user_cache = TTLCache(
+    max_size=int(os.environ.get('USER_CACHE_SIZE', '2048')),
+    ttl=int(os.environ.get('USER_CACHE_TTL', '300'))
+)
+USER_CACHE_NEGATIVE_TTL = int(os.environ.get('USER_CACHE_NEGATIVE_TTL', '60'))
 
 class DecimalEncoder(json.JSONEncoder):
     def default(self, o):
@@ -16,9 +65,9 @@ class DecimalEncoder(json.JSONEncoder):
         return super(DecimalEncoder, self).default(o)
 
 def get_user_by_car_reg(car_reg):    
-    users_table = dynamodb.Table(USERS_TABLE)
-    
-    car_reg = car_reg.strip() if car_reg else car_reg
+    # Profiles saved before plate mapping items existed are only reachable
+    # through the CarRegistrationIndex GSI.
+    users_table = get_table(USERS_TABLE)
     
     response = users_table.query(
         IndexName='CarRegistrationIndex',
@@ -28,45 +77,416 @@ def get_user_by_car_reg(car_reg):
         }
     )
     
-    if response['Items']:
-        return response['Items'][0]
+    return response['Items'][0] if response['Items'] else {}
+
+def get_user_by_spellings(car_regs):
+    # CarRegistrationIndex holds a legacy profile's plate as it was typed, so
+    # each spelling read of the plate is tried.
+    for car_reg in sorted(car_regs):
+        user = get_user_by_car_reg(car_reg)
+        if user:
+            return user
     return {}
 
+def get_plate_owners(keys):
+    owners = {}
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        request_items = {USERS_TABLE: {'Keys': [serialize_item({'UserID': key}) for key in keys[start:start + BATCH_GET_SIZE]]}}
+        retries = 0
+        while True:
+            response = get_client('dynamodb').batch_get_item(RequestItems=request_items)
+            for item in response['Responses'].get(USERS_TABLE, []):
+                item = deserialize_item(item)
+                owners[item['UserID']] = item
+            request_items = response.get('UnprocessedKeys')
+            if not request_items:
+                break
+            if retries == BATCH_GET_RETRIES:
+                raise RuntimeError(f"{len(request_items[USERS_TABLE]['Keys'])} plate mappings unread after {retries} retries")
+            time.sleep(backoff_delay(retries))
+            retries += 1
+
+    return owners
+
+def get_users_by_car_regs(car_regs, executor):
+    # Plates are looked up and cached by their owner key, so every spelling
+    # of a plate in a batch shares one lookup. Users and failures are
+    # returned by the spellings given.
+    spellings = {}
+    for car_reg in car_regs:
+        if car_reg and normalise_plate(car_reg):
+            spellings.setdefault(plate_owner_key(car_reg), set()).add(car_reg.strip())
+
+    found = {}
+    uncached = []
+    for key in spellings:
+        user = user_cache.get(key, MISSING)
+        if user is MISSING:
+            uncached.append(key)
+        else:
+            found[key] = user
+    count('UserCacheHits', len(found))
+    count('UserCacheMisses', len(uncached))
+
+    # Plate mapping items are read together with BatchGetItem. Plates without
+    # one fall back to concurrent GSI queries.
+    failed_keys = set()
+    try:
+        owners = get_plate_owners(uncached)
+    except Exception as e:
+        print(f"Error resolving plate owners: {str(e)}")
+        owners = {}
+        failed_keys.update(uncached)
+
+    futures = {
+        key: executor.submit(get_user_by_spellings, spellings[key])
+        for key in uncached if key not in owners and key not in failed_keys
+    }
+    for key in uncached:
+        if key in failed_keys:
+            continue
+        try:
+            user = owners[key] if key in owners else futures[key].result()
+        except Exception as e:
+            print(f"Error resolving user for car registration {key}: {str(e)}")
+            failed_keys.add(key)
+            continue
+
+        found[key] = user
+        user_cache.set(key, user, ttl=None if user else USER_CACHE_NEGATIVE_TTL)
+
+    users = {car_reg: user for key, user in found.items() for car_reg in spellings[key]}
+    failed = {car_reg for key in failed_keys for car_reg in spellings[key]}
+    return users, failed
+
+def user_id_of(user):
+    # Plate mapping items name their owner; profiles found through the
+    # legacy index are the owner.
+    return user.get('OwnerID') or user['UserID']
+
+def get_ended_sessions(records):
+    # A malformed record would fail on every retry, so it is logged and
+    # skipped rather than holding up its shard.
+    sessions = []
+    for record in records:
+        try:
+            if record['eventName'] != 'MODIFY':
+                continue
+
+            # Only the update that closed the session, not later ones to it.
+            images = record['dynamodb']
+            new_image = images['NewImage']
+            if 'ExitTime' not in new_image or 'ExitTime' in images.get('OldImage', {}):
+                continue
+
+            sessions.append({
+                'sequence_number': images['SequenceNumber'],
+                'car_reg': new_image['CarRegistration']['S'].strip(),
+                'session_id': new_image['SessionID']['S'],
+                'entry_time': int(new_image['EntryTime']['N']),
+                'exit_time': int(new_image['ExitTime']['N']),
+                'payment_due': float(new_image.get('PaymentDue', {}).get('N', 0))
+            })
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            print(f"Skipping malformed stream record {record.get('dynamodb', {}).get('SequenceNumber')}: {str(e)}")
+            count('MalformedRecords')
+    return sessions
+
+def claim_session(session, user_id, owner):
+    # Returns False when an earlier delivery of the same stream record
+    # already sent the session, and raises ClaimHeld while another delivery
+    # holds its lease. A claim left Pending by a delivery that failed before
+    # its publish went through is taken again. Log items written before
+    # claims had a status count as sent.
+    now = int(time.time())
+    item = {
+        'SessionID': session['session_id'],
+        'UserID': user_id,
+        'NotificationStatus': PENDING,
+        'ExpiresAt': now + NOTIFICATION_LOG_TTL
+    }
+    condition = 'attribute_not_exists(SessionID) OR NotificationStatus = :pending'
+    values = {':pending': PENDING}
+    if NOTIFICATION_MODE == 'digest':
+        item.update({
+            'CarRegistration': session['car_reg'],
+            'EntryTime': session['entry_time'],
+            'ExitTime': session['exit_time'],
+            'PaymentDue': Decimal(str(session['payment_due'])),
+            'DigestWindow': session['exit_time'] // DIGEST_WINDOW * DIGEST_WINDOW
+        })
+    else:
+        item.update({'ClaimOwner': owner, 'LeaseExpiresAt': now + CLAIM_LEASE})
+        condition = ('attribute_not_exists(SessionID) OR (NotificationStatus = :pending AND '
+                     '(attribute_not_exists(LeaseExpiresAt) OR LeaseExpiresAt <= :now))')
+        values[':now'] = now
+    try:
+        get_table(NOTIFICATIONS_TABLE).put_item(
+            Item=item,
+            ConditionExpression=condition,
+            ExpressionAttributeValues=values,
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        current = deserialize_item(e.response.get('Item', {}))
+        if current.get('NotificationStatus') == PENDING:
+            raise ClaimHeld(f"Session {session['session_id']} is claimed by {current.get('ClaimOwner')}")
+        return False
+    return True
+
+def claim_sessions(notifications, owner, executor):
+    # notifications are (session, user ID) pairs. Returns the pairs claimed
+    # now, the number already sent and the sequence numbers of records that
+    # could not be claimed.
+    futures = [executor.submit(claim_session, session, user_id, owner) for session, user_id in notifications]
+    claimed = []
+    duplicates = 0
+    failures = []
+    for (session, user_id), future in zip(notifications, futures):
+        try:
+            if future.result():
+                claimed.append((session, user_id))
+            else:
+                duplicates += 1
+        except ClaimHeld as e:
+            print(str(e))
+            count('ClaimsHeld')
+            failures.append(session['sequence_number'])
+        except Exception as e:
+            print(f"Error claiming session {session['session_id']}: {str(e)}")
+            failures.append(session['sequence_number'])
+    return claimed, duplicates, failures
+
+def mark_sent(session_id, sent_at):
+    # Removing DigestWindow takes a digest session out of the sparse index.
+    # The claim itself stays until it expires, to keep deduplicating.
+    get_table(NOTIFICATIONS_TABLE).update_item(
+        Key={'SessionID': session_id},
+        UpdateExpression='REMOVE DigestWindow SET NotificationStatus = :sent, SentAt = :sent_at',
+        ExpressionAttributeValues={':sent': SENT, ':sent_at': sent_at}
+    )
+
+def mark_all_sent(session_ids, executor):
+    # A session whose claim stays Pending is sent again if its record is
+    # redelivered, so a failure here is logged rather than failing the
+    # record, whose message has gone.
+    now = int(time.time())
+    futures = [executor.submit(mark_sent, session_id, now) for session_id in session_ids]
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        print(f"Error marking {len(errors)} sessions sent: {str(errors[0])}")
+        count('MarkSentErrors', len(errors))
+
+def release_claim(session_id, owner):
+    # Lets the retry of a failed publish take the claim straight away rather
+    # than after the lease.
+    try:
+        get_table(NOTIFICATIONS_TABLE).update_item(
+            Key={'SessionID': session_id},
+            UpdateExpression='REMOVE LeaseExpiresAt',
+            ConditionExpression='ClaimOwner = :owner AND NotificationStatus = :pending',
+            ExpressionAttributeValues={':owner': owner, ':pending': PENDING}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+def release_claims(session_ids, owner, executor):
+    # An unreleased claim is only taken again once its lease ends.
+    futures = [executor.submit(release_claim, session_id, owner) for session_id in session_ids]
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        print(f"Error releasing {len(errors)} claims: {str(errors[0])}")
+        count('ReleaseErrors', len(errors))
+
+def user_attributes(user_id):
+    # Each user's subscription has a filter policy on UserID, so a message
+    # reaches only its user rather than every subscriber to the topic.
+    return {'UserID': {'DataType': 'String', 'StringValue': user_id}}
+
+def build_publish_entry(entry_id, session, user_id):
+    car_reg = session['car_reg']
+    payment_due = session['payment_due']
+    message = {
+        'sessionId': session['session_id'],
+        'carRegistration': car_reg,
+        'entryTime': session['entry_time'],
+        'exitTime': session['exit_time'],
+        'paymentDue': payment_due,
+        'message': f"Your parking session for {car_reg} has ended. Payment due: ${payment_due}"
+    }
+    return {
+        'Id': entry_id,
+        'Message': json.dumps(message, cls=DecimalEncoder),
+        'Subject': f"Parking Payment Due for {car_reg}",
+        'MessageAttributes': user_attributes(user_id)
+    }
+
+def batches(entries):
+    for start in range(0, len(entries), PUBLISH_BATCH_SIZE):
+        yield entries[start:start + PUBLISH_BATCH_SIZE]
+
+def publish_entries(entries):
+    try:
+        response = get_client('sns').publish_batch(
+            TopicArn=SNS_TOPIC_ARN,
+            PublishBatchRequestEntries=entries
+        )
+    except Exception as e:
+        print(f"Error publishing notification batch: {str(e)}")
+        return [entry['Id'] for entry in entries]
+
+    for failure in response.get('Failed', []):
+        print(f"Notification {failure['Id']} failed: {failure.get('Message', failure.get('Code'))}")
+    return [failure['Id'] for failure in response.get('Failed', [])]
+
+@instrumented('notifications')
 def main(event, context):
-    for record in event['Records']:
-        if record['eventName'] == 'MODIFY':
-            new_image = record['dynamodb']['NewImage']
-            
-            if 'ExitTime' in new_image:
-                car_reg = new_image['CarRegistration']['S']
-                session_id = new_image['SessionID']['S']
-                entry_time = int(new_image['EntryTime']['N'])
-                exit_time = int(new_image['ExitTime']['N'])
-                payment_due = float(new_image.get('PaymentDue', {}).get('N', 0))
-                
-                user = get_user_by_car_reg(car_reg)
-                
-                if user and 'Email' in user:
-                    message = {
-                        'sessionId': session_id,
-                        'carRegistration': car_reg,
-                        'entryTime': entry_time,
-                        'exitTime': exit_time,
-                        'paymentDue': payment_due,
-                        'message': f"Your parking session for {car_reg} has ended. Payment due: ${payment_due}"
-                    }
-                    
-                    sns.publish(
-                        TopicArn=SNS_TOPIC_ARN,
-                        Message=json.dumps(message, cls=DecimalEncoder),
-                        Subject=f"Parking Payment Due for {car_reg}"
-                    )
-                    
-                    print(f"Notification sent for {car_reg}")
-                else:
-                    print(f"No user found for car registration {car_reg}")
+    sessions = get_ended_sessions(event['Records'])
+    failures = []
+    owner = uuid.uuid4().hex
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Duplicate plates within a batch are resolved with a single lookup.
+        with stage('UserResolution'):
+            users, failed_car_regs = get_users_by_car_regs({session['car_reg'] for session in sessions}, executor)
+
+        notifications = []
+        for session in sessions:
+            car_reg = session['car_reg']
+            if car_reg in failed_car_regs:
+                failures.append(session['sequence_number'])
+            elif 'Email' in users.get(car_reg, {}):
+                notifications.append((session, user_id_of(users[car_reg])))
+            else:
+                print(f"No user found for car registration {car_reg}")
+
+        if DEDUPE_NOTIFICATIONS or NOTIFICATION_MODE == 'digest':
+            with stage('Dedupe'):
+                notifications, duplicates, claim_failures = claim_sessions(notifications, owner, executor)
+            failures.extend(claim_failures)
+            count('DuplicatesSuppressed', duplicates)
+
+        if NOTIFICATION_MODE == 'digest':
+            print(f"Sessions queued for digests: {len(notifications)}, failed records: {len(failures)}")
+            count('SessionsQueued', len(notifications))
+            count('FailedRecords', len(failures))
+            return {
+                'statusCode': 200,
+                'body': json.dumps('Sessions queued for digests'),
+                'batchItemFailures': [{'itemIdentifier': sequence_number} for sequence_number in failures]
+            }
+
+        entries = {}
+        for session, user_id in notifications:
+            entry_id = str(len(entries))
+            entries[entry_id] = (session, build_publish_entry(entry_id, session, user_id))
+
+        failed_ids = set()
+        with stage('Publish'):
+            for batch_failed_ids in executor.map(publish_entries, batches([entry for _, entry in entries.values()])):
+                failed_ids.update(batch_failed_ids)
+
+        # Failed sessions keep their Pending claims and are retried with
+        # their records.
+        failed_sessions = [entries[entry_id][0] for entry_id in failed_ids]
+        if DEDUPE_NOTIFICATIONS:
+            with stage('DedupeWrite'):
+                mark_all_sent([session['session_id'] for entry_id, (session, _) in entries.items()
+                               if entry_id not in failed_ids], executor)
+                release_claims([session['session_id'] for session in failed_sessions], owner, executor)
+
+    failures.extend(session['sequence_number'] for session in failed_sessions)
+    print(f"Notifications sent: {len(entries) - len(failed_ids)}, failed records: {len(failures)}")
+    count('NotificationsSent', len(entries) - len(failed_ids))
+    count('FailedRecords', len(failures))
     
     return {
         'statusCode': 200,
-        'body': json.dumps('Notifications processed successfully')
-    }
\ No newline at end of file
+        'body': json.dumps('Notifications processed successfully'),
+        'batchItemFailures': [{'itemIdentifier': sequence_number} for sequence_number in failures]
+    }
+
+def pending_digest_items(window):
+    items = []
+    query_params = {
+        'IndexName': 'DigestWindowIndex',
+        'KeyConditionExpression': 'DigestWindow = :window',
+        'ExpressionAttributeValues': {':window': window}
+    }
+    while True:
+        response = get_table(NOTIFICATIONS_TABLE).query(**query_params)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return items
+        query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def build_digest_entry(entry_id, user_id, items):
+    items = sorted(items, key=lambda item: item['ExitTime'])
+    total_due = sum(item.get('PaymentDue', 0) for item in items)
+    message = {
+        'sessions': [
+            {
+                'sessionId': item['SessionID'],
+                'carRegistration': item['CarRegistration'],
+                'entryTime': int(item['EntryTime']),
+                'exitTime': int(item['ExitTime']),
+                'paymentDue': item.get('PaymentDue', 0)
+            }
+            for item in items
+        ],
+        'totalDue': total_due,
+        'message': f"{len(items)} of your parking sessions have ended. Total payment due: ${total_due}"
+    }
+    subject = f"Parking Payment Due for {items[0]['CarRegistration']}"
+    if len(items) > 1:
+        subject = f"Parking Payments Due for {len(items)} Sessions"
+    return {
+        'Id': entry_id,
+        'Message': json.dumps(message, cls=DecimalEncoder),
+        'Subject': subject,
+        'MessageAttributes': user_attributes(user_id)
+    }
+
+@instrumented('notification-digests')
+def send_digests(event, context):
+    # Runs on a schedule. Windows still open are left for the next run; a
+    # window that closed up to DIGEST_LOOKBACK windows ago is still sent, so
+    # a failed run only delays its digests. A run that fails after publishing
+    # can send a digest twice.
+    now = int(time.time())
+    current_window = now // DIGEST_WINDOW * DIGEST_WINDOW
+    windows = [current_window - DIGEST_WINDOW * i for i in range(1, DIGEST_LOOKBACK + 1)]
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        with stage('DigestRead'):
+            pending = {}
+            for items in executor.map(pending_digest_items, windows):
+                for item in items:
+                    pending.setdefault(item['UserID'], []).append(item)
+
+        entries = {}
+        for user_id, items in pending.items():
+            entry_id = str(len(entries))
+            entries[entry_id] = (items, build_digest_entry(entry_id, user_id, items))
+
+        failed_ids = set()
+        with stage('Publish'):
+            for batch_failed_ids in executor.map(publish_entries, batches([entry for _, entry in entries.values()])):
+                failed_ids.update(batch_failed_ids)
+
+        sent = [item for entry_id, (items, _) in entries.items() if entry_id not in failed_ids for item in items]
+        with stage('DigestWrite'):
+            mark_all_sent([item['SessionID'] for item in sent], executor)
+
+    print(f"Digests sent: {len(entries) - len(failed_ids)} covering {len(sent)} sessions, failed: {len(failed_ids)}")
+    count('DigestsSent', len(entries) - len(failed_ids))
+    count('SessionsSent', len(sent))
+    count('DigestsFailed', len(failed_ids))
+
+    return {
+        'statusCode': 500 if failed_ids else 200,
+        'body': json.dumps(f"Sent {len(entries) - len(failed_ids)} digests")
+    }
@@ -0,0 +1,43 @@
+import re
+
+NON_PLATE_CHARS = re.compile(r'[^A-Z0-9]')
+
+# A UK plate is 520mm x 111mm.
+PLATE_ASPECT_RATIO = 520 / 111
+
+# Plate-to-owner mapping items share CarParkUsers with the profiles, keyed by
+# this prefix and the normalised plate.
+PLATE_OWNER_PREFIX = 'PLATE#'
+
+# Characters that OCR commonly confuses on plates are folded onto a single
+# representative, so every misread of a plate shares the same skeleton.
+CONFUSABLE_GROUPS = ['0ODQ', '1I', '2Z', '5S', '6G', '8B']
+SKELETON_TABLE = str.maketrans({
+    char: group[0] for group in CONFUSABLE_GROUPS for char in group[1:]
+})
+
+def normalise_plate(text):
+    if not text:
+        return ''
+    return NON_PLATE_CHARS.sub('', text.upper())
+
+def plate_owner_key(text):
+    return PLATE_OWNER_PREFIX + normalise_plate(text)
+
+def plate_skeleton(text):
+    return normalise_plate(text).translate(SKELETON_TABLE)
+
+def best_match(text, candidates):
+    # candidates maps normalised plates sharing the skeleton of text to any
+    # value. An exact read wins, otherwise the candidate agreeing with the read
+    # on the most characters.
+    plate_key = normalise_plate(text)
+    if plate_key in candidates:
+        return candidates[plate_key]
+    if not candidates:
+        return None
+
+    def agreement(candidate):
+        return sum(1 for a, b in zip(candidate, plate_key) if a == b)
+
+    return candidates[max(candidates, key=agreement)]
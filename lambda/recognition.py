@@ -0,0 +1,255 @@
+import abc
+import io
+import math
+import os
+import re
+
+import imaging
+from cache import MISSING, TTLCache
+from clients import get_client
+from metrics import count, stage
+from plates import PLATE_ASPECT_RATIO, normalise_plate
+from throttling import call_with_backoff, rekognition_limiter
+
+RECOGNITION_BACKEND = os.environ.get('RECOGNITION_BACKEND', 'rekognition')
+MIN_CANDIDATE_SCORE = float(os.environ.get('MIN_CANDIDATE_SCORE', '0.5'))
+LOCAL_FALLBACK_SCORE = float(os.environ.get('LOCAL_FALLBACK_SCORE', '0.75'))
+PREPROCESS_IMAGES = os.environ.get('PREPROCESS_IMAGES', 'true').lower() == 'true'
+
+# Current and older UK formats, plus short dateless and cherished plates.
+PLATE_PATTERN = re.compile(os.environ.get(
+    'PLATE_PATTERN',
+    r'^([A-Z]{2}[0-9]{2}[A-Z]{3}|[A-Z][0-9]{1,3}[A-Z]{3}|[A-Z]{3}[0-9]{1,3}[A-Z]|[0-9]{1,4}[A-Z]{1,3}|[A-Z]{1,3}[0-9]{1,4})$'
+))
+# Bounding boxes are fractions of the frame, so the camera's own aspect ratio
+# is needed to recover a plate's real shape.
+IMAGE_ASPECT_RATIO = float(os.environ.get('IMAGE_ASPECT_RATIO', str(4 / 3)))
+
+# Re-delivered events carry the same ETag, so they skip OCR entirely.
+recognition_cache = TTLCache(
+    max_size=int(os.environ.get('RECOGNITION_CACHE_SIZE', '1024')),
+    ttl=int(os.environ.get('RECOGNITION_CACHE_TTL', '3600'))
+)
+# Cameras send several frames of each car; frames from the same camera whose
+# plate regions have barely changed reuse the first read.
+recent_frames = imaging.RecentFrameCache(
+    max_size=int(os.environ.get('FRAME_CACHE_SIZE', '64')),
+    ttl=int(os.environ.get('FRAME_CACHE_TTL', '10')),
+    max_change=float(os.environ.get('FRAME_MATCH_CHANGE', '0.01'))
+)
+
+class RecognitionBackend(abc.ABC):
+    # Backends return detections in Rekognition's TextDetections shape:
+    # DetectedText, Type (LINE or WORD), Confidence (0-100) and
+    # Geometry.BoundingBox as fractions of the image. detect reads the frame
+    # from S3 and detect_bytes takes an encoded image inline.
+    name = None
+
+    @abc.abstractmethod
+    def detect(self, bucket, key):
+        pass
+
+    @abc.abstractmethod
+    def detect_bytes(self, data):
+        pass
+
+class RekognitionBackend(RecognitionBackend):
+    name = 'rekognition'
+
+    def detect(self, bucket, key):
+        return self.detect_text({'S3Object': {'Bucket': bucket, 'Name': key}})
+
+    def detect_bytes(self, data):
+        return self.detect_text({'Bytes': data})
+
+    def detect_text(self, image):
+        response = call_with_backoff(
+            lambda: get_client('rekognition').detect_text(Image=image),
+            rekognition_limiter
+        )
+        return response['TextDetections']
+
+class LocalBackend(RecognitionBackend):
+    # CPU-only OCR that runs offline with Tesseract. Pillow, pytesseract and
+    # the tesseract binary are optional and only needed for this backend.
+    name = 'local'
+
+    def __init__(self):
+        try:
+            import pytesseract
+            from PIL import Image
+        except ImportError as e:
+            raise RuntimeError('The local recognition backend needs Pillow and pytesseract') from e
+        self.pytesseract = pytesseract
+        self.image_module = Image
+
+    def detect(self, bucket, key):
+        body = get_client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+        return self.detect_bytes(body)
+
+    def detect_bytes(self, data):
+        return self.detect_image(self.image_module.open(io.BytesIO(data)))
+
+    def detect_image(self, image):
+        width, height = image.size
+        data = self.pytesseract.image_to_data(
+            image.convert('L'),
+            config='--psm 11',
+            output_type=self.pytesseract.Output.DICT
+        )
+
+        detections = []
+        lines = {}
+        for i, text in enumerate(data['text']):
+            confidence = float(data['conf'][i])
+            if not text.strip() or confidence < 0:
+                continue
+
+            box = (data['left'][i], data['top'][i], data['width'][i], data['height'][i])
+            detections.append(make_detection(text, 'WORD', confidence, box, width, height))
+            lines.setdefault((data['block_num'][i], data['par_num'][i], data['line_num'][i]), []).append((text, confidence, box))
+
+        for words in lines.values():
+            left = min(box[0] for _, _, box in words)
+            top = min(box[1] for _, _, box in words)
+            right = max(box[0] + box[2] for _, _, box in words)
+            bottom = max(box[1] + box[3] for _, _, box in words)
+            detections.append(make_detection(
+                ' '.join(text for text, _, _ in words),
+                'LINE',
+                min(confidence for _, confidence, _ in words),
+                (left, top, right - left, bottom - top),
+                width,
+                height
+            ))
+        return detections
+
+class LocalFirstBackend(RecognitionBackend):
+    # Uses the local engine and only pays for a Rekognition call when the
+    # local result is missing or too weak.
+    name = 'local-first'
+
+    def __init__(self):
+        self.local = LocalBackend()
+        self.remote = RekognitionBackend()
+
+    def detect(self, bucket, key):
+        detections = self.local.detect(bucket, key)
+        ranked = rank_detections(detections)
+        if ranked and ranked[0][0] >= LOCAL_FALLBACK_SCORE:
+            return detections
+        return self.remote.detect(bucket, key)
+
+    def detect_bytes(self, data):
+        detections = self.local.detect_bytes(data)
+        ranked = rank_detections(detections)
+        if ranked and ranked[0][0] >= LOCAL_FALLBACK_SCORE:
+            return detections
+        return self.remote.detect_bytes(data)
+
+BACKENDS = {
+    backend.name: backend for backend in (RekognitionBackend, LocalBackend, LocalFirstBackend)
+}
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = BACKENDS[RECOGNITION_BACKEND]()
+    return _backend
+
+def make_detection(text, detection_type, confidence, box, image_width, image_height):
+    left, top, width, height = box
+    return {
+        'DetectedText': text,
+        'Type': detection_type,
+        'Confidence': confidence,
+        'Geometry': {
+            'BoundingBox': {
+                'Left': left / image_width,
+                'Top': top / image_height,
+                'Width': width / image_width,
+                'Height': height / image_height
+            }
+        }
+    }
+
+def score_detection(detection):
+    plate = normalise_plate(detection.get('DetectedText'))
+    if not plate:
+        return 0.0
+
+    confidence = detection.get('Confidence', 0) / 100
+    format_score = 1.0 if PLATE_PATTERN.match(plate) else 0.0
+
+    aspect_score = 0.0
+    box = detection.get('Geometry', {}).get('BoundingBox')
+    if box and box.get('Width') and box.get('Height'):
+        aspect_ratio = box['Width'] / box['Height'] * IMAGE_ASPECT_RATIO
+        aspect_score = math.exp(-abs(math.log(aspect_ratio / PLATE_ASPECT_RATIO)))
+
+    return 0.5 * confidence + 0.35 * format_score + 0.15 * aspect_score
+
+def rank_detections(detections):
+    # Returns (score, text) pairs for every LINE and WORD detection, best first.
+    candidates = [
+        (score_detection(detection), detection['DetectedText'].strip())
+        for detection in detections
+        if detection.get('Type') in ('LINE', 'WORD')
+    ]
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    return candidates
+
+def best_plate(detections):
+    ranked = rank_detections(detections)
+    return ranked[0][1] if ranked and ranked[0][0] >= MIN_CANDIDATE_SCORE else False
+
+def recognise_prepared(frame, camera):
+    plate = recent_frames.get(camera, frame)
+    if plate is not MISSING:
+        count('FramesDeduplicated')
+        return plate
+
+    backend = get_backend()
+    count('OCRBytesSent', len(frame.data))
+    plate = best_plate(frame.to_frame(backend.detect_bytes(frame.data)))
+    if plate:
+        recent_frames.add(camera, frame, plate)
+    elif frame.cropped:
+        # The region heuristic missed the plate. Only reads from the crops are
+        # remembered, so a later frame still gets this second chance.
+        count('CropMisses')
+        data = frame.frame_data()
+        count('OCRBytesSent', len(data))
+        plate = best_plate(backend.detect_bytes(data))
+    return plate
+
+def recognise_plate(bucket, key, etag=None):
+    if etag:
+        cached = recognition_cache.get(etag)
+        if cached is not None:
+            return cached
+
+    frame = None
+    if PREPROCESS_IMAGES:
+        with stage('Preprocess'):
+            frame = imaging.prepare_frame(bucket, key)
+    if frame is not None:
+        count('ImageBytesRead', frame.object_bytes)
+        plate = recognise_prepared(frame, key.rpartition('/')[0])
+    else:
+        plate = best_plate(get_backend().detect(bucket, key))
+
+    if etag:
+        recognition_cache.set(etag, plate)
+    return plate
+
+def recognise_image(data, camera):
+    # For images sent inline rather than uploaded, as the gate API gets them.
+    frame = None
+    if PREPROCESS_IMAGES:
+        with stage('Preprocess'):
+            frame = imaging.prepare_image(data)
+    if frame is not None:
+        return recognise_prepared(frame, camera)
+    return best_plate(get_backend().detect_bytes(data))
@@ -1,50 +1,86 @@
-import boto3
-import time
 import json
+import os
 
-def main(event, context): 
+from metrics import instrumented, stage
+from plates import normalise_plate
+from tables import get_table
+
+SESSIONS_TABLE = os.environ.get('SESSIONS_TABLE', 'ParkingSessions')
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Headers" : "Content-Type",
+    "Access-Control-Allow-Methods": "GET, POST, DELETE, OPTIONS",
+    'Access-Control-Allow-Origin' : '*',
+    'Access-Control-Allow-Credentials' : 'true',
+    'Content-Type': 'application/json'
+}
+
+def get_latest_session(table, reg_plate):
+    plate_key = normalise_plate(reg_plate)
+    if not plate_key:
+        return None
+
+    response = table.query(
+        IndexName='PlateEntryTimeIndex',
+        KeyConditionExpression='PlateKey = :plate_key',
+        ExpressionAttributeValues={
+            ':plate_key': plate_key
+        },
+        ScanIndexForward=False,
+        Limit=1
+    )
+    if response['Items']:
+        return response['Items'][0]
+
+    return get_latest_legacy_session(table, reg_plate.strip())
+
+def get_latest_legacy_session(table, reg_plate):
+    # Sessions written before PlateKey existed are only reachable through the
+    # raw CarRegistration index, which has no sort key, so every page is read.
+    query_params = {
+        'IndexName': 'CarRegistrationIndex',
+        'KeyConditionExpression': 'CarRegistration = :reg',
+        'ExpressionAttributeValues': {
+            ':reg': reg_plate
+        }
+    }
+
+    latest = None
+    while True:
+        response = table.query(**query_params)
+        for entry in response['Items']:
+            if latest is None or entry['EntryTime'] > latest['EntryTime']:
+                latest = entry
+
+        if 'LastEvaluatedKey' not in response:
+            return latest
+        query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+@instrumented('regplateapi')
+def main(event, context):
     jsonBody = json.loads(event['body'])
-    reg_plate = jsonBody['regPlate']
-    if not reg_plate:
-        exit()
-    
-    table_name = 'Customer_Reg_DB'
-    
-    dynamodbresource = boto3.resource('dynamodb')
-    tableToScan = dynamodbresource.Table(table_name)
-    responseQuery = tableToScan.scan()
-    
-    data = responseQuery['Items']
-    
-    returnDataReg = ''
-    mostRecentEntryTime = 0
-    exitTime = 0
-    
-    for entry in data:
-        if reg_plate in entry["reg_plate"]:
-            if (entry["entry_time"] > mostRecentEntryTime):
-                mostRecentEntryTime = entry["entry_time"]
-                returnDataReg = entry["reg_plate"]
-                exitTime = entry["exit_time"]
-    
-    
-    if mostRecentEntryTime == 0:
+    reg_plate = jsonBody.get('regPlate')
+
+    session = None
+    if reg_plate:
+        with stage('SessionLookup'):
+            session = get_latest_session(get_table(SESSIONS_TABLE), reg_plate)
+
+    if session is None:
         returnData = {}
         statusCode = 400
     else:
-        returnData = { 'reg_plate': reg_plate, 'entry_time': str(mostRecentEntryTime), 'exit_time': str(exitTime) }
+        returnData = {
+            'reg_plate': reg_plate,
+            'entry_time': str(session['EntryTime']),
+            'exit_time': str(session.get('ExitTime', 0))
+        }
         statusCode = 200
-        
+
     response = {
         'statusCode': statusCode,
-        'headers': {
-            "Access-Control-Allow-Headers" : "Content-Type",
-            "Access-Control-Allow-Methods": "GET, POST, DELETE, OPTIONS",
-            'Access-Control-Allow-Origin' : '*',
-            'Access-Control-Allow-Credentials' : 'true',
-            'Content-Type': 'application/json'
-        },
+        'headers': CORS_HEADERS,
         'body': json.dumps(returnData)
     }
 
-    return response    
\ No newline at end of file
+    return response
@@ -0,0 +1,95 @@
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from sites import DEFAULT_SITE, site_key
+from tables import get_table
+
+SESSIONS_TABLE = os.environ.get('SESSIONS_TABLE', 'ParkingSessions')
+ENTRY_BUCKET_SHARDS = int(os.environ.get('ENTRY_BUCKET_SHARDS', '1'))
+BUCKET_SECONDS = 3600
+DAY_SECONDS = 86400
+# Ranges longer than this are read by day rather than by hour.
+DAY_BUCKETS_AFTER = 2 * DAY_SECONDS
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '8'))
+
+# Sessions are indexed by site and the UTC hour they started in
+# (EntryBucketIndex) and by site and UTC day (EntryDayIndex), optionally
+# split into write shards, and sorted by EntryTime inside a bucket. A time
+# range at one site is therefore read with one query per bucket it overlaps,
+# and never reads another site's buckets: hours for short ranges, so they
+# can be queried in parallel, and days for long ones, so a month is 31
+# queries rather than 744. Writers and readers must agree on
+# ENTRY_BUCKET_SHARDS, which Terraform sets for every function from
+# entry_bucket_shards. A session is in the same shard of both indexes.
+BUCKET_FORMATS = {BUCKET_SECONDS: '%Y-%m-%dT%H', DAY_SECONDS: '%Y-%m-%d'}
+# The index, and its partition key, holding each granularity of bucket.
+BUCKET_INDEXES = {BUCKET_SECONDS: ('EntryBucketIndex', 'EntryBucket'), DAY_SECONDS: ('EntryDayIndex', 'EntryDay')}
+
+def bucket_name(bucket_time, bucket_seconds):
+    return f"{datetime.fromtimestamp(bucket_time, timezone.utc):{BUCKET_FORMATS[bucket_seconds]}}"
+
+def entry_bucket(entry_time, session_id, site_id=DEFAULT_SITE, bucket_seconds=BUCKET_SECONDS):
+    name = bucket_name(entry_time, bucket_seconds)
+    if ENTRY_BUCKET_SHARDS > 1:
+        return site_key(site_id, f"{name}#{zlib.crc32(session_id.encode()) % ENTRY_BUCKET_SHARDS}")
+    return site_key(site_id, name)
+
+def entry_day(entry_time, session_id, site_id=DEFAULT_SITE):
+    return entry_bucket(entry_time, session_id, site_id, DAY_SECONDS)
+
+def bucket_seconds_for(start_time, end_time):
+    return DAY_SECONDS if end_time - start_time > DAY_BUCKETS_AFTER else BUCKET_SECONDS
+
+def buckets_between(start_time, end_time, site_id=DEFAULT_SITE, bucket_seconds=BUCKET_SECONDS):
+    bucket_start = start_time - start_time % bucket_seconds
+    for bucket_time in range(bucket_start, end_time + 1, bucket_seconds):
+        name = bucket_name(bucket_time, bucket_seconds)
+        if ENTRY_BUCKET_SHARDS > 1:
+            for shard in range(ENTRY_BUCKET_SHARDS):
+                yield site_key(site_id, f"{name}#{shard}")
+        else:
+            yield site_key(site_id, name)
+
+def query_bucket(bucket, start_time, end_time, open_only=False, bucket_seconds=BUCKET_SECONDS):
+    index_name, bucket_key = BUCKET_INDEXES[bucket_seconds]
+    query_params = {
+        'IndexName': index_name,
+        'KeyConditionExpression': f"{bucket_key} = :bucket AND EntryTime BETWEEN :start AND :end",
+        'ExpressionAttributeValues': {
+            ':bucket': bucket,
+            ':start': start_time,
+            ':end': end_time
+        }
+    }
+    if open_only:
+        query_params['FilterExpression'] = 'attribute_not_exists(ExitTime)'
+
+    table = get_table(SESSIONS_TABLE)
+    items = []
+    while True:
+        response = table.query(**query_params)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return items
+        query_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def sessions_between(start_time, end_time, open_only=False, max_workers=MAX_WORKERS, site_id=DEFAULT_SITE):
+    # Yields sessions that entered between start_time and end_time inclusive.
+    # Buckets are queried in parallel, with at most twice max_workers buckets
+    # in flight so memory stays bounded however long the range is. Results
+    # come back in bucket order.
+    bucket_seconds = bucket_seconds_for(start_time, end_time)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+        for bucket in buckets_between(start_time, end_time, site_id, bucket_seconds):
+            in_flight.append(executor.submit(query_bucket, bucket, start_time, end_time, open_only, bucket_seconds))
+            if len(in_flight) >= max_workers * 2:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+def open_sessions_older_than(age_seconds, now, lookback_seconds=31 * 24 * 3600, site_id=DEFAULT_SITE):
+    return sessions_between(now - lookback_seconds, now - age_seconds, open_only=True, site_id=site_id)
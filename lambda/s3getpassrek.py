@@ -1,92 +1,483 @@
-import boto3
+import json
+import random
 import time
 import uuid
 import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
 
-def detect_text(photo, bucket):
-    client=boto3.client('rekognition')
-    response=client.detect_text(Image={'S3Object':{'Bucket':bucket,'Name':photo}})
-                        
-    textDetections=response['TextDetections']
-    for text in textDetections:
-        if text['Type'] == 'LINE':
-            return text['DetectedText']
-    return False
-
-def main(event, context): 
-    bucket = event["Records"][0]["s3"]["bucket"]["name"]
-    photo = event["Records"][0]["s3"]["object"]["key"]
-
-    text_detected = detect_text(photo, bucket)
-    
-    if not text_detected:
-        print("No text detected in the image")
+from botocore.exceptions import ClientError
+
+from cache import TTLCache
+from clients import get_client
+from metrics import count, instrumented, stage
+from plates import normalise_plate, plate_skeleton
+from recognition import recognise_plate
+from reporting import entry_bucket, entry_day
+from sessions import OPEN_SESSIONS_TABLE, find_open_session
+from sites import DEFAULT_SITE, is_entry_gate, is_exit_gate, location_from_key, parse_capture_time, site_key, unscoped_key, valid_id
+from tables import serialize
+from tariff import get_tariff
+from throttling import ENTRY_PRIORITY, EXIT_PRIORITY, Deferred, admission, deadline_for
+
+SESSIONS_TABLE = os.environ.get('SESSIONS_TABLE', 'ParkingSessions')
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '8'))
+DEBOUNCE_SECONDS = int(os.environ.get('DEBOUNCE_SECONDS', '60'))
+CLOSED_POINTER_TTL = int(os.environ.get('CLOSED_POINTER_TTL', '86400'))
+READ_OBJECT_METADATA = os.environ.get('READ_OBJECT_METADATA', 'false').lower() == 'true'
+MAX_CAPTURE_SKEW = int(os.environ.get('MAX_CAPTURE_SKEW', '300'))
+# With exit gates on a queue of their own, their uploads also reach the main
+# queue through the bucket's catch-all notification and are left to the exit
+# queue's consumer.
+EXITS_QUEUED_SEPARATELY = os.environ.get('EXITS_QUEUED_SEPARATELY', 'false').lower() == 'true'
+# Seconds a message deferred for want of recognition capacity waits before it
+# is received again, doubled at random to spread the retries.
+REQUEUE_DELAY = int(os.environ.get('REQUEUE_DELAY', '5'))
+# Seconds after its upload that an exit read with no open session is retried,
+# waiting for its entry read, before it is counted as an orphan exit.
+ORPHAN_EXIT_WAIT = int(os.environ.get('ORPHAN_EXIT_WAIT', '300'))
+
+queue_urls = {}
+# Events this container has already processed, by object and ETag. S3 and SQS
+# deliver at least once, and a redelivery that lands here is dropped before
+# OCR, the session lookup or any write.
+processed_events = TTLCache(
+    max_size=int(os.environ.get('PROCESSED_EVENT_CACHE_SIZE', '1024')),
+    ttl=int(os.environ.get('PROCESSED_EVENT_CACHE_TTL', '3600'))
+)
+
+def detect_text(photo, bucket, etag=None):
+    return recognise_plate(bucket, photo, etag)
+
+def to_attribute_values(values):
+    return {name: serialize(value) for name, value in values.items()}
+
+def lost_condition_race(error):
+    # A transaction cancelled by a failed condition means another event
+    # already moved the plate on; anything else (conflicts, throttling) is
+    # left to the caller to retry.
+    if error.response['Error']['Code'] != 'TransactionCanceledException':
+        return False
+    reasons = error.response.get('CancellationReasons', [])
+    return any(reason.get('Code') == 'ConditionalCheckFailed' for reason in reasons)
+
+def capture_details(bucket, photo, current_time):
+    # Site and gate come from the key. With READ_OBJECT_METADATA on, which
+    # costs a HeadObject per event, site-id and gate-id metadata override the
+    # key and the capture-time metadata dates the event when the upload was
+    # delayed. Otherwise, or when the capture time is further in the future
+    # than the cameras' clocks are trusted, processing time is used.
+    site_id, gate_id = location_from_key(photo)
+    capture_time = None
+    if READ_OBJECT_METADATA:
+        metadata = get_client('s3').head_object(Bucket=bucket, Key=photo).get('Metadata', {})
+        site_id = valid_id(metadata.get('site-id')) or site_id
+        gate_id = valid_id(metadata.get('gate-id')) or gate_id
+        capture_time = parse_capture_time(metadata.get('capture-time'))
+
+    if capture_time is not None and capture_time > current_time + MAX_CAPTURE_SKEW:
+        print(f"Ignoring capture time {capture_time} of {photo}, ahead of processing time {current_time}")
+        capture_time = None
+    return site_id or DEFAULT_SITE, gate_id, capture_time or current_time
+
+def entry_items(text_detected, bucket, photo, etag, current_time, site_id, gate_id):
+    # The OpenSessions pointer and ParkingSessions item of a new session.
+    plate_key = normalise_plate(text_detected)
+    # Derived from the object so that a re-delivered event cannot open a second session.
+    session_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"s3://{bucket}/{photo}#{etag}"))
+
+    pointer = {
+        'PlateKey': site_key(site_id, plate_key),
+        'PlateSkeleton': site_key(site_id, plate_skeleton(text_detected)),
+        'SessionID': session_id,
+        'SiteID': site_id,
+        'CarRegistration': text_detected,
+        'EntryTime': current_time,
+        'EntryPhoto': photo
+    }
+    # Sessions keep the unscoped PlateKey so a plate's history spans sites.
+    session = {
+        'SessionID': session_id,
+        'SiteID': site_id,
+        'CarRegistration': text_detected,
+        'PlateKey': plate_key,
+        'EntryTime': current_time,
+        'EntryBucket': entry_bucket(current_time, session_id, site_id),
+        'EntryDay': entry_day(current_time, session_id, site_id),
+        'EntryPhoto': photo
+    }
+    if gate_id:
+        pointer['EntryGate'] = session['EntryGate'] = gate_id
+    return pointer, session
+
+def record_entry(text_detected, bucket, photo, etag, current_time, site_id=DEFAULT_SITE, gate_id=None):
+    pointer, session = entry_items(text_detected, bucket, photo, etag, current_time, site_id, gate_id)
+    get_client('dynamodb').transact_write_items(TransactItems=[
+        {
+            'Put': {
+                'TableName': OPEN_SESSIONS_TABLE,
+                'Item': to_attribute_values(pointer),
+                'ConditionExpression': 'attribute_not_exists(PlateKey) OR attribute_exists(ExitTime)'
+            }
+        },
+        {
+            'Put': {
+                'TableName': SESSIONS_TABLE,
+                'Item': to_attribute_values(session),
+                'ConditionExpression': 'attribute_not_exists(SessionID)'
+            }
+        }
+    ])
+
+def exit_charge(pointer, current_time):
+    # Returns the exit time, duration in started hours and payment due of a
+    # session leaving at current_time. Entry and exit may be dated by
+    # different clocks, one by the camera's capture time and the other by
+    # processing time, so an exit can appear to come first. It is recorded at
+    # the entry time rather than before it.
+    entry_time = int(pointer['EntryTime'])
+    current_time = max(current_time, entry_time)
+    duration_hours = (current_time - entry_time + 3599) // 3600
+    return current_time, duration_hours, get_tariff(pointer.get('SiteID')).price(entry_time, current_time)
+
+def replace_session(stale, text_detected, bucket, photo, etag, current_time, site_id=DEFAULT_SITE, gate_id=None):
+    # An entry gate read a car whose last session is still open, so its exit
+    # was never read. That session is closed at this entry, marked with
+    # ExitReason, and a new one opened in the same transaction, so the entry
+    # is not taken for the missed exit.
+    pointer, session = entry_items(text_detected, bucket, photo, etag, current_time, site_id, gate_id)
+    exit_time, duration_hours, payment_due = exit_charge(stale, current_time)
+    get_client('dynamodb').transact_write_items(TransactItems=[
+        {
+            'Put': {
+                'TableName': OPEN_SESSIONS_TABLE,
+                'Item': to_attribute_values(pointer),
+                'ConditionExpression': 'SessionID = :session_id AND attribute_not_exists(ExitTime)',
+                'ExpressionAttributeValues': to_attribute_values({':session_id': stale['SessionID']})
+            }
+        },
+        {
+            'Update': {
+                'TableName': SESSIONS_TABLE,
+                'Key': to_attribute_values({'SessionID': stale['SessionID']}),
+                'UpdateExpression': 'SET ExitTime = :exit_time, DurationHours = :duration, PaymentDue = :payment, '
+                                    'ExitReason = :reason',
+                'ConditionExpression': 'attribute_not_exists(ExitTime)',
+                'ExpressionAttributeValues': to_attribute_values({
+                    ':exit_time': exit_time,
+                    ':duration': duration_hours,
+                    ':payment': payment_due,
+                    ':reason': 'ExitNotRead'
+                })
+            }
+        },
+        {
+            'Put': {
+                'TableName': SESSIONS_TABLE,
+                'Item': to_attribute_values(session),
+                'ConditionExpression': 'attribute_not_exists(SessionID)'
+            }
+        }
+    ])
+
+def record_exit(pointer, photo, current_time, gate_id=None):
+    session_id = pointer['SessionID']
+    current_time, duration_hours, payment_due = exit_charge(pointer, current_time)
+
+    pointer_update = 'SET ExitTime = :exit_time, ExitPhoto = :photo, ExpiresAt = :expires_at'
+    session_update = 'SET ExitTime = :exit_time, DurationHours = :duration, PaymentDue = :payment, ExitPhoto = :photo'
+    gate_values = {}
+    if gate_id:
+        pointer_update += ', ExitGate = :gate'
+        session_update += ', ExitGate = :gate'
+        gate_values[':gate'] = gate_id
+
+    get_client('dynamodb').transact_write_items(TransactItems=[
+        {
+            'Update': {
+                'TableName': OPEN_SESSIONS_TABLE,
+                'Key': to_attribute_values({'PlateKey': pointer['PlateKey']}),
+                'UpdateExpression': pointer_update,
+                'ConditionExpression': 'SessionID = :session_id AND attribute_not_exists(ExitTime)',
+                'ExpressionAttributeValues': to_attribute_values({
+                    ':exit_time': current_time,
+                    ':photo': photo,
+                    ':expires_at': current_time + CLOSED_POINTER_TTL,
+                    ':session_id': session_id,
+                    **gate_values
+                })
+            }
+        },
+        {
+            'Update': {
+                'TableName': SESSIONS_TABLE,
+                'Key': to_attribute_values({'SessionID': session_id}),
+                'UpdateExpression': session_update,
+                'ConditionExpression': 'attribute_not_exists(ExitTime)',
+                'ExpressionAttributeValues': to_attribute_values({
+                    ':exit_time': current_time,
+                    ':duration': duration_hours,
+                    ':payment': payment_due,
+                    ':photo': photo,
+                    **gate_values
+                })
+            }
+        }
+    ])
+
+    return duration_hours, payment_due
+
+def is_duplicate_event(pointer, text_detected, photo, current_time, exit_gate=False):
+    # The pointer item for a plate moves between open (no ExitTime) and closed.
+    # Events for a photo it already recorded come from S3 redelivery. Those
+    # arriving within the debounce window of its last transition come from a
+    # second camera, but only when they read the pointer's plate exactly: a
+    # pointer found through the skeleton index may be another car's. An exit
+    # gate's read is never a second camera on an entry, however soon after it
+    # the entry read was processed.
+    if pointer is None:
+        return False
+    if photo in (pointer.get('EntryPhoto'), pointer.get('ExitPhoto')):
+        return True
+    if exit_gate and 'ExitTime' not in pointer:
+        return False
+    if unscoped_key(pointer['PlateKey']) != normalise_plate(text_detected):
+        return False
+    last_transition = pointer.get('ExitTime', pointer['EntryTime'])
+    return current_time - int(last_transition) < DEBOUNCE_SECONDS
+
+def ignore_duplicate(text_detected):
+    print(f"Duplicate event ignored for {text_detected}")
+    count('Duplicates')
+
+    return {
+        'statusCode': 200,
+        'body': f"Duplicate event ignored for {text_detected}"
+    }
+
+def s3_records(event):
+    # Notifications arrive from S3 directly or, in queue mode, as SQS messages
+    # whose body is the S3 notification. Returns (item identifier, S3 record)
+    # pairs, where the identifier is what batchItemFailures reports: the SQS
+    # message ID, or the object key for direct events.
+    records = []
+    for record in event["Records"]:
+        if record.get("eventSource") == "aws:sqs":
+            body = json.loads(record["body"])
+            if body.get("detail-type") == "Object Created":
+                # The exit queue is fed by an EventBridge rule, whose events
+                # carry one object each.
+                records.append((record["messageId"], {"eventTime": body.get("time"), "s3": {
+                    "bucket": {"name": body["detail"]["bucket"]["name"]},
+                    "object": {"key": body["detail"]["object"]["key"], "eTag": body["detail"]["object"].get("etag")}
+                }}))
+                continue
+            # The s3:TestEvent sent when a notification is configured has no
+            # Records and is simply consumed.
+            for s3_record in body.get("Records", []):
+                records.append((record["messageId"], s3_record))
+        else:
+            records.append((record["s3"]["object"]["key"], record))
+    return records
+
+def record_priority(record):
+    # Cars wait at an exit barrier, so exit images go first.
+    site_id, gate_id = location_from_key(unquote_plus(record["s3"]["object"]["key"]))
+    return EXIT_PRIORITY if is_exit_gate(site_id, gate_id) else ENTRY_PRIORITY
+
+def event_key(record):
+    etag = record["s3"]["object"].get("eTag")
+    if not etag:
+        return None
+    return f"{record['s3']['bucket']['name']}/{unquote_plus(record['s3']['object']['key'])}#{etag}"
+
+def process_record(record, priority=ENTRY_PRIORITY, deadline=None):
+    key = event_key(record)
+    if key and processed_events.get(key):
+        print(f"Redelivered event ignored for {key}")
+        count('Redeliveries')
+        return {
+            'statusCode': 200,
+            'body': 'Redelivered event ignored'
+        }
+
+    with admission(priority, deadline):
+        result = handle_record(record)
+    # Only events that were handled are remembered, so one that failed is
+    # processed again when it is retried.
+    if key:
+        processed_events.set(key, True)
+    return result
+
+def wait_for_entry(record, text_detected, current_time):
+    # An exit gate read a plate with no open session. Exits have a queue of
+    # their own and go first, so its entry read may still be waiting; the
+    # record is deferred until ORPHAN_EXIT_WAIT after its upload. After that,
+    # or when the upload time is unknown, the entry was never read and the
+    # exit is counted rather than opening a session the next read would close.
+    uploaded_at = parse_capture_time(record.get("eventTime"))
+    if uploaded_at is not None and current_time - uploaded_at < ORPHAN_EXIT_WAIT:
+        raise Deferred(f"No open session yet for the exit of {text_detected}")
+
+    print(f"No open session for the exit of {text_detected}")
+    count('OrphanExits')
+    return {
+        'statusCode': 200,
+        'body': f"No open session for the exit of {text_detected}"
+    }
+
+def handle_record(record):
+    bucket = record["s3"]["bucket"]["name"]
+    photo = unquote_plus(record["s3"]["object"]["key"])
+    etag = record["s3"]["object"].get("eTag")
+
+    with stage('OCR'):
+        text_detected = detect_text(photo, bucket, etag)
+
+    if not text_detected or not normalise_plate(text_detected):
+        print(f"No text detected in the image {photo}")
+        count('Unread')
         return {
             'statusCode': 400,
             'body': 'No registration plate detected'
         }
-    
+
     text_detected = text_detected.strip()
     print("Text detected: " + str(text_detected))
-    
-    current_time = int(time.time())
-    
-    dynamodb = boto3.resource('dynamodb')
-    sessions_table = os.environ.get('SESSIONS_TABLE', 'ParkingSessions')
-    table = dynamodb.Table(sessions_table)
-    
-    response = table.query(
-        IndexName='CarRegistrationIndex',
-        KeyConditionExpression='CarRegistration = :reg',
-        FilterExpression='attribute_not_exists(ExitTime)',
-        ExpressionAttributeValues={
-            ':reg': text_detected
-        }
-    )
-    
-    if response['Items']:
-        session = response['Items'][0]
-        session_id = session['SessionID']
-        entry_time = int(session['EntryTime'])
-        
-        duration_seconds = current_time - entry_time
-        duration_hours = (duration_seconds + 3599) // 3600 
-        
-        payment_due = duration_hours * 2
-        
-        table.update_item(
-            Key={
-                'SessionID': session_id
-            },
-            UpdateExpression='SET ExitTime = :exit_time, DurationHours = :duration, PaymentDue = :payment',
-            ExpressionAttributeValues={
-                ':exit_time': current_time,
-                ':duration': duration_hours,
-                ':payment': payment_due
-            }
-        )
-        
-        print(f"Exit recorded for {text_detected}. Duration: {duration_hours} hours, Payment due: ${payment_due}")
-        
+
+    with stage('Metadata'):
+        site_id, gate_id, current_time = capture_details(bucket, photo, int(time.time()))
+
+    # Misreads are matched to an open session only at exit gates and gates of
+    # unknown direction.
+    with stage('SessionLookup'):
+        pointer = find_open_session(text_detected, site_id, fuzzy=not is_entry_gate(site_id, gate_id))
+    exit_gate = is_exit_gate(site_id, gate_id)
+    if is_duplicate_event(pointer, text_detected, photo, current_time, exit_gate):
+        return ignore_duplicate(text_detected)
+
+    open_pointer = pointer and 'ExitTime' not in pointer
+    if not open_pointer and exit_gate:
+        return wait_for_entry(record, text_detected, int(time.time()))
+    if open_pointer and is_entry_gate(site_id, gate_id):
+        # A race with the stale session's exit fails the record, which is
+        # retried and then finds the pointer closed.
+        with stage('SessionWrite'):
+            replace_session(pointer, text_detected, bucket, photo, etag, current_time, site_id, gate_id)
+        print(f"Entry recorded for {text_detected}, closing a session whose exit was not read")
+        count('Entries')
+        count('ExitsNotRead')
         return {
             'statusCode': 200,
-            'body': f"Exit recorded for {text_detected}. Payment due: ${payment_due}"
+            'body': f"Entry recorded for {text_detected}"
         }
-    else:
-        session_id = str(uuid.uuid4())
-        
-        table.put_item(
-            Item={
-                'SessionID': session_id,
-                'CarRegistration': text_detected,
-                'EntryTime': current_time,
-                'EntryPhoto': photo
+
+    try:
+        if open_pointer:
+            with stage('SessionWrite'):
+                duration_hours, payment_due = record_exit(pointer, photo, current_time, gate_id)
+
+            print(f"Exit recorded for {text_detected}. Duration: {duration_hours} hours, Payment due: ${payment_due}")
+            count('Exits')
+
+            return {
+                'statusCode': 200,
+                'body': f"Exit recorded for {text_detected}. Payment due: ${payment_due}"
             }
-        )
-        
-        print(f"Entry recorded for {text_detected}")
-        
+        else:
+            with stage('SessionWrite'):
+                record_entry(text_detected, bucket, photo, etag, current_time, site_id, gate_id)
+
+            print(f"Entry recorded for {text_detected}")
+            count('Entries')
+
+            return {
+                'statusCode': 200,
+                'body': f"Entry recorded for {text_detected}"
+            }
+    except ClientError as e:
+        if not lost_condition_race(e):
+            raise
+        return ignore_duplicate(text_detected)
+
+def process_batch(records, deadline=None):
+    # records are (item identifier, S3 record) pairs. Within a batch, exit
+    # records are submitted first and are served first by the Rekognition
+    # limiter. Returns the results, the identifiers of items that failed and
+    # those of items deferred for want of recognition capacity. A message is
+    # retried whole, so each is reported once, as failed if any record failed.
+    results = [None] * len(records)
+    failed = []
+    deferred = []
+    priorities = [record_priority(record) for _, record in records]
+    order = sorted(range(len(records)), key=lambda index: priorities[index])
+
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(records)))) as executor:
+        futures = {}
+        for index in order:
+            if EXITS_QUEUED_SEPARATELY and priorities[index] == EXIT_PRIORITY:
+                count('LeftToExitQueue')
+                results[index] = {'statusCode': 200, 'body': 'Left to the exit queue'}
+                continue
+            futures[index] = executor.submit(process_record, records[index][1], priorities[index], deadline)
+        for index, future in futures.items():
+            item_id = records[index][0]
+            try:
+                results[index] = future.result()
+            except Deferred as e:
+                print(f"Deferred {item_id}: {str(e)}")
+                count('Deferred')
+                results[index] = {'statusCode': 503, 'body': str(e)}
+                if item_id not in deferred:
+                    deferred.append(item_id)
+            except Exception as e:
+                print(f"Error processing {item_id}: {str(e)}")
+                results[index] = {'statusCode': 500, 'body': str(e)}
+                if item_id not in failed:
+                    failed.append(item_id)
+
+    return results, failed, [item_id for item_id in deferred if item_id not in failed]
+
+def requeue(record):
+    # Sends a deferred message back to its queue as a new message, so that
+    # waiting for recognition capacity during a long burst does not use up
+    # the receives after which the queue moves it to the dead-letter queue.
+    queue_arn = record["eventSourceARN"]
+    if queue_arn not in queue_urls:
+        _, _, _, _, account, name = queue_arn.split(':')
+        queue_urls[queue_arn] = get_client('sqs').get_queue_url(QueueName=name, QueueOwnerAWSAccountId=account)['QueueUrl']
+    get_client('sqs').send_message(
+        QueueUrl=queue_urls[queue_arn],
+        MessageBody=record["body"],
+        DelaySeconds=int(REQUEUE_DELAY * random.uniform(1, 2))
+    )
+
+@instrumented('s3getpassrek')
+def main(event, context):
+    results, failed, deferred = process_batch(s3_records(event), deadline_for(context))
+
+    # S3 invokes the function asynchronously and only retries an event whose
+    # invocation failed, so batchItemFailures is only returned to SQS.
+    messages = {record["messageId"]: record for record in event["Records"] if record.get("eventSource") == "aws:sqs"}
+    if not messages:
+        if failed or deferred:
+            raise RuntimeError(f"Failed to process {', '.join(failed + deferred)}")
         return {
             'statusCode': 200,
-            'body': f"Entry recorded for {text_detected}"
-        }
\ No newline at end of file
+            'body': json.dumps(results)
+        }
+
+    for item_id in deferred:
+        try:
+            requeue(messages[item_id])
+            count('Requeued')
+        except (ClientError, KeyError) as e:
+            print(f"Could not requeue {item_id}, leaving it to the queue: {str(e)}")
+            failed.append(item_id)
+    failures = [{'itemIdentifier': item_id} for item_id in failed]
+
+    return {
+        'statusCode': 500 if failures else 200,
+        'body': json.dumps(results),
+        'batchItemFailures': failures
+    }
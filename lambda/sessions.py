@@ -0,0 +1,40 @@
+import os
+
+from plates import best_match, normalise_plate, plate_skeleton
+from sites import DEFAULT_SITE, site_key, unscoped_key
+from tables import get_table
+
+OPEN_SESSIONS_TABLE = os.environ.get('OPEN_SESSIONS_TABLE', 'OpenSessions')
+
+# OpenSessions holds one pointer item per plate and site, keyed by the site
+# scoped PlateKey. A pointer without ExitTime is the plate's open session;
+# closed pointers are kept until ExpiresAt.
+
+def find_open_session(text_detected, site_id=DEFAULT_SITE, fuzzy=True):
+    # fuzzy=False looks up the exact plate only. An entry gate reads cars
+    # arriving, and a lookalike of a parked car must not close its session.
+    pointers = get_table(OPEN_SESSIONS_TABLE)
+
+    pointer = pointers.get_item(
+        Key={'PlateKey': site_key(site_id, normalise_plate(text_detected))},
+        ConsistentRead=True
+    ).get('Item')
+    if not fuzzy or pointer and 'ExitTime' not in pointer:
+        return pointer
+
+    # A misread has a different PlateKey but the same skeleton. Closed pointers
+    # stay in the index until they expire so that late duplicates of an exit
+    # read differently are still recognised.
+    response = pointers.query(
+        IndexName='PlateSkeletonIndex',
+        KeyConditionExpression='PlateSkeleton = :skeleton',
+        ExpressionAttributeValues={
+            ':skeleton': site_key(site_id, plate_skeleton(text_detected))
+        }
+    )
+    open_pointers = {unscoped_key(item['PlateKey']): item for item in response['Items'] if 'ExitTime' not in item}
+    if open_pointers:
+        return best_match(text_detected, open_pointers)
+    if pointer or not response['Items']:
+        return pointer
+    return max(response['Items'], key=lambda item: item['ExitTime'])
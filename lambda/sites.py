@@ -0,0 +1,66 @@
+import os
+import re
+from datetime import datetime
+
+DEFAULT_SITE = 'default'
+UPLOAD_PREFIX = 'uploads/'
+SITE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+# Gates whose images are exits, as gate IDs used at every site or as
+# site/gate for a single site. Their images are processed ahead of entries.
+EXIT_GATES = frozenset(gate.strip() for gate in os.environ.get('EXIT_GATES', '').split(',') if gate.strip())
+
+def valid_id(value):
+    if value and SITE_ID_PATTERN.match(value):
+        return value
+    return None
+
+# Keys and index values shared by every site (the open-session pointers, their
+# skeleton index and the entry-hour buckets) are prefixed with the site, so a
+# busy site's reads and writes stay on partitions of its own. The default site
+# keeps the unprefixed form that items written before sites existed use.
+def site_key(site_id, key):
+    if not site_id or site_id == DEFAULT_SITE:
+        return key
+    return f"{site_id}#{key}"
+
+def unscoped_key(key):
+    return key.rpartition('#')[2]
+
+def location_from_key(object_key):
+    # Cameras upload to uploads/<site>/<gate>/<image>. Images uploaded
+    # anywhere else belong to the default site and an unknown gate.
+    if not object_key.startswith(UPLOAD_PREFIX):
+        return None, None
+    folders = object_key[len(UPLOAD_PREFIX):].split('/')[:-1]
+    if len(folders) != 2:
+        return None, None
+    site_id, gate_id = valid_id(folders[0]), valid_id(folders[1])
+    if site_id is None or gate_id is None:
+        return None, None
+    return site_id, gate_id
+
+def is_exit_gate(site_id, gate_id):
+    if not gate_id:
+        return False
+    return gate_id in EXIT_GATES or f"{site_id}/{gate_id}" in EXIT_GATES
+
+def is_entry_gate(site_id, gate_id):
+    # A gate is only known to be an entry when exit gates are configured and
+    # it is not one of them. Without EXIT_GATES every gate may see both.
+    return bool(gate_id) and bool(EXIT_GATES) and not is_exit_gate(site_id, gate_id)
+
+def parse_capture_time(value):
+    # Epoch seconds or an ISO 8601 timestamp with a UTC offset.
+    if not value:
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    try:
+        captured = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if captured.tzinfo is None:
+        return None
+    return int(captured.timestamp())
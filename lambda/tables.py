@@ -0,0 +1,158 @@
+import random
+import time
+from decimal import Decimal
+
+from clients import get_client
+
+# A small replacement for boto3's DynamoDB Table resource, built on the
+# botocore client. Handlers never import boto3, which pulls in s3transfer and
+# the resource models during a cold start. Values convert as they do in boto3:
+# numbers come back as Decimal and floats are rejected.
+
+BATCH_WRITE_SIZE = 25
+# Unprocessed items are resubmitted after a jittered, exponentially growing
+# pause, as the AWS SDKs recommend, so a throttled table is not hammered.
+BATCH_BACKOFF_BASE = 0.05
+BATCH_BACKOFF_CAP = 5
+
+def backoff_delay(retries):
+    return random.uniform(0, min(BATCH_BACKOFF_CAP, BATCH_BACKOFF_BASE * 2 ** retries))
+
+def serialize(value):
+    if value is None:
+        return {'NULL': True}
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if isinstance(value, (int, Decimal)):
+        return {'N': str(value)}
+    if isinstance(value, float):
+        raise TypeError('Float types are not supported. Use Decimal types instead.')
+    if isinstance(value, str):
+        return {'S': value}
+    if isinstance(value, (bytes, bytearray)):
+        return {'B': bytes(value)}
+    if isinstance(value, (set, frozenset)):
+        if all(isinstance(member, str) for member in value):
+            return {'SS': list(value)}
+        if all(isinstance(member, (bytes, bytearray)) for member in value):
+            return {'BS': [bytes(member) for member in value]}
+        if all(isinstance(member, (int, Decimal)) and not isinstance(member, bool) for member in value):
+            return {'NS': [serialize(member)['N'] for member in value]}
+        raise TypeError(f"Sets must hold only strings, only binary or only numbers: {value!r}")
+    if isinstance(value, dict):
+        return {'M': serialize_item(value)}
+    if isinstance(value, (list, tuple)):
+        return {'L': [serialize(member) for member in value]}
+    raise TypeError(f"Unsupported type {type(value).__name__} for value {value!r}")
+
+def deserialize(attribute):
+    (attribute_type, value), = attribute.items()
+    if attribute_type == 'S' or attribute_type == 'B' or attribute_type == 'BOOL':
+        return value
+    if attribute_type == 'N':
+        return Decimal(value)
+    if attribute_type == 'NULL':
+        return None
+    if attribute_type == 'M':
+        return deserialize_item(value)
+    if attribute_type == 'L':
+        return [deserialize(member) for member in value]
+    if attribute_type == 'NS':
+        return {Decimal(member) for member in value}
+    if attribute_type in ('SS', 'BS'):
+        return set(value)
+    raise TypeError(f"Unsupported DynamoDB type {attribute_type}")
+
+def serialize_item(item):
+    return {name: serialize(value) for name, value in item.items()}
+
+def deserialize_item(item):
+    return {name: deserialize(value) for name, value in item.items()}
+
+class Table:
+    def __init__(self, name):
+        self.name = name
+
+    def call(self, operation, params):
+        request = dict(params, TableName=self.name)
+        for name in ('Key', 'Item', 'ExclusiveStartKey', 'ExpressionAttributeValues'):
+            if name in request:
+                request[name] = serialize_item(request[name])
+
+        response = getattr(get_client('dynamodb'), operation)(**request)
+        for name in ('Item', 'Attributes', 'LastEvaluatedKey'):
+            if name in response:
+                response[name] = deserialize_item(response[name])
+        if 'Items' in response:
+            response['Items'] = [deserialize_item(item) for item in response['Items']]
+        return response
+
+    def get_item(self, **params):
+        return self.call('get_item', params)
+
+    def put_item(self, **params):
+        return self.call('put_item', params)
+
+    def update_item(self, **params):
+        return self.call('update_item', params)
+
+    def delete_item(self, **params):
+        return self.call('delete_item', params)
+
+    def query(self, **params):
+        return self.call('query', params)
+
+    def scan(self, **params):
+        return self.call('scan', params)
+
+    def batch_writer(self):
+        return BatchWriter(self.name)
+
+class BatchWriter:
+    # Buffers puts and deletes into BatchWriteItem calls of up to 25 and
+    # resubmits unprocessed items, backing off between attempts, until the
+    # buffer is empty.
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.requests = []
+        self.retries = 0
+
+    def put_item(self, Item):
+        self.add({'PutRequest': {'Item': serialize_item(Item)}})
+
+    def delete_item(self, Key):
+        self.add({'DeleteRequest': {'Key': serialize_item(Key)}})
+
+    def add(self, request):
+        self.requests.append(request)
+        if len(self.requests) >= BATCH_WRITE_SIZE:
+            self.flush_batch()
+
+    def flush_batch(self):
+        batch, self.requests = self.requests[:BATCH_WRITE_SIZE], self.requests[BATCH_WRITE_SIZE:]
+        response = get_client('dynamodb').batch_write_item(RequestItems={self.table_name: batch})
+        unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+        if not unprocessed:
+            self.retries = 0
+            return
+        self.requests.extend(unprocessed)
+        time.sleep(backoff_delay(self.retries))
+        self.retries += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        while self.requests:
+            self.flush_batch()
+        return False
+
+_tables = {}
+
+def get_table(table_name):
+    # Table objects hold no connection state, so one per name is shared by
+    # every thread.
+    table = _tables.get(table_name)
+    if table is None:
+        table = _tables[table_name] = Table(table_name)
+    return table
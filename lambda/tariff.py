@@ -0,0 +1,113 @@
+import json
+import os
+from decimal import Decimal
+
+MINUTES_PER_DAY = 24 * 60
+
+# The original flat rate: £2 for every started hour.
+DEFAULT_TARIFF = {
+    'unit_minutes': 60,
+    'grace_minutes': 0,
+    'daily_cap': None,
+    'utc_offset_minutes': 0,
+    'bands': [
+        {'start': '00:00', 'end': '24:00', 'hourly_rate': 2}
+    ]
+}
+
+def parse_time_of_day(value):
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+class Tariff:
+    # A tariff is compiled into the cumulative price of every minute across two
+    # days, so the price of any window shorter than a day is one subtraction
+    # and a session of any length costs O(1) to price.
+    def __init__(self, definition):
+        self.unit_minutes = int(definition.get('unit_minutes', 60))
+        self.grace_minutes = int(definition.get('grace_minutes', 0))
+        self.daily_cap = definition.get('daily_cap')
+        self.utc_offset_minutes = int(definition.get('utc_offset_minutes', 0))
+
+        minute_rates = [0.0] * MINUTES_PER_DAY
+        for band in definition['bands']:
+            start = parse_time_of_day(band['start'])
+            end = parse_time_of_day(band['end'])
+            minutes = range(start, end) if start < end else list(range(start, MINUTES_PER_DAY)) + list(range(0, end))
+            for minute in minutes:
+                minute_rates[minute] = band['hourly_rate'] / 60
+
+        self.cumulative = [0.0]
+        for rate in minute_rates + minute_rates:
+            self.cumulative.append(self.cumulative[-1] + rate)
+
+        self.day_price = self.cumulative[MINUTES_PER_DAY]
+        if self.daily_cap is not None:
+            self.day_price = min(self.day_price, self.daily_cap)
+
+    def billed_minutes(self, entry_time, exit_time):
+        duration_seconds = max(exit_time - entry_time, 0)
+        if duration_seconds <= self.grace_minutes * 60:
+            return 0
+        minutes = -(-duration_seconds // 60)
+        return -(-minutes // self.unit_minutes) * self.unit_minutes
+
+    def start_minute(self, entry_time):
+        return (entry_time // 60 + self.utc_offset_minutes) % MINUTES_PER_DAY
+
+    def price(self, entry_time, exit_time):
+        full_days, remainder = divmod(self.billed_minutes(entry_time, exit_time), MINUTES_PER_DAY)
+        start = self.start_minute(entry_time)
+
+        partial_price = self.cumulative[start + remainder] - self.cumulative[start]
+        if self.daily_cap is not None:
+            partial_price = min(partial_price, self.daily_cap)
+
+        price = full_days * self.day_price + partial_price
+        return Decimal(str(round(price, 2))).quantize(Decimal('0.01'))
+
+    def price_many(self, entry_times, exit_times):
+        # Vectorised repricing for bulk jobs over historical sessions. NumPy is
+        # only needed here, so the Lambda handlers do not import it.
+        import numpy as np
+
+        entry_times = np.asarray(entry_times, dtype=np.int64)
+        exit_times = np.asarray(exit_times, dtype=np.int64)
+
+        duration_seconds = np.maximum(exit_times - entry_times, 0)
+        minutes = -(-duration_seconds // 60)
+        billed = -(-minutes // self.unit_minutes) * self.unit_minutes
+        billed[duration_seconds <= self.grace_minutes * 60] = 0
+
+        full_days, remainder = np.divmod(billed, MINUTES_PER_DAY)
+        start = (entry_times // 60 + self.utc_offset_minutes) % MINUTES_PER_DAY
+
+        cumulative = np.asarray(self.cumulative)
+        partial_price = cumulative[start + remainder] - cumulative[start]
+        if self.daily_cap is not None:
+            partial_price = np.minimum(partial_price, self.daily_cap)
+
+        return np.round(full_days * self.day_price + partial_price, 2)
+
+def load_tariff_definitions():
+    if os.environ.get('TARIFFS_FILE'):
+        with open(os.environ['TARIFFS_FILE']) as tariffs_file:
+            return json.load(tariffs_file)
+    if os.environ.get('TARIFFS'):
+        return json.loads(os.environ['TARIFFS'])
+    return {'default': DEFAULT_TARIFF}
+
+_definitions = None
+_tariffs = {}
+
+def get_tariff(site_id=None):
+    # TARIFFS holds a 'default' tariff and optional per-site overrides under 'sites'.
+    global _definitions
+    if _definitions is None:
+        _definitions = load_tariff_definitions()
+
+    key = site_id if site_id in _definitions.get('sites', {}) else None
+    if key not in _tariffs:
+        definition = _definitions['sites'][key] if key else _definitions.get('default', DEFAULT_TARIFF)
+        _tariffs[key] = Tariff(definition)
+    return _tariffs[key]
@@ -0,0 +1,138 @@
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from botocore.exceptions import ClientError
+
+from metrics import count
+
+# Rekognition calls are paced by a token bucket sized to the account's TPS
+# quota, shared between the containers the queue's event source mapping may
+# run at once. REKOGNITION_TPS=0 turns pacing off.
+REKOGNITION_TPS = float(os.environ.get('REKOGNITION_TPS', '5'))
+QUEUE_CONCURRENCY = int(os.environ.get('QUEUE_CONCURRENCY', '1'))
+THROTTLE_RETRIES = int(os.environ.get('THROTTLE_RETRIES', '5'))
+BACKOFF_BASE = float(os.environ.get('BACKOFF_BASE', '0.2'))
+BACKOFF_CAP = float(os.environ.get('BACKOFF_CAP', '5'))
+# Time kept back from the invocation's deadline to finish writing a record.
+DEADLINE_MARGIN = float(os.environ.get('DEADLINE_MARGIN', '3'))
+
+RETRYABLE_CODES = {
+    'ThrottlingException',
+    'ProvisionedThroughputExceededException',
+    'LimitExceededException',
+    'InternalServerError'
+}
+
+# Lower values are served first.
+EXIT_PRIORITY = 0
+ENTRY_PRIORITY = 1
+
+class Deferred(Exception):
+    # A call could not be made before the invocation's deadline. The record is
+    # handed back to the queue rather than counted as an error.
+    pass
+
+class TokenBucket:
+    # Refills at rate tokens per second up to burst. Callers waiting for a
+    # token are served by priority, then in arrival order.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority=ENTRY_PRIORITY, deadline=None):
+        # Returns False when no token could be had before deadline, a
+        # time.monotonic() value.
+        with self.condition:
+            waiter = (priority, next(self.sequence))
+            heapq.heappush(self.waiters, waiter)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.refill(now)
+                    first = self.waiters[0] == waiter
+                    if first and self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+
+                    # The first waiter sleeps until its token is due; the rest
+                    # until a waiter ahead of them leaves.
+                    timeout = (1 - self.tokens) / self.rate if first else None
+                    if deadline is not None:
+                        if now >= deadline:
+                            return False
+                        timeout = deadline - now if timeout is None else min(timeout, deadline - now)
+                    self.condition.wait(timeout)
+            finally:
+                self.waiters.remove(waiter)
+                heapq.heapify(self.waiters)
+                self.condition.notify_all()
+
+    def drain(self):
+        # After a throttling error the quota is already spent, so every caller
+        # waits for fresh tokens.
+        with self.condition:
+            self.refill(time.monotonic())
+            self.tokens = min(self.tokens, 0)
+
+rekognition_limiter = None
+if REKOGNITION_TPS > 0:
+    # A burst of one keeps calls evenly spaced, so no second sees more than
+    # the container's share even when the bucket starts full.
+    rekognition_limiter = TokenBucket(REKOGNITION_TPS / max(1, QUEUE_CONCURRENCY), burst=1)
+
+# The priority and deadline of the record each worker thread is processing.
+_request = threading.local()
+
+@contextmanager
+def admission(priority, deadline):
+    previous = getattr(_request, 'value', None)
+    _request.value = (priority, deadline)
+    try:
+        yield
+    finally:
+        _request.value = previous
+
+def deadline_for(context):
+    # Lambda contexts report the time left; the offline harness passes None.
+    remaining = getattr(context, 'get_remaining_time_in_millis', None)
+    if remaining is None:
+        return None
+    return time.monotonic() + remaining() / 1000 - DEADLINE_MARGIN
+
+def is_retryable(error):
+    return error.response.get('Error', {}).get('Code') in RETRYABLE_CODES
+
+def call_with_backoff(call, limiter):
+    # Takes a token for every attempt and retries throttling and server errors
+    # with full jitter, so that containers throttled together do not retry in
+    # step. Raises Deferred when the deadline would pass first.
+    priority, deadline = getattr(_request, 'value', None) or (ENTRY_PRIORITY, None)
+    for attempt in range(THROTTLE_RETRIES + 1):
+        if limiter is not None and not limiter.acquire(priority, deadline):
+            raise Deferred('No recognition capacity before the deadline')
+        try:
+            return call()
+        except ClientError as e:
+            if not is_retryable(e) or attempt == THROTTLE_RETRIES:
+                raise
+            count('Throttled')
+            if limiter is not None:
+                limiter.drain()
+            delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise Deferred('Throttled until the deadline') from e
+            time.sleep(delay)
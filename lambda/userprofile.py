@@ -1,15 +1,64 @@
 import json
-import boto3
+import logging
 import os
 from decimal import Decimal
 from datetime import datetime
 
-dynamodb = boto3.resource('dynamodb')
-sns = boto3.client('sns')
+from botocore.exceptions import ClientError
+
+from clients import get_client
+from metrics import instrumented, stage
+from plates import normalise_plate, plate_owner_key
+from tables import get_table, serialize_item
 
 USERS_TABLE = os.environ.get('USERS_TABLE', 'CarParkUsers')
 SNS_TOPIC_ARN = os.environ.get('SNS_TOPIC_ARN')
 
+# Request and response dumps are logged at DEBUG so the hot path stays quiet.
+logger = logging.getLogger()
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+def subscribe_user(user_id, email):
+    # Notifications carry a UserID message attribute, and each user's
+    # subscription only accepts messages with their own. SNS refuses to
+    # subscribe an address again with different attributes, so when the
+    # address already has a subscription, made before filtering or for
+    # another profile with the same address, the user's ID is added to its
+    # filter policy instead.
+    sns = get_client('sns')
+    policy = {'UserID': [user_id]}
+    try:
+        sns.subscribe(
+            TopicArn=SNS_TOPIC_ARN,
+            Protocol='email',
+            Endpoint=email,
+            Attributes={'FilterPolicy': json.dumps(policy)}
+        )
+        return
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidParameter':
+            raise
+
+    subscription_arn = sns.subscribe(
+        TopicArn=SNS_TOPIC_ARN,
+        Protocol='email',
+        Endpoint=email,
+        ReturnSubscriptionArn=True
+    )['SubscriptionArn']
+    attributes = sns.get_subscription_attributes(SubscriptionArn=subscription_arn)['Attributes']
+    if attributes.get('FilterPolicy'):
+        existing = json.loads(attributes['FilterPolicy'])
+        user_ids = existing.get('UserID', [])
+        if user_id in user_ids:
+            return
+        policy = dict(existing, UserID=user_ids + [user_id])
+    sns.set_subscription_attributes(
+        SubscriptionArn=subscription_arn,
+        AttributeName='FilterPolicy',
+        AttributeValue=json.dumps(policy)
+    )
+    logger.info("Added user %s to the filter policy of %s", user_id, subscription_arn)
+
 def handle_cognito_trigger(event, context):
     if event['triggerSource'] == 'PostConfirmation_ConfirmSignUp':
         try:
@@ -20,24 +69,19 @@ def handle_cognito_trigger(event, context):
                 'Email': user_attributes['email'],
                 'Name': '',  
                 'RegPlates': [], 
+                'PlateOwnerItems': True,
                 'CreatedAt': datetime.now().isoformat(),
                 'UpdatedAt': datetime.now().isoformat()
             }
             
-            table = dynamodb.Table(USERS_TABLE)
+            table = get_table(USERS_TABLE)
             table.put_item(Item=user_item)
             
-            update_car_registration_index(user_attributes['sub'], [])
-            
             if user_attributes['email']:
-                sns.subscribe(
-                    TopicArn=SNS_TOPIC_ARN,
-                    Protocol='email',
-                    Endpoint=user_attributes['email']
-                )
+                subscribe_user(user_attributes['sub'], user_attributes['email'])
             
-        except Exception as e:
-            print(f"Error creating user record: {str(e)}")
+        except Exception:
+            logger.exception("Error creating user record")
         
         return event
     
@@ -54,26 +98,26 @@ def create_user_profile(event, context):
         
         reg_plates = [plate.strip() for plate in reg_plates if plate]
         
-        user_item = {
-            'UserID': user_id,
-            'Email': email,
-            'Name': name,
-            'RegPlates': reg_plates,
-            'UpdatedAt': datetime.now().isoformat()
-        }
-        
-        table = dynamodb.Table(USERS_TABLE)
-        table.put_item(Item=user_item)
+        def write(plates, old_item):
+            user_item = {
+                'UserID': user_id,
+                'Email': email,
+                'Name': name,
+                'RegPlates': plates,
+                'PlateOwnerItems': True,
+                'UpdatedAt': datetime.now().isoformat()
+            }
+            if plates:
+                user_item['CarRegistration'] = plates[0]
+            return {'Put': {'TableName': USERS_TABLE, 'Item': serialize_item(user_item)}}, user_item
         
-        if reg_plates:
-            update_car_registration_index(user_id, reg_plates)
+        conflicts, _ = save_profile(get_table(USERS_TABLE), user_id, reg_plates, email, write)
         
         if email:
-            sns.subscribe(
-                TopicArn=SNS_TOPIC_ARN,
-                Protocol='email',
-                Endpoint=email
-            )
+            subscribe_user(user_id, email)
+        
+        if conflicts:
+            return conflict_response(conflicts)
         
         return {
             'statusCode': 200,
@@ -84,7 +128,10 @@ def create_user_profile(event, context):
             },
             'body': json.dumps({'message': 'Profile created successfully'})
         }
+    except TooManyPlateChanges as e:
+        return too_many_changes_response(e)
     except Exception as e:
+        logger.exception("Error creating user profile")
         return {
             'statusCode': 500,
             'headers': {
@@ -95,77 +142,53 @@ def create_user_profile(event, context):
             'body': json.dumps({'error': str(e)})
         }
 
+def migrate_legacy_profile(item):
+    # Profiles saved before plate mapping items existed are migrated the first
+    # time they are read; afterwards GET /profile is a single get_item.
+    user_id = item['UserID']
+
+    # Before mapping items, saving plates rewrote the profile item itself, so
+    # CarRegistration is the only plate a profile without RegPlates kept.
+    reg_plates = item.get('RegPlates')
+    if reg_plates is None:
+        reg_plates = [item['CarRegistration']] if 'CarRegistration' in item else []
+
+    conflicts = update_car_registration_index(user_id, reg_plates, [], item.get('Email', ''))
+    reg_plates = without_conflicts(reg_plates, conflicts)
+
+    try:
+        get_table(USERS_TABLE).update_item(
+            Key={'UserID': user_id},
+            UpdateExpression='SET RegPlates = :plates, PlateOwnerItems = :mapped',
+            ConditionExpression='attribute_not_exists(PlateOwnerItems)',
+            ExpressionAttributeValues={
+                ':plates': reg_plates,
+                ':mapped': True
+            }
+        )
+        logger.info("Migrated legacy profile %s with plates %s", user_id, reg_plates)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+    item['RegPlates'] = reg_plates
+    item['PlateOwnerItems'] = True
+
 def get_user_profile(event, context):
     try:
-        print("Event:", json.dumps(event))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Event: %s", json.dumps(event))
         user_id = event['requestContext']['authorizer']['jwt']['claims']['sub']
-        print("User ID:", user_id)
         
-        table = dynamodb.Table(USERS_TABLE)
-        print("Getting item from table:", USERS_TABLE)
-        response = table.get_item(Key={'UserID': user_id})
-        print("DynamoDB Response:", json.dumps(response))
+        table = get_table(USERS_TABLE)
+        with stage('ProfileRead'):
+            response = table.get_item(Key={'UserID': user_id})
         
         if 'Item' in response:
             item = response['Item']
-            print("User item found:", json.dumps(item))
             
-            if 'RegPlates' in item:
-                print("RegPlates found:", json.dumps(item['RegPlates']))
-            else:
-                print("RegPlates not found in user item")
-                
-                if 'CarRegistration' in item:
-                    car_reg = item['CarRegistration']
-                    print(f"Found CarRegistration directly in user record: {car_reg}")
-                    
-                    reg_plates = [car_reg]
-                    item['RegPlates'] = reg_plates
-                    
-                    try:
-                        table.update_item(
-                            Key={'UserID': user_id},
-                            UpdateExpression='SET RegPlates = :plates',
-                            ExpressionAttributeValues={
-                                ':plates': reg_plates
-                            }
-                        )
-                        print(f"Updated user record with RegPlates: {reg_plates}")
-                    except Exception as e:
-                        print(f"Error updating user record with RegPlates: {str(e)}")
-                else:
-                    try:
-                        scan_response = table.scan(
-                            FilterExpression='UserID = :user_id',
-                            ExpressionAttributeValues={
-                                ':user_id': user_id
-                            }
-                        )
-                        
-                        reg_plates = []
-                        for scan_item in scan_response.get('Items', []):
-                            if 'CarRegistration' in scan_item and scan_item['CarRegistration'] != user_id:
-                                reg_plates.append(scan_item['CarRegistration'])
-                        
-                        if reg_plates:
-                            print(f"Found registration plates in scan: {reg_plates}")
-                            
-                            item['RegPlates'] = reg_plates
-                            
-                            table.update_item(
-                                Key={'UserID': user_id},
-                                UpdateExpression='SET RegPlates = :plates',
-                                ExpressionAttributeValues={
-                                    ':plates': reg_plates
-                                }
-                            )
-                            print("Updated user record with RegPlates")
-                        else:
-                            print("No registration plates found in scan")
-                            item['RegPlates'] = []
-                    except Exception as e:
-                        print(f"Error scanning for registration plates: {str(e)}")
-                        item['RegPlates'] = []
+            if not item.get('PlateOwnerItems'):
+                migrate_legacy_profile(item)
             
             return {
                 'statusCode': 200,
@@ -188,8 +211,7 @@ def get_user_profile(event, context):
             }
     except Exception as e:
         import traceback
-        print("Error:", str(e))
-        print("Traceback:", traceback.format_exc())
+        logger.exception("Error getting user profile")
         return {
             'statusCode': 500,
             'headers': {
@@ -203,79 +225,236 @@ def get_user_profile(event, context):
             })
         }
 
-def update_car_registration_index(user_id, reg_plates):
-    table = dynamodb.Table(USERS_TABLE)
-    
-    response = table.get_item(Key={'UserID': user_id})
-    if 'Item' not in response:
-        print(f"User {user_id} not found")
-        return
-    
-    user = response['Item']
-    email = user.get('Email', '')
-    name = user.get('Name', '')
-    
-    update_expression = 'SET RegPlates = :plates'
-    expression_values = {
-        ':plates': reg_plates
+def mapped_plates(user_item):
+    # Profiles saved before plate mapping items existed have none to diff against.
+    if user_item.get('PlateOwnerItems'):
+        return user_item.get('RegPlates', [])
+    return []
+
+# TransactWriteItems takes up to 100 actions.
+TRANSACT_WRITE_SIZE = 100
+# A save is read and written again when another save of the same profile
+# commits between its read and its write.
+SAVE_ATTEMPTS = 5
+
+def mapping_actions(user_id, added, removed, email):
+    # A plate mapping is only written while it is free or already the user's,
+    # and only deleted while it is still theirs, so two users saving the same
+    # plate cannot take it from each other.
+    actions = []
+    for key, plate in added.items():
+        actions.append((key, {
+            'Put': {
+                'TableName': USERS_TABLE,
+                'Item': serialize_item({
+                    'UserID': key,
+                    'OwnerID': user_id,
+                    'CarRegistration': plate,
+                    'Email': email
+                }),
+                'ConditionExpression': 'attribute_not_exists(UserID) OR OwnerID = :me',
+                'ExpressionAttributeValues': serialize_item({':me': user_id})
+            }
+        }))
+    for key in removed:
+        actions.append((key, {
+            'Delete': {
+                'TableName': USERS_TABLE,
+                'Key': serialize_item({'UserID': key}),
+                'ConditionExpression': 'OwnerID = :me',
+                'ExpressionAttributeValues': serialize_item({':me': user_id})
+            }
+        }))
+    return actions
+
+def update_car_registration_index(user_id, reg_plates, old_plates=(), email=''):
+    # Each registered plate has its own mapping item so that plates resolve to
+    # their owner with a key lookup. Only plates added or removed since
+    # old_plates are written, in as few TransactWriteItems calls as possible.
+    # Returns the added plates that are registered to another user; their
+    # mappings are left alone.
+    new_keys = {plate_owner_key(plate): plate for plate in reg_plates if normalise_plate(plate)}
+    old_keys = {plate_owner_key(plate) for plate in old_plates if normalise_plate(plate)}
+
+    added = {key: plate for key, plate in new_keys.items() if key not in old_keys}
+    removed = [key for key in old_keys if key not in new_keys]
+    if not added and not removed:
+        return []
+
+    conflicts = []
+    actions = mapping_actions(user_id, added, removed, email)
+    with stage('PlateMappings'):
+        while actions:
+            batch, actions = actions[:TRANSACT_WRITE_SIZE], actions[TRANSACT_WRITE_SIZE:]
+            try:
+                get_client('dynamodb').transact_write_items(TransactItems=[action for _, action in batch])
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'TransactionCanceledException':
+                    raise
+                # One failed condition cancels the whole transaction. The
+                # actions that failed theirs are dropped and the rest retried:
+                # a plate owned by someone else is a conflict, and a removed
+                # plate that is no longer the user's needs no delete.
+                reasons = e.response.get('CancellationReasons', [])
+                failed = {index for index, reason in enumerate(reasons) if reason.get('Code') == 'ConditionalCheckFailed'}
+                if not failed:
+                    raise
+                conflicts.extend(added[key] for index, (key, action) in enumerate(batch) if index in failed and 'Put' in action)
+                actions = [pair for index, pair in enumerate(batch) if index not in failed] + actions
+
+    logger.info("Updated plate mappings for user %s: added %s, removed %s", user_id, list(added), removed)
+    if conflicts:
+        logger.warning("Plates %s for user %s are registered to another user", conflicts, user_id)
+    return conflicts
+
+def without_conflicts(reg_plates, conflicts):
+    # A conflict is reported in one spelling, so every spelling of the same
+    # plate is dropped with it.
+    conflict_keys = {plate_owner_key(plate) for plate in conflicts}
+    return [plate for plate in reg_plates if plate_owner_key(plate) not in conflict_keys]
+
+class TooManyPlateChanges(Exception):
+    pass
+
+def unchanged_since(old_item):
+    # The condition that no other save has written the profile since
+    # old_item was read.
+    if not old_item:
+        return 'attribute_not_exists(UserID)', {}
+    if 'UpdatedAt' not in old_item:
+        return 'attribute_not_exists(UpdatedAt)', {}
+    return 'UpdatedAt = :read_at', {':read_at': old_item['UpdatedAt']}
+
+def save_profile(table, user_id, reg_plates, email, write):
+    # The profile and the plate mappings it adds or removes are written in one
+    # TransactWriteItems, conditional on the profile being unchanged since it
+    # was read. Two racing saves cannot both diff against the same plates, and
+    # a save that fails leaves the profile and its mappings as they were.
+    # write(plates, old_item) returns the profile's Put or Update action and
+    # the profile it saves. Returns the plates registered to another user,
+    # which are left off the profile, and the saved profile.
+    client = get_client('dynamodb')
+    conflicts = []
+    for _ in range(SAVE_ATTEMPTS):
+        with stage('ProfileRead'):
+            old_item = table.get_item(Key={'UserID': user_id}, ConsistentRead=True).get('Item', {})
+        plates = without_conflicts(reg_plates, conflicts)
+        new_keys = {plate_owner_key(plate): plate for plate in plates if normalise_plate(plate)}
+        old_keys = {plate_owner_key(plate) for plate in mapped_plates(old_item) if normalise_plate(plate)}
+        added = {key: plate for key, plate in new_keys.items() if key not in old_keys}
+        removed = [key for key in old_keys if key not in new_keys]
+        if len(added) + len(removed) >= TRANSACT_WRITE_SIZE:
+            raise TooManyPlateChanges(f"A save can add or remove at most {TRANSACT_WRITE_SIZE - 1} plates")
+
+        condition, condition_values = unchanged_since(old_item)
+        mapping_email = old_item.get('Email') or email
+        while True:
+            plates = without_conflicts(reg_plates, conflicts)
+            action, profile = write(plates, old_item)
+            (operation,) = action.values()
+            operation['ConditionExpression'] = condition
+            if condition_values:
+                operation['ExpressionAttributeValues'] = dict(operation.get('ExpressionAttributeValues', {}),
+                                                              **serialize_item(condition_values))
+            actions = mapping_actions(user_id, added, removed, mapping_email) + [(user_id, action)]
+            try:
+                with stage('ProfileWrite'):
+                    client.transact_write_items(TransactItems=[action for _, action in actions])
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'TransactionCanceledException':
+                    raise
+                reasons = e.response.get('CancellationReasons', [])
+                failed = {index for index, reason in enumerate(reasons) if reason.get('Code') == 'ConditionalCheckFailed'}
+                if not failed:
+                    raise
+                # Another save wrote the profile since it was read, so the
+                # diff is made again from a new read.
+                if len(actions) - 1 in failed:
+                    break
+                # A plate owned by someone else is a conflict, and a removed
+                # plate that is no longer the user's needs no delete.
+                for index in failed:
+                    key, action = actions[index]
+                    if 'Put' in action:
+                        conflicts.append(added.pop(key))
+                    else:
+                        removed.remove(key)
+                continue
+
+            logger.info("Saved profile %s: plates added %s, removed %s", user_id, list(added), removed)
+            if conflicts:
+                logger.warning("Plates %s for user %s are registered to another user", conflicts, user_id)
+            return conflicts, profile
+
+    raise RuntimeError(f"Profile {user_id} changed during each of {SAVE_ATTEMPTS} attempts to save it")
+
+def too_many_changes_response(error):
+    return {
+        'statusCode': 400,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Credentials': 'true',
+            'Content-Type': 'application/json'
+        },
+        'body': json.dumps({'error': str(error)})
     }
+
+def profile_update(name, reg_plates):
+    # The update expression, values and names that save name and reg_plates
+    # where they are not None.
+    update_expression = "SET "
+    expression_values = {}
+    expression_names = {}
     
-    if reg_plates and len(reg_plates) > 0:
-        update_expression += ', CarRegistration = :car_reg'
-        expression_values[':car_reg'] = reg_plates[0]
-    
-    table.update_item(
-        Key={'UserID': user_id},
-        UpdateExpression=update_expression,
-        ExpressionAttributeValues=expression_values
-    )
-    print(f"Updated main user record with RegPlates: {reg_plates}")
-    
-    for plate in reg_plates:
-        if plate:  
-            table.put_item(Item={
-                'UserID': user_id,
-                'CarRegistration': plate,
-                'Email': email,
-                'Name': name
-            })
-            print(f"Added plate to CarRegistrationIndex: {plate}")
-    
-    print(f"Updated CarRegistrationIndex for user {user_id} with plates: {reg_plates}")
+    if name is not None:
+        update_expression += "#n = :name, "
+        expression_values[':name'] = name
+        expression_names['#n'] = 'Name'
+        
+    if reg_plates is not None:
+        update_expression += "RegPlates = :plates, PlateOwnerItems = :mapped, "
+        expression_values[':plates'] = reg_plates
+        expression_values[':mapped'] = True
+        if reg_plates:
+            update_expression += "CarRegistration = :car_reg, "
+            expression_values[':car_reg'] = reg_plates[0]
+        
+    update_expression += "UpdatedAt = :updated"
+    expression_values[':updated'] = datetime.now().isoformat()
+    # A profile with no plates left must not stay on CarRegistrationIndex,
+    # which notifications still query for profiles without mapping items.
+    if reg_plates == []:
+        update_expression += " REMOVE CarRegistration"
+    return update_expression, expression_values, expression_names
+
+def conflict_response(conflicts, profile=None):
+    body = {
+        'error': 'Some plates are registered to another user',
+        'conflictingPlates': conflicts
+    }
+    if profile is not None:
+        body['profile'] = profile
+    return {
+        'statusCode': 409,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Credentials': 'true',
+            'Content-Type': 'application/json'
+        },
+        'body': json.dumps(body, default=decimal_default)
+    }
 
 def update_user_profile(event, context):
     try:
-        print("Event:", json.dumps(event))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Event: %s", json.dumps(event))
         body = json.loads(event['body'])
-        print("Request body:", json.dumps(body))
         user_id = event['requestContext']['authorizer']['jwt']['claims']['sub']
-        print("User ID:", user_id)
         
         name = body.get('name')
         reg_plates = body.get('regPlates')
-        print("Name:", name)
-        print("Reg Plates:", reg_plates)
-        
-        if reg_plates is not None:
-            reg_plates = [plate.strip() for plate in reg_plates if plate]
-        
-        update_expression = "SET "
-        expression_values = {}
-        expression_names = {}
-        
-        if name is not None:
-            update_expression += "#n = :name, "
-            expression_values[':name'] = name
-            expression_names['#n'] = 'Name'
-            
-        if reg_plates is not None:
-            update_expression += "RegPlates = :plates, "
-            expression_values[':plates'] = reg_plates
-            
-        update_expression += "UpdatedAt = :updated"
-        expression_values[':updated'] = datetime.now().isoformat()
         
-        if len(expression_values) == 1: 
+        if name is None and reg_plates is None:
             return {
                 'statusCode': 400,
                 'headers': {
@@ -286,28 +465,52 @@ def update_user_profile(event, context):
                 'body': json.dumps({'error': 'No fields to update'})
             }
         
-        print("Update expression:", update_expression)
-        print("Expression values:", json.dumps(expression_values))
-        print("Expression names:", json.dumps(expression_names))
+        table = get_table(USERS_TABLE)
         
-        table = dynamodb.Table(USERS_TABLE)
-        print("Updating item in table:", USERS_TABLE)
-        
-        update_params = {
-            'Key': {'UserID': user_id},
-            'UpdateExpression': update_expression,
-            'ExpressionAttributeValues': expression_values,
-            'ReturnValues': "ALL_NEW"
-        }
-        
-        if expression_names:
-            update_params['ExpressionAttributeNames'] = expression_names
+        conflicts = []
+        if reg_plates is None:
+            update_expression, expression_values, expression_names = profile_update(name, None)
+            update_params = {
+                'Key': {'UserID': user_id},
+                'UpdateExpression': update_expression,
+                'ExpressionAttributeValues': expression_values,
+                'ExpressionAttributeNames': expression_names,
+                'ReturnValues': "ALL_NEW"
+            }
+            with stage('ProfileWrite'):
+                response = table.update_item(**update_params)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("DynamoDB Response: %s", json.dumps(response, default=decimal_default))
+            profile = response['Attributes']
+        else:
+            reg_plates = [plate.strip() for plate in reg_plates if plate]
+            email = event['requestContext']['authorizer']['jwt']['claims'].get('email', '')
+            
+            def write(plates, old_item):
+                update_expression, expression_values, expression_names = profile_update(name, plates)
+                update = {
+                    'TableName': USERS_TABLE,
+                    'Key': serialize_item({'UserID': user_id}),
+                    'UpdateExpression': update_expression,
+                    'ExpressionAttributeValues': serialize_item(expression_values)
+                }
+                if expression_names:
+                    update['ExpressionAttributeNames'] = expression_names
+                
+                profile = dict(old_item, UserID=user_id, UpdatedAt=expression_values[':updated'], RegPlates=plates,
+                               PlateOwnerItems=True)
+                if name is not None:
+                    profile['Name'] = name
+                if plates:
+                    profile['CarRegistration'] = plates[0]
+                else:
+                    profile.pop('CarRegistration', None)
+                return {'Update': update}, profile
             
-        response = table.update_item(**update_params)
-        print("DynamoDB Response:", json.dumps(response))
+            conflicts, profile = save_profile(table, user_id, reg_plates, email, write)
         
-        if reg_plates is not None:
-            update_car_registration_index(user_id, reg_plates)
+        if conflicts:
+            return conflict_response(conflicts, profile)
         
         return {
             'statusCode': 200,
@@ -318,13 +521,14 @@ def update_user_profile(event, context):
             },
             'body': json.dumps({
                 'message': 'Profile updated successfully',
-                'profile': response.get('Attributes', {})
+                'profile': profile
             }, default=decimal_default)
         }
+    except TooManyPlateChanges as e:
+        return too_many_changes_response(e)
     except Exception as e:
         import traceback
-        print("Error:", str(e))
-        print("Traceback:", traceback.format_exc())
+        logger.exception("Error updating user profile")
         return {
             'statusCode': 500,
             'headers': {
@@ -343,6 +547,7 @@ def decimal_default(obj):
         return float(obj)
     raise TypeError
 
+@instrumented('userprofile')
 def main(event, context):
     if 'triggerSource' in event:
         return handle_cognito_trigger(event, context)
@@ -1,23 +1,6 @@
-data "archive_file" "notifications_zip" {
+data "archive_file" "lambda_zip" {
   type        = "zip"
-  source_file = "${path.module}/../lambda/notifications.py"
-  output_path = "${path.module}/notifications.zip"
+  source_dir  = "${path.module}/../lambda"
+  output_path = "${path.module}/lambda.zip"
+  excludes    = ["__pycache__"]
 }
-
-data "archive_file" "s3getpassrek_zip" {
-  type        = "zip"
-  source_file = "${path.module}/../lambda/s3getpassrek.py"
-  output_path = "${path.module}/s3getpassrek.zip"
-}
-
-data "archive_file" "regplateapi_zip" {
-  type        = "zip"
-  source_file = "${path.module}/../lambda/regplateapi.py"
-  output_path = "${path.module}/regplateapi.zip"
-}
-
-data "archive_file" "user_profile_zip" {
-  type        = "zip"
-  source_file = "${path.module}/../lambda/userprofile.py"
-  output_path = "${path.module}/userprofile.zip"
-}
\ No newline at end of file
@@ -52,6 +52,64 @@ resource "aws_iam_role_policy_attachment" "lambda_sns" {
   policy_arn = "arn:aws:iam::aws:policy/AmazonSNSFullAccess"
 }
 
+resource "aws_iam_role_policy_attachment" "lambda_sqs" {
+  role       = aws_iam_role.lambda_role.name
+  policy_arn = "arn:aws:iam::aws:policy/service-role/AWSLambdaSQSQueueExecutionRole"
+}
+
+# Stream event source mappings send records that keep failing here.
+resource "aws_iam_role_policy" "lambda_stream_failures" {
+  name = "car_park_stream_failures"
+  role = aws_iam_role.lambda_role.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect   = "Allow"
+        Action   = "sqs:SendMessage"
+        Resource = aws_sqs_queue.stream_failures.arn
+      }
+    ]
+  })
+}
+
+# Image processing sends deferred messages back to their queue.
+resource "aws_iam_role_policy" "lambda_requeue" {
+  name = "car_park_image_requeue"
+  role = aws_iam_role.lambda_role.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect   = "Allow"
+        Action   = ["sqs:GetQueueUrl", "sqs:SendMessage"]
+        Resource = [aws_sqs_queue.image_events.arn, aws_sqs_queue.exit_image_events.arn]
+      }
+    ]
+  })
+}
+
+# The Rekognition quota is split between the gate API and the image queues'
+# consumers, so that a driver at a barrier and the exits have capacity of
+# their own however many entries are queued.
+locals {
+  gate_rekognition_tps  = var.rekognition_tps * var.gate_rekognition_share
+  queue_rekognition_tps = var.rekognition_tps - local.gate_rekognition_tps
+  exit_queue_enabled    = var.image_events_via_queue && length(var.exit_gates) > 0
+  exit_rekognition_tps  = local.exit_queue_enabled ? local.queue_rekognition_tps * var.exit_rekognition_share : 0
+  entry_rekognition_tps = local.queue_rekognition_tps - local.exit_rekognition_tps
+
+  # Exit gates given as site/gate match one folder; a bare gate ID matches
+  # that gate at every site.
+  exit_key_patterns = [
+    for gate in var.exit_gates : jsondecode(length(split("/", gate)) == 2
+      ? jsonencode({ prefix = "uploads/${gate}/" })
+      : jsonencode({ wildcard = "uploads/*/${gate}/*" }))
+  ]
+}
+
 # -----------------#
 # S3 BUCKETS       #
 # -----------------#
@@ -239,32 +297,190 @@ resource "aws_dynamodb_table" "parking_sessions" {
     type = "N"
   }
   
+  attribute {
+    name = "PlateKey"
+    type = "S"
+  }
+  
+  attribute {
+    name = "EntryBucket"
+    type = "S"
+  }
+  
+  attribute {
+    name = "EntryDay"
+    type = "S"
+  }
+  
   global_secondary_index {
     name               = "CarRegistrationIndex"
     hash_key           = "CarRegistration"
     projection_type    = "ALL"
   }
   
+  global_secondary_index {
+    name               = "PlateEntryTimeIndex"
+    hash_key           = "PlateKey"
+    range_key          = "EntryTime"
+    projection_type    = "ALL"
+  }
+  
   global_secondary_index {
     name               = "EntryTimeIndex"
     hash_key           = "EntryTime"
     projection_type    = "ALL"
   }
   
+  global_secondary_index {
+    name               = "EntryBucketIndex"
+    hash_key           = "EntryBucket"
+    range_key          = "EntryTime"
+    projection_type    = "ALL"
+  }
+  
+  global_secondary_index {
+    name               = "EntryDayIndex"
+    hash_key           = "EntryDay"
+    range_key          = "EntryTime"
+    projection_type    = "ALL"
+  }
+  
   stream_enabled = true
   stream_view_type = "NEW_AND_OLD_IMAGES"
 }
 
+resource "aws_dynamodb_table" "open_sessions" {
+  name         = "OpenSessions"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "PlateKey"
+  
+  attribute {
+    name = "PlateKey"
+    type = "S"
+  }
+  
+  attribute {
+    name = "PlateSkeleton"
+    type = "S"
+  }
+  
+  global_secondary_index {
+    name               = "PlateSkeletonIndex"
+    hash_key           = "PlateSkeleton"
+    projection_type    = "ALL"
+  }
+  
+  ttl {
+    attribute_name = "ExpiresAt"
+    enabled        = true
+  }
+}
+
+# One item per ended session that has been notified, or queued for a digest,
+# so a redelivered stream batch does not email the driver twice.
+resource "aws_dynamodb_table" "notification_log" {
+  name         = "NotificationLog"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "SessionID"
+  
+  attribute {
+    name = "SessionID"
+    type = "S"
+  }
+  
+  attribute {
+    name = "DigestWindow"
+    type = "N"
+  }
+  
+  attribute {
+    name = "UserID"
+    type = "S"
+  }
+  
+  global_secondary_index {
+    name               = "DigestWindowIndex"
+    hash_key           = "DigestWindow"
+    range_key          = "UserID"
+    projection_type    = "ALL"
+  }
+  
+  ttl {
+    attribute_name = "ExpiresAt"
+    enabled        = true
+  }
+}
+
+resource "aws_dynamodb_table" "car_park_stats" {
+  name         = "CarParkStats"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "Counter"
+  range_key    = "Shard"
+  
+  attribute {
+    name = "Counter"
+    type = "S"
+  }
+  
+  attribute {
+    name = "Shard"
+    type = "N"
+  }
+
+  # Expires the markers of stream records already applied to the counters.
+  ttl {
+    attribute_name = "ExpiresAt"
+    enabled        = true
+  }
+}
+
 # -----------------------#
 # DYNAMODB STREAM EVENTS #
 # -----------------------#
 
+# Records that still fail after their retries are described on this queue,
+# so a poison record holds up its shard for minutes rather than a day.
+resource "aws_sqs_queue" "stream_failures" {
+  name                      = "car-park-stream-failures"
+  message_retention_seconds = 1209600
+}
+
 resource "aws_lambda_event_source_mapping" "dynamodb_stream_mapping" {
   event_source_arn  = aws_dynamodb_table.parking_sessions.stream_arn
   function_name     = aws_lambda_function.notifications.function_name
   starting_position = "LATEST"
-  batch_size        = 1
+  batch_size        = 100
   enabled           = true
+
+  maximum_batching_window_in_seconds = 5
+  function_response_types            = ["ReportBatchItemFailures"]
+  maximum_retry_attempts             = 5
+  bisect_batch_on_function_error     = true
+
+  destination_config {
+    on_failure {
+      destination_arn = aws_sqs_queue.stream_failures.arn
+    }
+  }
+}
+
+resource "aws_lambda_event_source_mapping" "aggregates_stream_mapping" {
+  event_source_arn  = aws_dynamodb_table.parking_sessions.stream_arn
+  function_name     = aws_lambda_function.aggregates.function_name
+  starting_position = "LATEST"
+  batch_size        = 500
+  enabled           = true
+
+  maximum_batching_window_in_seconds = 10
+  function_response_types            = ["ReportBatchItemFailures"]
+  maximum_retry_attempts             = 5
+  bisect_batch_on_function_error     = true
+
+  destination_config {
+    on_failure {
+      destination_arn = aws_sqs_queue.stream_failures.arn
+    }
+  }
 }
 
 resource "aws_lambda_permission" "allow_dynamodb" {
@@ -283,6 +499,8 @@ resource "aws_sns_topic" "payment_notifications" {
   name = "car-park-payment-notifications"
 }
 
+# Drivers' subscriptions carry a filter policy on their UserID. This one has
+# none, so the operator receives every message.
 resource "aws_sns_topic_subscription" "email_subscription" {
   topic_arn = aws_sns_topic.payment_notifications.arn
   protocol  = "email"
@@ -297,8 +515,8 @@ resource "aws_sns_topic_subscription" "email_subscription" {
 
 resource "aws_lambda_function" "notifications" {
   function_name    = "car-park-notifications"
-  filename         = data.archive_file.notifications_zip.output_path
-  source_code_hash = data.archive_file.notifications_zip.output_base64sha256
+  filename         = data.archive_file.lambda_zip.output_path
+  source_code_hash = data.archive_file.lambda_zip.output_base64sha256
   role             = aws_iam_role.lambda_role.arn
   handler          = "notifications.main"
   runtime          = "python3.10"
@@ -307,34 +525,137 @@ resource "aws_lambda_function" "notifications" {
 
   environment {
     variables = {
-      SNS_TOPIC_ARN = aws_sns_topic.payment_notifications.arn
+      SNS_TOPIC_ARN       = aws_sns_topic.payment_notifications.arn
+      NOTIFICATIONS_TABLE = aws_dynamodb_table.notification_log.name
+      NOTIFICATION_MODE   = var.notification_mode
+      DIGEST_WINDOW       = var.notification_digest_minutes * 60
+    }
+  }
+}
+
+# Sends each driver one summary of the sessions queued in the last window.
+resource "aws_lambda_function" "notification_digests" {
+  count            = var.notification_mode == "digest" ? 1 : 0
+  function_name    = "car-park-notification-digests"
+  filename         = data.archive_file.lambda_zip.output_path
+  source_code_hash = data.archive_file.lambda_zip.output_base64sha256
+  role             = aws_iam_role.lambda_role.arn
+  handler          = "notifications.send_digests"
+  runtime          = "python3.10"
+  timeout          = 60
+  memory_size      = 128
+
+  environment {
+    variables = {
+      SNS_TOPIC_ARN       = aws_sns_topic.payment_notifications.arn
+      NOTIFICATIONS_TABLE = aws_dynamodb_table.notification_log.name
+      NOTIFICATION_MODE   = var.notification_mode
+      DIGEST_WINDOW       = var.notification_digest_minutes * 60
+    }
+  }
+}
+
+resource "aws_cloudwatch_event_rule" "notification_digests" {
+  count               = var.notification_mode == "digest" ? 1 : 0
+  name                = "car-park-notification-digests"
+  schedule_expression = "rate(${var.notification_digest_minutes} minutes)"
+}
+
+resource "aws_cloudwatch_event_target" "notification_digests" {
+  count = var.notification_mode == "digest" ? 1 : 0
+  rule  = aws_cloudwatch_event_rule.notification_digests[0].name
+  arn   = aws_lambda_function.notification_digests[0].arn
+}
+
+resource "aws_lambda_permission" "allow_digest_schedule" {
+  count         = var.notification_mode == "digest" ? 1 : 0
+  statement_id  = "AllowExecutionFromEventBridge"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.notification_digests[0].function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.notification_digests[0].arn
+}
+
+resource "aws_lambda_function" "aggregates" {
+  function_name    = "car-park-aggregates"
+  filename         = data.archive_file.lambda_zip.output_path
+  source_code_hash = data.archive_file.lambda_zip.output_base64sha256
+  role             = aws_iam_role.lambda_role.arn
+  handler          = "aggregates.main"
+  runtime          = "python3.10"
+  timeout          = 15
+  memory_size      = 128
+
+  environment {
+    variables = {
+      STATS_TABLE = aws_dynamodb_table.car_park_stats.name
     }
   }
 }
 
 resource "aws_lambda_function" "s3getpassrek" {
   function_name    = "car-park-image-processing"
-  filename         = data.archive_file.s3getpassrek_zip.output_path
-  source_code_hash = data.archive_file.s3getpassrek_zip.output_base64sha256
+  filename         = data.archive_file.lambda_zip.output_path
+  source_code_hash = data.archive_file.lambda_zip.output_base64sha256
   role             = aws_iam_role.lambda_role.arn
   handler          = "s3getpassrek.main"
   runtime          = "python3.10"
   timeout          = 15
   memory_size      = 128
+  layers           = var.image_processing_layers
 
   environment {
     variables = {
-      IMAGES_BUCKET  = aws_s3_bucket.car_images_bucket.bucket
-      USERS_TABLE    = aws_dynamodb_table.car_park_users.name
-      SESSIONS_TABLE = aws_dynamodb_table.parking_sessions.name
+      IMAGES_BUCKET        = aws_s3_bucket.car_images_bucket.bucket
+      USERS_TABLE          = aws_dynamodb_table.car_park_users.name
+      SESSIONS_TABLE       = aws_dynamodb_table.parking_sessions.name
+      OPEN_SESSIONS_TABLE  = aws_dynamodb_table.open_sessions.name
+      ENTRY_BUCKET_SHARDS  = var.entry_bucket_shards
+      REKOGNITION_TPS      = local.entry_rekognition_tps
+      READ_OBJECT_METADATA = var.read_object_metadata
+      QUEUE_CONCURRENCY    = var.image_queue_concurrency
+      EXIT_GATES           = join(",", var.exit_gates)
+      # Exit uploads reach the main queue too, and are left to the exit queue.
+      EXITS_QUEUED_SEPARATELY = local.exit_queue_enabled
+    }
+  }
+}
+
+# Drains the exit queue with reserved concurrency and its own share of the
+# Rekognition quota, so cars at an exit barrier never wait behind entries.
+resource "aws_lambda_function" "exit_processing" {
+  count            = local.exit_queue_enabled ? 1 : 0
+  function_name    = "car-park-exit-image-processing"
+  filename         = data.archive_file.lambda_zip.output_path
+  source_code_hash = data.archive_file.lambda_zip.output_base64sha256
+  role             = aws_iam_role.lambda_role.arn
+  handler          = "s3getpassrek.main"
+  runtime          = "python3.10"
+  timeout          = 15
+  memory_size      = 128
+  layers           = var.image_processing_layers
+
+  reserved_concurrent_executions = var.exit_queue_concurrency
+
+  environment {
+    variables = {
+      IMAGES_BUCKET        = aws_s3_bucket.car_images_bucket.bucket
+      USERS_TABLE          = aws_dynamodb_table.car_park_users.name
+      SESSIONS_TABLE       = aws_dynamodb_table.parking_sessions.name
+      OPEN_SESSIONS_TABLE  = aws_dynamodb_table.open_sessions.name
+      ENTRY_BUCKET_SHARDS  = var.entry_bucket_shards
+      REKOGNITION_TPS      = local.exit_rekognition_tps
+      READ_OBJECT_METADATA = var.read_object_metadata
+      QUEUE_CONCURRENCY    = var.exit_queue_concurrency
+      EXIT_GATES           = join(",", var.exit_gates)
     }
   }
 }
 
 resource "aws_lambda_function" "regplateapi" {
   function_name    = "car-park-reg-plate-api"
-  filename         = data.archive_file.regplateapi_zip.output_path
-  source_code_hash = data.archive_file.regplateapi_zip.output_base64sha256
+  filename         = data.archive_file.lambda_zip.output_path
+  source_code_hash = data.archive_file.lambda_zip.output_base64sha256
   role             = aws_iam_role.lambda_role.arn
   handler          = "regplateapi.main"
   runtime          = "python3.10"
@@ -349,10 +670,40 @@ resource "aws_lambda_function" "regplateapi" {
   }
 }
 
+# Answers barrier controllers synchronously. More memory buys the CPU that
+# decoding an image at the gate needs. Its concurrency is reserved so that
+# each container's share of the gate's Rekognition quota holds.
+resource "aws_lambda_function" "gateapi" {
+  function_name    = "car-park-gate-api"
+  filename         = data.archive_file.lambda_zip.output_path
+  source_code_hash = data.archive_file.lambda_zip.output_base64sha256
+  role             = aws_iam_role.lambda_role.arn
+  handler          = "gateapi.main"
+  runtime          = "python3.10"
+  timeout          = 5
+  memory_size      = 512
+  layers           = var.image_processing_layers
+
+  reserved_concurrent_executions = var.gate_api_concurrency
+
+  environment {
+    variables = {
+      OPEN_SESSIONS_TABLE = aws_dynamodb_table.open_sessions.name
+      EXIT_GATES          = join(",", var.exit_gates)
+      # The gate's calls are paced to its own share of the quota, which the
+      # image queues do not use, so a driver at the barrier never waits
+      # behind queued uploads.
+      REKOGNITION_TPS     = local.gate_rekognition_tps
+      QUEUE_CONCURRENCY   = var.gate_api_concurrency
+      DEADLINE_MARGIN     = 1
+    }
+  }
+}
+
 resource "aws_lambda_function" "userprofile" {
   function_name    = "car-park-user-profile"
-  filename         = data.archive_file.user_profile_zip.output_path
-  source_code_hash = data.archive_file.user_profile_zip.output_base64sha256
+  filename         = data.archive_file.lambda_zip.output_path
+  source_code_hash = data.archive_file.lambda_zip.output_base64sha256
   role             = aws_iam_role.lambda_role.arn
   handler          = "userprofile.main"
   runtime          = "python3.10"
@@ -371,22 +722,159 @@ resource "aws_lambda_function" "userprofile" {
 # S3 EVENT TRIGGERS #
 # ------------------#
 
+# Uploads go through a queue by default, so bursts wait there instead of
+# failing on Rekognition throttling. The consumer's concurrency is capped and
+# each container paces its Rekognition calls to its share of the TPS quota.
+# Exit gates' uploads are also sent to EventBridge, whose rule puts them on a
+# queue of their own: S3 notifications cannot route a gate folder apart from
+# the uploads/ prefix that holds it.
 resource "aws_s3_bucket_notification" "car_images_notification" {
-  bucket = aws_s3_bucket.car_images_bucket.id
-  
-  lambda_function {
-    lambda_function_arn = aws_lambda_function.s3getpassrek.arn
-    events              = ["s3:ObjectCreated:*"]
-    filter_prefix       = "uploads/"
+  bucket      = aws_s3_bucket.car_images_bucket.id
+  eventbridge = local.exit_queue_enabled
+
+  dynamic "queue" {
+    for_each = var.image_events_via_queue ? [1] : []
+    content {
+      queue_arn     = aws_sqs_queue.image_events.arn
+      events        = ["s3:ObjectCreated:*"]
+      filter_prefix = "uploads/"
+    }
   }
-  
+
+  dynamic "lambda_function" {
+    for_each = var.image_events_via_queue ? [] : [1]
+    content {
+      lambda_function_arn = aws_lambda_function.s3getpassrek.arn
+      events              = ["s3:ObjectCreated:*"]
+      filter_prefix       = "uploads/"
+    }
+  }
+
   depends_on = [
     aws_lambda_permission.allow_s3,
     aws_lambda_function.s3getpassrek,
+    aws_sqs_queue_policy.image_events_from_s3,
     aws_s3_object.uploads_folder
   ]
 }
 
+resource "aws_sqs_queue" "image_events_dlq" {
+  name                      = "car-park-image-events-dlq"
+  message_retention_seconds = 1209600
+}
+
+# Messages deferred for want of Rekognition capacity are sent back as new
+# messages, so only failed processing counts towards maxReceiveCount.
+resource "aws_sqs_queue" "image_events" {
+  name                       = "car-park-image-events"
+  visibility_timeout_seconds = 90  # six times the function timeout
+  message_retention_seconds  = 86400
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.image_events_dlq.arn
+    maxReceiveCount     = 5
+  })
+}
+
+resource "aws_sqs_queue" "exit_image_events" {
+  name                       = "car-park-exit-image-events"
+  visibility_timeout_seconds = 90
+  message_retention_seconds  = 86400
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.image_events_dlq.arn
+    maxReceiveCount     = 5
+  })
+}
+
+resource "aws_cloudwatch_event_rule" "exit_images" {
+  count = local.exit_queue_enabled ? 1 : 0
+  name  = "car-park-exit-images"
+
+  event_pattern = jsonencode({
+    source        = ["aws.s3"]
+    "detail-type" = ["Object Created"]
+    detail = {
+      bucket = { name = [aws_s3_bucket.car_images_bucket.bucket] }
+      object = { key = local.exit_key_patterns }
+    }
+  })
+}
+
+resource "aws_cloudwatch_event_target" "exit_images" {
+  count = local.exit_queue_enabled ? 1 : 0
+  rule  = aws_cloudwatch_event_rule.exit_images[0].name
+  arn   = aws_sqs_queue.exit_image_events.arn
+}
+
+resource "aws_sqs_queue_policy" "exit_image_events_from_eventbridge" {
+  count     = local.exit_queue_enabled ? 1 : 0
+  queue_url = aws_sqs_queue.exit_image_events.id
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect    = "Allow"
+        Principal = { Service = "events.amazonaws.com" }
+        Action    = "sqs:SendMessage"
+        Resource  = aws_sqs_queue.exit_image_events.arn
+        Condition = {
+          ArnEquals = { "aws:SourceArn" = aws_cloudwatch_event_rule.exit_images[0].arn }
+        }
+      }
+    ]
+  })
+}
+
+resource "aws_sqs_queue_policy" "image_events_from_s3" {
+  queue_url = aws_sqs_queue.image_events.id
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect    = "Allow"
+        Principal = { Service = "s3.amazonaws.com" }
+        Action    = "sqs:SendMessage"
+        Resource  = aws_sqs_queue.image_events.arn
+        Condition = {
+          ArnEquals = { "aws:SourceArn" = aws_s3_bucket.car_images_bucket.arn }
+        }
+      }
+    ]
+  })
+}
+
+resource "aws_lambda_event_source_mapping" "image_events_mapping" {
+  count            = var.image_events_via_queue ? 1 : 0
+  event_source_arn = aws_sqs_queue.image_events.arn
+  function_name    = aws_lambda_function.s3getpassrek.function_name
+  batch_size       = 10
+  enabled          = true
+
+  maximum_batching_window_in_seconds = 1
+  function_response_types            = ["ReportBatchItemFailures"]
+
+  scaling_config {
+    maximum_concurrency = var.image_queue_concurrency
+  }
+}
+
+resource "aws_lambda_event_source_mapping" "exit_image_events_mapping" {
+  count            = local.exit_queue_enabled ? 1 : 0
+  event_source_arn = aws_sqs_queue.exit_image_events.arn
+  function_name    = aws_lambda_function.exit_processing[0].function_name
+  batch_size       = 10
+  enabled          = true
+
+  # Exits are processed as soon as they arrive rather than batched up.
+  maximum_batching_window_in_seconds = 0
+  function_response_types            = ["ReportBatchItemFailures"]
+
+  scaling_config {
+    maximum_concurrency = var.exit_queue_concurrency
+  }
+}
+
 resource "aws_lambda_permission" "allow_s3" {
   statement_id  = "AllowExecutionFromS3"
   action        = "lambda:InvokeFunction"
@@ -447,6 +935,46 @@ resource "aws_lambda_permission" "api_gateway_regplateapi" {
   source_arn    = "${aws_apigatewayv2_api.car_park_api.execution_arn}/*/*"
 }
 
+resource "aws_apigatewayv2_integration" "gateapi_integration" {
+  api_id             = aws_apigatewayv2_api.car_park_api.id
+  integration_type   = "AWS_PROXY"
+  integration_uri    = aws_lambda_function.gateapi.invoke_arn
+  integration_method = "POST"
+}
+
+# Barrier controllers are machines, not Cognito users, so they sign their
+# requests with IAM credentials granted the gate_controllers policy.
+resource "aws_apigatewayv2_route" "gateapi_route" {
+  api_id             = aws_apigatewayv2_api.car_park_api.id
+  route_key          = "POST /gate"
+  target             = "integrations/${aws_apigatewayv2_integration.gateapi_integration.id}"
+  authorization_type = "AWS_IAM"
+}
+
+resource "aws_iam_policy" "gate_controllers" {
+  name        = "car-park-gate-controllers"
+  description = "Lets barrier controllers call POST /gate"
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect   = "Allow"
+        Action   = "execute-api:Invoke"
+        Resource = "${aws_apigatewayv2_api.car_park_api.execution_arn}/*/POST/gate"
+      }
+    ]
+  })
+}
+
+resource "aws_lambda_permission" "api_gateway_gateapi" {
+  statement_id  = "AllowExecutionFromAPIGateway"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.gateapi.function_name
+  principal     = "apigateway.amazonaws.com"
+  source_arn    = "${aws_apigatewayv2_api.car_park_api.execution_arn}/*/*"
+}
+
 resource "aws_apigatewayv2_integration" "notifications_integration" {
   api_id             = aws_apigatewayv2_api.car_park_api.id
   integration_type   = "AWS_PROXY"
@@ -10,3 +10,12 @@ output "api_gateway_url" {
   value = "${aws_apigatewayv2_stage.car_park_api_stage.invoke_url}"
 }
 
+output "gate_controllers_policy_arn" {
+  value = aws_iam_policy.gate_controllers.arn
+}
+
+# Reports run outside Lambda must read EntryBucketIndex and EntryDayIndex with
+# ENTRY_BUCKET_SHARDS set to this.
+output "entry_bucket_shards" {
+  value = var.entry_bucket_shards
+}
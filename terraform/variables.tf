@@ -27,3 +27,81 @@ variable "notification_email" {
   description = "Email address to receive parking payment notifications"
   type        = string
 }
+
+variable "image_processing_layers" {
+  description = "Lambda layer ARNs for the image processing function, e.g. one providing Pillow for plate-region preprocessing"
+  type        = list(string)
+  default     = []
+}
+
+variable "image_events_via_queue" {
+  description = "Deliver image uploads to the processing function through an SQS queue instead of invoking it directly"
+  type        = bool
+  default     = true
+}
+
+variable "image_queue_concurrency" {
+  description = "Maximum concurrent invocations draining the image queue (at least 2)"
+  type        = number
+  default     = 2
+}
+
+variable "rekognition_tps" {
+  description = "Rekognition DetectText requests per second allowed by the account quota"
+  type        = number
+  default     = 5
+}
+
+variable "exit_gates" {
+  description = "Gate IDs, or site/gate pairs, of exit cameras; with the image queue on, their images get a queue of their own"
+  type        = list(string)
+  default     = []
+}
+
+variable "read_object_metadata" {
+  description = "Read site-id, gate-id and capture-time metadata from each upload, at one S3 HeadObject per image"
+  type        = bool
+  default     = false
+}
+
+variable "entry_bucket_shards" {
+  description = "Write shards of each EntryBucketIndex and EntryDayIndex bucket; every function writing or reading the indexes gets the same count"
+  type        = number
+  default     = 1
+}
+
+variable "exit_queue_concurrency" {
+  description = "Concurrency reserved for the function draining the exit image queue (at least 2)"
+  type        = number
+  default     = 2
+}
+
+variable "exit_rekognition_share" {
+  description = "Share of rekognition_tps given to the exit image queue when exit_gates are set"
+  type        = number
+  default     = 0.6
+}
+
+variable "gate_api_concurrency" {
+  description = "Concurrency reserved for the gate API"
+  type        = number
+  default     = 2
+}
+
+variable "gate_rekognition_share" {
+  description = "Share of rekognition_tps reserved for images sent to the gate API; the image queues get the rest"
+  type        = number
+  default     = 0.2
+}
+
+variable "notification_mode" {
+  description = "immediate to email each ended session, or digest to send each driver one summary per window"
+  type        = string
+  default     = "immediate"
+}
+
+variable "notification_digest_minutes" {
+  description = "Length of a digest window, and how often digests are sent, in minutes"
+  type        = number
+  default     = 60
+}
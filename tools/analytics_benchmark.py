@@ -0,0 +1,290 @@
+"""Benchmark the session analytics over synthetic sessions.
+
+--sessions sessions at --sites sites over --days days are written in chunks
+to memory mapped columns, the format analytics.from_export converts session
+exports to. Arrivals follow a commuter profile, stays are log-normal around two
+hours, and a few of the --plates plates make most of the visits. Sessions
+that would end after the last day are left open. Fees come from the default
+tariff.
+
+Every analysis is then run over the mapped columns and timed: the occupancy
+sweep, peak occupancy, the occupancy curve, mean occupancy by hour, dwell
+histogram and percentiles, arrivals by hour, fee totals by day, per-plate
+aggregates and one site's sessions. The columns were just written, so they
+are mostly read from the page cache.
+
+The first --check-sessions sessions are also analysed with the loops over
+ParkingSessions items the analytics replace. Every result is compared, and
+the loops' time per session gives the speedup. They are compared again with
+open sessions counted only up to six hours before the end, so that some of
+them entered after that time, and no occupancy may then be negative.
+
+The report gives the time of each analysis and sessions per second. It
+exits with status 1 when a result differs from the loops or the analyses
+take longer than --max-seconds in total.
+
+    python tools/analytics_benchmark.py
+    python tools/analytics_benchmark.py --sessions 30000000 --plates 2000000 --max-seconds 30
+    python tools/analytics_benchmark.py --directory /data/synthetic --json analytics.json
+
+Requires numpy.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from tariff import get_tariff
+
+START_TIME = 1767225600  # Thursday 1 January 2026, 00:00 UTC
+CHUNK_ROWS = 1000000
+# Share of arrivals in each UTC hour.
+ARRIVALS = [1, 1, 1, 1, 1, 2, 4, 9, 12, 9, 6, 5, 5, 5, 5, 5, 6, 7, 5, 3, 2, 2, 1, 1]
+CURVE_STEP = 300
+MEAN_STEP = 3600
+# How long before the end the second comparison counts open sessions until.
+EARLY_AS_OF = 6 * 3600
+
+def generate(np, analytics, directory, args):
+    rng = np.random.default_rng(args.seed)
+    tariff = get_tariff()
+    end_time = START_TIME + args.days * 86400
+    arrivals = np.asarray(ARRIVALS, dtype=np.float64) / sum(ARRIVALS)
+    columns = analytics.create_columns(directory, args.sessions)
+    for start in range(0, args.sessions, CHUNK_ROWS):
+        end = min(start + CHUNK_ROWS, args.sessions)
+        size = end - start
+        entry_time = (START_TIME + rng.integers(0, args.days, size) * 86400
+                      + rng.choice(24, size, p=arrivals) * 3600 + rng.integers(0, 3600, size))
+        dwell = 60 + rng.lognormal(np.log(7200), 0.9, size).astype(np.int64)
+        exit_time = entry_time + dwell
+        open_sessions = exit_time > end_time
+
+        columns['EntryTime'][start:end] = entry_time
+        columns['ExitTime'][start:end] = np.where(open_sessions, analytics.OPEN, exit_time)
+        columns['DurationHours'][start:end] = np.where(open_sessions, 0, -(-dwell // 3600))
+        columns['PaymentDue'][start:end] = np.where(open_sessions, 0.0, tariff.price_many(entry_time, exit_time))
+        # Cubing a uniform draw makes the low plate indexes the regulars.
+        columns['PlateIndex'][start:end] = (rng.random(size) ** 3 * args.plates).astype(np.int32)
+        columns['SiteIndex'][start:end] = rng.integers(0, args.sites, size)
+
+    for column in columns.values():
+        column.flush()
+    analytics.write_labels(directory, [f"P{i:07d}" for i in range(args.plates)], [f"site-{i}" for i in range(args.sites)])
+
+def analyse(analytics, sessions, start_time, end_time, as_of=None):
+    # Returns {analysis: (seconds, result)} in the order they ran. Open
+    # sessions are parked until as_of, end_time by default.
+    timings = {}
+
+    def timed(name, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        timings[name] = (time.perf_counter() - started, result)
+        return result
+
+    sweep = timed('occupancy sweep', analytics.OccupancySweep, sessions, end_time if as_of is None else as_of)
+    timed('peak occupancy', sweep.peak)
+    timed(f"occupancy every {CURVE_STEP // 60} min", sweep.curve, start_time, end_time, CURVE_STEP)
+    timed('mean occupancy by hour', sweep.mean_occupancy, start_time, end_time, MEAN_STEP)
+    timed('dwell histogram', analytics.dwell_histogram, sessions)
+    timed('dwell percentiles', analytics.dwell_percentiles, sessions)
+    timed('arrivals by hour', analytics.arrivals_by_hour, sessions)
+    timed('fee totals by day', analytics.fee_totals, sessions)
+    aggregates = timed('plate aggregates', analytics.plate_aggregates, sessions)
+    timed('top plates', analytics.top_plates, aggregates)
+    timed('one site', sessions.for_site, sessions.sites[0])
+    return timings
+
+def to_items(sessions):
+    # The sessions as ParkingSessions items, as the loops read them.
+    closed = sessions.closed()
+    items = []
+    for i in range(len(sessions)):
+        item = {
+            'CarRegistration': str(sessions.plates[sessions.plate_index[i]]),
+            'EntryTime': int(sessions.entry_time[i])
+        }
+        if closed[i]:
+            item['ExitTime'] = int(sessions.exit_time[i])
+            item['DurationHours'] = int(sessions.duration_hours[i])
+            item['PaymentDue'] = float(sessions.payment_due[i])
+        items.append(item)
+    return items
+
+def loop_analyse(items, start_time, end_time, as_of=None):
+    # The loops the analytics replace, one item at a time.
+    as_of = end_time if as_of is None else as_of
+    events = []
+    for item in items:
+        events.append((item['EntryTime'], 1))
+        events.append((max(item.get('ExitTime', as_of), item['EntryTime']), -1))
+    # An exit at the same second as an entry is applied first.
+    events.sort()
+    curve_times = list(range(start_time, end_time, CURVE_STEP))
+    curve = []
+    parked = peak = 0
+    next_time = 0
+    for event_time, change in events:
+        while next_time < len(curve_times) and curve_times[next_time] < event_time:
+            curve.append(parked)
+            next_time += 1
+        parked += change
+        peak = max(peak, parked)
+    curve.extend([parked] * (len(curve_times) - next_time))
+
+    hours = (end_time - start_time + MEAN_STEP - 1) // MEAN_STEP
+    mean = [0.0] * hours
+    histogram = [0] * 97
+    fees = {}
+    plates = {}
+    for item in items:
+        exit_time = max(item.get('ExitTime', as_of), item['EntryTime'])
+        hour = (item['EntryTime'] - start_time) // MEAN_STEP
+        while hour < hours and start_time + hour * MEAN_STEP < exit_time:
+            hour_start = start_time + hour * MEAN_STEP
+            hour_end = min(hour_start + MEAN_STEP, end_time)
+            overlap = min(exit_time, hour_end) - max(item['EntryTime'], hour_start)
+            mean[hour] += max(overlap, 0) / (hour_end - hour_start)
+            hour += 1
+
+        plate = plates.setdefault(item['CarRegistration'], {'visits': 0, 'fees': 0.0, 'last_entry': 0})
+        plate['visits'] += 1
+        plate['last_entry'] = max(plate['last_entry'], item['EntryTime'])
+        if 'ExitTime' not in item:
+            continue
+        histogram[min((item['ExitTime'] - item['EntryTime']) // 900, 96)] += 1
+        day = item['ExitTime'] // 86400 * 86400
+        fees[day] = fees.get(day, 0.0) + item['PaymentDue']
+        plate['fees'] += item['PaymentDue']
+    return {'peak': peak, 'curve': curve, 'mean': mean, 'histogram': histogram, 'fees': fees, 'plates': plates}
+
+def compare(np, sessions, timings, expected):
+    # Returns the analyses whose results differ from the loops'.
+    differences = []
+    if timings['peak occupancy'][1][0] != expected['peak']:
+        differences.append('peak occupancy')
+    if timings[f"occupancy every {CURVE_STEP // 60} min"][1][1].tolist() != expected['curve']:
+        differences.append('occupancy curve')
+    if not np.allclose(timings['mean occupancy by hour'][1][1], expected['mean']):
+        differences.append('mean occupancy by hour')
+    if timings['dwell histogram'][1][0].tolist() != expected['histogram']:
+        differences.append('dwell histogram')
+
+    days, fees, _ = timings['fee totals by day'][1]
+    fee_totals = {int(day): fee for day, fee in zip(days, fees) if fee}
+    expected_fees = {day: fee for day, fee in expected['fees'].items() if fee}
+    if fee_totals.keys() != expected_fees.keys() or not np.allclose(
+            [fee_totals[day] for day in sorted(fee_totals)], [expected_fees[day] for day in sorted(expected_fees)]):
+        differences.append('fee totals by day')
+
+    aggregates = timings['plate aggregates'][1]
+    for plate, totals in expected['plates'].items():
+        index = int(np.searchsorted(sessions.plates, plate))
+        if (aggregates['visits'][index] != totals['visits'] or aggregates['last_entry'][index] != totals['last_entry']
+                or not np.isclose(aggregates['fees'][index], totals['fees'])):
+            differences.append('plate aggregates')
+            break
+    if int(aggregates['visits'].sum()) != len(sessions):
+        differences.append('plate aggregates')
+    return differences
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=10000000)
+    parser.add_argument('--plates', type=int, default=500000)
+    parser.add_argument('--sites', type=int, default=4)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--check-sessions', type=int, default=20000, help='sessions also analysed with loops')
+    parser.add_argument('--max-seconds', type=float, default=10, help='time the analyses must finish within')
+    parser.add_argument('--directory', help='where to write the columns; a temporary directory by default')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    try:
+        import numpy as np
+        import analytics
+    except ImportError:
+        sys.exit('The analytics benchmark needs numpy: pip install numpy')
+
+    start_time = START_TIME
+    end_time = START_TIME + args.days * 86400
+    with tempfile.TemporaryDirectory() as temp_directory:
+        directory = args.directory or temp_directory
+        started = time.perf_counter()
+        generate(np, analytics, directory, args)
+        generate_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        sessions = analytics.load_sessions(directory)
+        load_seconds = time.perf_counter() - started
+        timings = analyse(analytics, sessions, start_time, end_time)
+        total_seconds = load_seconds + sum(seconds for seconds, _ in timings.values())
+
+        sample = sessions.select(slice(0, min(args.check_sessions, args.sessions)))
+        items = to_items(sample)
+        started = time.perf_counter()
+        expected = loop_analyse(items, start_time, end_time)
+        loop_seconds = time.perf_counter() - started
+        differences = compare(np, sample, analyse(analytics, sample, start_time, end_time), expected)
+
+        as_of = end_time - EARLY_AS_OF
+        entered_after = int(((sample.exit_time == analytics.OPEN) & (sample.entry_time > as_of)).sum())
+        early = analyse(analytics, sample, start_time, end_time, as_of)
+        differences += [f"{name} with open sessions until {as_of}"
+                        for name in compare(np, sample, early, loop_analyse(items, start_time, end_time, as_of))]
+        lowest = int(early[f"occupancy every {CURVE_STEP // 60} min"][1][1].min())
+        peak, peak_time = timings['peak occupancy'][1]
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+        'generate_seconds': generate_seconds,
+        'load_seconds': load_seconds,
+        'analyses': {name: seconds for name, (seconds, _) in timings.items()},
+        'total_seconds': total_seconds,
+        'sessions_per_second': args.sessions / total_seconds if total_seconds else 0.0,
+        'loop_sessions_per_second': len(items) / loop_seconds if loop_seconds else 0.0,
+        'peak_occupancy': peak,
+        'peak_time': peak_time,
+        'open_sessions_entered_after_as_of': entered_after,
+        'differences': differences
+    }
+
+    print(f"{args.sessions} sessions for {args.plates} plates at {args.sites} sites over {args.days} days, "
+          f"generated in {generate_seconds:.1f}s")
+    print()
+    print(f"{'analysis':<28}{'ms':>10}")
+    print(f"{'load':<28}{load_seconds * 1000:>10.1f}")
+    for name, seconds in report['analyses'].items():
+        print(f"{name:<28}{seconds * 1000:>10.1f}")
+    print(f"{'total':<28}{total_seconds * 1000:>10.1f}")
+    print()
+    print(f"{report['sessions_per_second']:,.0f} sessions/s, loops over {len(items)} items "
+          f"{report['loop_sessions_per_second']:,.0f} sessions/s "
+          f"({report['sessions_per_second'] / max(1.0, report['loop_sessions_per_second']):,.0f}x)")
+    print(f"Peak occupancy {peak} at {peak_time}")
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    failures = [f"{name} differs from the loops" for name in differences]
+    if lowest < 0:
+        failures.append(f"occupancy fell to {lowest} with open sessions until {as_of}")
+    if not entered_after:
+        failures.append(f"no open session in the first {len(items)} entered in the last {EARLY_AS_OF // 3600} hours")
+    if total_seconds > args.max_seconds:
+        failures.append(f"analyses took {total_seconds:.1f}s, more than {args.max_seconds:g}s")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""Load test s3getpassrek with batches of S3 upload records.
+
+--records synthetic uploads are replayed through s3getpassrek.main in
+batches of each of --batch-sizes, as an S3 notification or the image queue's
+event source mapping delivers them. Half are cars arriving at an entry gate
+and half the same cars leaving an hour later through an exit gate, so every
+record is read, looked up and written as at the barrier. Each batch size
+uses a site of its own, so its runs start from an empty car park.
+
+Rekognition is a stand-in that answers each upload with its plate after
+--ocr-latency milliseconds, give or take half. DynamoDB is moto, with
+--backend-latency milliseconds added to each call to stand for the network.
+moto processes one request at a time, as in tools/burst.py, while the
+network waits and Rekognition calls of the handler's threads overlap. Each
+batch size starts from fresh tables, since moto's transactions copy whole
+tables and would otherwise slow down as the runs fill them. --workers sets
+s3getpassrek.MAX_WORKERS.
+
+moto's processing is this host's CPU rather than DynamoDB's, and as it is
+serialised it cannot overlap however well the handler does. Each run is
+therefore compared with its ideal: the Rekognition time of every image
+spread over min(batch size, --workers) threads, or the time spent inside
+moto when that is longer, as neither can take less.
+
+The report gives, for each batch size, images/s, the share of its ideal
+reached, invocation latency percentiles and, for every stage the handler
+times, the latency per record. It exits with status 1 when an upload is not
+recorded as the entry or exit it is, or when the largest batch size reaches
+less than --min-efficiency of its ideal.
+
+    python tools/batch_loadtest.py
+    python tools/batch_loadtest.py --records 400 --batch-sizes 1 10 50 100 --workers 16
+    python tools/batch_loadtest.py --ocr-latency 300 --backend-latency 0 --json batches.json
+
+Requires moto.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+# Stages are timed per record below rather than summed per invocation.
+os.environ['METRICS_ENABLED'] = 'false'
+os.environ['EXIT_GATES'] = 'exit'
+os.environ['PREPROCESS_IMAGES'] = 'false'
+
+import recognition
+import s3getpassrek
+from clients import get_session, set_client
+from simulate import IMAGES_BUCKET, START_TIME, CallCounter, PlateReader, SimulatedClock, create_resources, percentile, random_plate
+
+class SlowReader(PlateReader):
+    # Rekognition taking its time over each image.
+    def __init__(self, latency):
+        super().__init__(CallCounter())
+        self.latency = latency
+
+    def detect_text(self, Image):
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        return super().detect_text(Image)
+
+class Backend:
+    # Adds network latency before each AWS call.
+    def __init__(self, latency):
+        self.latency = latency
+
+    def before_call(self, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+
+class Moto:
+    # Serialises moto's request processing, which is not thread-safe, and
+    # keeps the time spent inside it.
+    def __init__(self, process_request):
+        self.process_request = process_request
+        self.lock = threading.Lock()
+        self.seconds = 0.0
+
+    def patch(self):
+        moto = self
+
+        def process(stubber, request):
+            with moto.lock:
+                started = time.perf_counter()
+                try:
+                    return moto.process_request(stubber, request)
+                finally:
+                    moto.seconds += time.perf_counter() - started
+        return process
+
+class TimedStage:
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.add(self.name, time.perf_counter() - self.started)
+        return False
+
+class StageRecorder:
+    # Stands in for metrics.stage in s3getpassrek, keeping the time of every
+    # stage of every record instead of their sum over an invocation.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+
+    def stage(self, name):
+        return TimedStage(self, name)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.times.setdefault(name, []).append(seconds)
+
+def uploads(reader, rng, site, gate, plates):
+    records = []
+    for plate in plates:
+        key = f"uploads/{site}/{gate}/{len(reader.uploads)}.jpg"
+        reader.uploads[key] = plate
+        records.append({
+            'eventSource': 'aws:s3',
+            'eventName': 'ObjectCreated:Put',
+            's3': {'bucket': {'name': IMAGES_BUCKET}, 'object': {'key': key, 'eTag': f"{rng.getrandbits(128):032x}"}}
+        })
+    return records
+
+def run(args, batch_size, reader, rng, moto):
+    site = f"batch-{batch_size}"
+    moto.seconds = 0.0
+    plates = set()
+    while len(plates) < args.records // 2:
+        plates.add(random_plate(rng))
+    plates = sorted(plates)
+
+    clock = SimulatedClock(START_TIME)
+    recorder = StageRecorder()
+    latencies = []
+    outcomes = {'entries': 0, 'exits': 0, 'other': 0}
+    with mock.patch.object(s3getpassrek, 'time', clock), \
+            mock.patch.object(s3getpassrek, 'stage', recorder.stage), \
+            contextlib.redirect_stdout(io.StringIO()):
+        for gate, expected in (('entry', 'entries'), ('exit', 'exits')):
+            records = uploads(reader, rng, site, gate, plates)
+            for start in range(0, len(records), batch_size):
+                started = time.perf_counter()
+                response = s3getpassrek.main({'Records': records[start:start + batch_size]}, None)
+                latencies.append(time.perf_counter() - started)
+                for result in json.loads(response['body']):
+                    recorded = result['body'].startswith('Entry' if expected == 'entries' else 'Exit')
+                    outcomes[expected if recorded else 'other'] += 1
+            clock.now += 3600
+
+    images = 2 * len(plates)
+    elapsed = sum(latencies)
+    ideal = max(images * args.ocr_latency / 1000 / min(batch_size, args.workers), moto.seconds)
+    return {
+        'images': images,
+        'outcomes': outcomes,
+        'elapsed_seconds': elapsed,
+        'moto_seconds': moto.seconds,
+        'ideal_seconds': ideal,
+        'efficiency': ideal / elapsed if elapsed else 0.0,
+        'images_per_second': images / elapsed if elapsed else 0.0,
+        'invocation_ms': {
+            'p50': percentile(latencies, 0.5) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000
+        },
+        'stage_ms': {
+            name: {
+                'mean': sum(times) / len(times) * 1000,
+                'p50': percentile(times, 0.5) * 1000,
+                'p99': percentile(times, 0.99) * 1000
+            }
+            for name, times in sorted(recorder.times.items())
+        }
+    }
+
+def print_report(report):
+    config = report['config']
+    print(f"{config['records']} uploads per batch size, {config['workers']} workers, "
+          f"{config['ocr_latency']:g}ms per Rekognition call, {config['backend_latency']:g}ms added to each AWS call")
+    print()
+    print(f"{'batch':>6}{'images/s':>10}{'speedup':>9}{'moto s':>8}{'ideal':>7}{'p50 ms':>9}{'p99 ms':>9}")
+    smallest = next(iter(report['runs'].values()))['images_per_second']
+    for batch_size, run in report['runs'].items():
+        print(f"{batch_size:>6}{run['images_per_second']:>10.1f}{run['images_per_second'] / smallest:>9.2f}"
+              f"{run['moto_seconds']:>8.1f}{run['efficiency']:>7.0%}"
+              f"{run['invocation_ms']['p50']:>9.1f}{run['invocation_ms']['p99']:>9.1f}")
+    for batch_size, run in report['runs'].items():
+        print()
+        print(f"Batches of {batch_size}, per record:")
+        print(f"  {'stage':<15}{'mean ms':>9}{'p50 ms':>9}{'p99 ms':>9}")
+        for name, stats in run['stage_ms'].items():
+            print(f"  {name:<15}{stats['mean']:>9.1f}{stats['p50']:>9.1f}{stats['p99']:>9.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=200, help='uploads replayed at each batch size, half of them exits')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 5, 10], help='records per invocation')
+    parser.add_argument('--workers', type=int, default=s3getpassrek.MAX_WORKERS, help='threads per invocation')
+    parser.add_argument('--ocr-latency', type=float, default=150, help='Rekognition latency in milliseconds')
+    parser.add_argument('--backend-latency', type=float, default=5, help='milliseconds added to each AWS call')
+    parser.add_argument('--min-efficiency', type=float, default=0.5,
+                        help="smallest allowed share of its ideal time the largest batch size may reach")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    try:
+        from moto import mock_aws
+        from moto.core.botocore_stubber import BotocoreStubber
+    except ImportError:
+        sys.exit('The load test needs moto: pip install moto')
+
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    reader = SlowReader(args.ocr_latency / 1000)
+    batch_sizes = sorted(set(args.batch_sizes))
+    moto = Moto(BotocoreStubber.process_request)
+    report = {'config': {key: value for key, value in vars(args).items() if key != 'json'}, 'runs': {}}
+    with mock.patch.object(BotocoreStubber, 'process_request', moto.patch()), \
+            mock.patch.object(s3getpassrek, 'MAX_WORKERS', args.workers), \
+            mock.patch.object(recognition, 'rekognition_limiter', None):
+        set_client('rekognition', reader)
+        get_session().register('before-call', Backend(args.backend_latency / 1000).before_call)
+        for batch_size in batch_sizes:
+            with mock_aws():
+                create_resources()
+                report['runs'][batch_size] = run(args, batch_size, reader, rng, moto)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    failures = []
+    for batch_size, run_report in report['runs'].items():
+        outcomes = run_report['outcomes']
+        cars = run_report['images'] // 2
+        if outcomes['other'] or outcomes['entries'] != cars or outcomes['exits'] != cars:
+            failures.append(f"in batches of {batch_size}, {outcomes['entries']} entries and {outcomes['exits']} exits "
+                            f"were recorded for {cars} cars")
+    largest = report['runs'][batch_sizes[-1]]
+    if largest['efficiency'] < args.min_efficiency:
+        failures.append(f"batches of {batch_sizes[-1]} took {largest['elapsed_seconds']:.1f}s against an ideal of "
+                        f"{largest['ideal_seconds']:.1f}s, {largest['efficiency']:.0%} of it, "
+                        f"below {args.min_efficiency:.0%}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""Compare time-range reports on EntryBucketIndex with a table scan.
+
+ParkingSessions is filled with --days days of sessions, --sessions-per-day a
+day with a commuter peak, in an in-memory stand-in that keeps
+EntryBucketIndex sorted as DynamoDB does (tools/standin.py). Sessions are
+bucketed by hour and by day with reporting.entry_bucket and entry_day, as
+s3getpassrek writes them, once for each of --shards. --open-rate of them have no exit.
+
+Three reports are then read with reporting and, for comparison, with a
+paginated scan that keeps the matching sessions, as they were read before
+the index. The morning report is read by hour and the others by day:
+
+    morning  sessions that entered between 08:00 and 10:00 on the last day
+    month    sessions that entered in the last 30 days
+    stale    sessions still open 24 hours after they entered
+
+Every request waits --latency milliseconds. The report gives the time,
+requests and items read of each. Items read are what DynamoDB charges read
+capacity for. It exits with status 1 when the index and the scan disagree.
+
+    python tools/bucket_benchmark.py
+    python tools/bucket_benchmark.py --days 365 --sessions-per-day 5000 --shards 1 4 16
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from simulate import START_TIME, random_plate
+from standin import StandInTable
+
+import reporting
+
+# Share of arrivals in each UTC hour.
+ARRIVALS = [1, 1, 1, 1, 1, 2, 4, 9, 12, 9, 6, 5, 5, 5, 5, 5, 6, 7, 5, 3, 2, 2, 1, 1]
+DAY = 86400
+
+def make_sessions(args, rng):
+    sessions = []
+    for day in range(args.days):
+        for hour in rng.choices(range(24), weights=ARRIVALS, k=args.sessions_per_day):
+            entry_time = START_TIME + day * DAY + hour * 3600 + rng.randrange(3600)
+            session = {
+                'SessionID': f"session-{len(sessions)}",
+                'SiteID': 'default',
+                'CarRegistration': random_plate(rng),
+                'EntryTime': entry_time
+            }
+            if rng.random() >= args.open_rate:
+                session['ExitTime'] = entry_time + rng.randrange(600, 8 * 3600)
+            sessions.append(session)
+    return sessions
+
+def reports(now):
+    # Each report as the arguments of sessions_between and the filter a
+    # scan applies.
+    morning = now - DAY + 8 * 3600
+    return {
+        'morning': ((morning, morning + 2 * 3600, False),
+                    lambda item: morning <= item['EntryTime'] <= morning + 2 * 3600),
+        'month': ((now - 30 * DAY, now, False),
+                  lambda item: now - 30 * DAY <= item['EntryTime'] <= now),
+        'stale': ((now - 31 * DAY, now - DAY, True),
+                  lambda item: now - 31 * DAY <= item['EntryTime'] <= now - DAY and 'ExitTime' not in item)
+    }
+
+def scan_matching(table, matches):
+    scan_params = {}
+    found = []
+    while True:
+        response = table.scan(**scan_params)
+        found.extend(item['SessionID'] for item in response['Items'] if matches(item))
+        if 'LastEvaluatedKey' not in response:
+            return found
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def timed(table, read):
+    table.reset_counts()
+    started = time.perf_counter()
+    found = read()
+    return sorted(found), {
+        'ms': (time.perf_counter() - started) * 1000,
+        'sessions': len(found),
+        'requests': table.requests,
+        'items_read': table.items_read
+    }
+
+def run(args, sessions, shards):
+    failures = []
+    table = StandInTable('SessionID', {
+        'EntryBucketIndex': ('EntryBucket', 'EntryTime'),
+        'EntryDayIndex': ('EntryDay', 'EntryTime')
+    }, latency=args.latency / 1000)
+    with mock.patch.object(reporting, 'ENTRY_BUCKET_SHARDS', shards):
+        for session in sessions:
+            table.put(dict(
+                session,
+                EntryBucket=reporting.entry_bucket(session['EntryTime'], session['SessionID']),
+                EntryDay=reporting.entry_day(session['EntryTime'], session['SessionID'])
+            ))
+
+    now = START_TIME + args.days * DAY
+    results = {}
+    with mock.patch.object(reporting, 'get_table', lambda name: table):
+        for name, (between, matches) in reports(now).items():
+            with mock.patch.object(reporting, 'ENTRY_BUCKET_SHARDS', shards):
+                indexed, index_stats = timed(table, lambda: [
+                    item['SessionID'] for item in reporting.sessions_between(*between, max_workers=args.workers)
+                ])
+            scanned, scan_stats = timed(table, lambda: scan_matching(table, matches))
+            results[name] = {'index': index_stats, 'scan': scan_stats}
+            if indexed != scanned:
+                failures.append(f"with {shards} shards, the index found {len(indexed)} sessions for {name} "
+                                f"and the scan {len(scanned)}")
+    return results, failures
+
+def print_report(report):
+    config = report['config']
+    print(f"{report['sessions']} sessions over {config['days']} days, {config['latency']:g}ms per request, "
+          f"{config['workers']} bucket queries at once")
+    for shards, results in report['runs'].items():
+        print()
+        print(f"{shards} shards per bucket:")
+        print(f"  {'report':<9}{'method':<7}{'sessions':>9}{'ms':>10}{'requests':>10}{'items read':>12}")
+        for name, methods in results.items():
+            for method, stats in methods.items():
+                print(f"  {name:<9}{method:<7}{stats['sessions']:>9}{stats['ms']:>10.1f}"
+                      f"{stats['requests']:>10}{stats['items_read']:>12}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--sessions-per-day', type=int, default=2000)
+    parser.add_argument('--open-rate', type=float, default=0.01, help='share of sessions with no exit')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 4], help='shard counts to compare')
+    parser.add_argument('--workers', type=int, default=reporting.MAX_WORKERS, help='bucket queries at once')
+    parser.add_argument('--latency', type=float, default=5, help='milliseconds per request')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    sessions = make_sessions(args, random.Random(args.seed))
+    runs = {}
+    failures = []
+    for shards in args.shards:
+        runs[shards], shard_failures = run(args, sessions, shards)
+        failures += shard_failures
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+        'sessions': len(sessions),
+        'runs': runs
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
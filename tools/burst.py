@@ -0,0 +1,466 @@
+"""Drain a burst of camera uploads through the image queue against a throttled Rekognition.
+
+The scenario the image queues exist for: --entries cars arrive while --exits
+parked cars leave, all uploading within a moment of each other. Every upload
+is queued on the main queue, as the bucket's notification queues it, and
+exit uploads are also queued on the exit queue, as the EventBridge rule for
+exit gates queues them. --concurrency consumers drain the main queue and
+--exit-concurrency consumers the exit queue, in batches of ten as the event
+source mappings do. The main queue's consumers leave exit uploads to the
+exit queue. Rekognition is a stand-in that throttles anything above --quota
+requests per second.
+
+Each consumer calls s3getpassrek.main with a context holding the Lambda
+timeout. Records that fail return to the queue after --visibility seconds.
+Records deferred because capacity ran out before the deadline are sent back
+to their queue as new messages, so they do not use up receives. The
+consumers of each queue share one limiter set to that queue's share of the
+quota: --exit-share of it for exits and the rest for entries, as each
+queue's containers would each take their part. --no-limiter leaves pacing
+off so that only the jittered retries stand between the burst and the quota.
+
+The run passes when every upload is recorded once, each queue's consumers
+use their share of the quota at --min-utilisation or better, exits finish
+ahead of entries on average and at the median, and no message is received
+--max-receives times, after which the queue would move it to the dead-letter
+queue. A Rekognition client configured as the handlers configure it must also
+make a single attempt at a throttled call, leaving every retry to the
+limiter. It exits with status 1 otherwise.
+
+    python tools/burst.py
+    python tools/burst.py --entries 200 --exits 200 --quota 20 --concurrency 4
+    python tools/burst.py --entries 400 --exits 100 --quota 5 --seed 3
+    python tools/burst.py --no-limiter
+
+Requires moto.
+"""
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+# Consumer threads would share one metrics collector, so metrics are off.
+os.environ['METRICS_ENABLED'] = 'false'
+os.environ['EXIT_GATES'] = 'exit'
+os.environ['PREPROCESS_IMAGES'] = 'false'
+
+import botocore.session
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+
+import recognition
+import s3getpassrek
+import throttling
+from clients import SERVICE_CONFIGS, get_client, set_client
+from simulate import IMAGES_BUCKET, START_TIME, SimulatedClock, create_resources, percentile, random_plate
+
+QUEUE_NAME = 'car-park-image-events-burst'
+EXIT_QUEUE_NAME = 'car-park-exit-image-events-burst'
+SITE = 'burst'
+FUNCTION_TIMEOUT = 15  # seconds, as in terraform/main.tf
+
+class ThrottledReader:
+    # Rekognition with a requests-per-second quota over a sliding second.
+    # Accepted calls take --ocr-latency milliseconds.
+    def __init__(self, quota, latency):
+        self.quota = quota
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.accepted = collections.deque()
+        self.uploads = {}
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.throttled = 0
+        # Accepted calls, and the first and last of them, by gate.
+        self.accepted_by_gate = collections.Counter()
+        self.first_accepted = {}
+        self.last_accepted = {}
+
+    def detect_text(self, Image):
+        now = time.monotonic()
+        with self.lock:
+            self.calls += 1
+            while self.accepted and self.accepted[0] <= now - 1:
+                self.accepted.popleft()
+            if len(self.accepted) >= self.quota:
+                self.throttled += 1
+                raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'DetectText')
+            self.accepted.append(now)
+            gate = Image['S3Object']['Name'].split('/')[2]
+            self.accepted_by_gate[gate] += 1
+            self.first_accepted.setdefault(gate, now)
+            self.last_accepted[gate] = now
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        text = self.uploads[Image['S3Object']['Name']]
+        return {'TextDetections': [{
+            'DetectedText': text,
+            'Type': 'LINE',
+            'Confidence': 98.5,
+            'Geometry': {'BoundingBox': {'Left': 0.35, 'Top': 0.6, 'Width': 0.3, 'Height': 0.0854}}
+        }]}
+
+class ThrottledResponse:
+    # The raw body of a Rekognition ThrottlingException.
+    def stream(self, **kwargs):
+        yield b'{"__type": "ThrottlingException", "message": "Rate exceeded"}'
+
+def botocore_attempts():
+    # Returns the requests a Rekognition client with the handlers' config
+    # sends for one DetectText call answered with throttling every time.
+    client = botocore.session.Session().create_client(
+        'rekognition', region_name='eu-west-2', aws_access_key_id='testing', aws_secret_access_key='testing',
+        config=SERVICE_CONFIGS['rekognition']
+    )
+    attempts = []
+
+    def throttle(request, **kwargs):
+        attempts.append(request)
+        return AWSResponse(request.url, 400, {}, ThrottledResponse())
+
+    client.meta.events.register('before-send', throttle)
+    try:
+        client.detect_text(Image={'Bytes': b'image'})
+    except ClientError:
+        pass
+    return len(attempts)
+
+class PriorityLimiter:
+    # Stands in for each queue's limiter inside one process. The exit queue's
+    # consumers only process exits, so a call's priority says whose it is.
+    def __init__(self, limiters):
+        self.limiters = limiters
+
+    def acquire(self, priority=throttling.ENTRY_PRIORITY, deadline=None):
+        return self.limiters[priority].acquire(priority, deadline)
+
+    def drain(self):
+        priority = (getattr(throttling._request, 'value', None) or (throttling.ENTRY_PRIORITY, None))[0]
+        self.limiters[priority].drain()
+
+class ConsumerSetting:
+    # A module setting that differs between the queues' consumers, which are
+    # threads of one process here.
+    def __init__(self):
+        self.local = threading.local()
+
+    def set(self, value):
+        self.local.value = value
+
+    def __bool__(self):
+        return getattr(self.local, 'value', False)
+
+class Context:
+    def __init__(self, timeout):
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+class Burst:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.reader = ThrottledReader(args.quota, args.ocr_latency / 1000)
+        self.clock = SimulatedClock(START_TIME)
+        self.lock = threading.Lock()
+        self.queued_at = {}
+        self.finished = {}
+        self.outcomes = collections.Counter()
+        self.deliveries = collections.Counter()
+        self.failed_deliveries = collections.Counter()
+        self.max_receives = 0
+        self.requeued = 0
+        self.exits_queued_separately = ConsumerSetting()
+
+    def upload(self, gate, plate):
+        key = f"uploads/{SITE}/{gate}/{len(self.reader.uploads)}.jpg"
+        get_client('s3').put_object(Bucket=IMAGES_BUCKET, Key=key, Body=plate.encode())
+        self.reader.uploads[key] = plate
+        return {
+            'eventSource': 'aws:s3',
+            'eventName': 'ObjectCreated:Put',
+            's3': {'bucket': {'name': IMAGES_BUCKET}, 'object': {'key': key, 'eTag': f"{self.rng.getrandbits(128):032x}"}}
+        }
+
+    def handle_record(self, record):
+        # Wraps s3getpassrek.handle_record to time each upload's completion.
+        result = self.original_handle_record(record)
+        key = record['s3']['object']['key']
+        with self.lock:
+            self.finished.setdefault(key, time.monotonic())
+            body = result['body']
+            self.outcomes['exits' if body.startswith('Exit') else 'entries' if body.startswith('Entry')
+                          else 'duplicates' if body.startswith('Duplicate') else 'unread'] += 1
+        return result
+
+    def requeue(self, record):
+        self.original_requeue(record)
+        with self.lock:
+            self.requeued += 1
+
+    def park(self, plates):
+        # The leaving cars entered two hours before the burst, directly and
+        # without pacing.
+        records = [self.upload('entry', plate) for plate in plates]
+        with mock.patch.object(recognition, 'rekognition_limiter', None), \
+                mock.patch.object(self.reader, 'quota', float('inf')):
+            for start in range(0, len(records), 10):
+                s3getpassrek.main({'Records': records[start:start + 10]}, None)
+        self.reader.reset()
+        self.clock.now += 7200
+
+    def consume(self, queue, queue_url, queue_arn, total):
+        sqs = get_client('sqs')
+        self.exits_queued_separately.set(queue == 'main')
+        while True:
+            with self.lock:
+                if len(self.finished) >= total:
+                    return
+            messages = sqs.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=10,
+                AttributeNames=['ApproximateReceiveCount']
+            ).get('Messages', [])
+            if not messages:
+                time.sleep(0.05)
+                continue
+            event = {'Records': [{
+                'messageId': message['MessageId'],
+                'receiptHandle': message['ReceiptHandle'],
+                'body': message['Body'],
+                'eventSource': 'aws:sqs',
+                'eventSourceARN': queue_arn
+            } for message in messages]}
+            response = s3getpassrek.main(event, Context(FUNCTION_TIMEOUT))
+            failed = {failure['itemIdentifier'] for failure in response['batchItemFailures']}
+            with self.lock:
+                self.deliveries[queue] += len(messages)
+                self.failed_deliveries[queue] += len(failed)
+                self.max_receives = max(
+                    [self.max_receives] + [int(message['Attributes']['ApproximateReceiveCount']) for message in messages]
+                )
+            for message in messages:
+                if message['MessageId'] not in failed:
+                    sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+
+    def utilisation(self, gates, capacity):
+        # Calls per second while the gates' uploads were being read, as a
+        # share of capacity. This leaves out the queue's first poll and the
+        # handlers' writes after the last call.
+        accepted = sum(self.reader.accepted_by_gate[gate] for gate in gates)
+        if accepted < 2 or not capacity:
+            return 0.0
+        busy = (max(self.reader.last_accepted[gate] for gate in gates if gate in self.reader.last_accepted)
+                - min(self.reader.first_accepted[gate] for gate in gates if gate in self.reader.first_accepted))
+        return (accepted - 1) / busy / capacity if busy else 0.0
+
+    def run(self):
+        args = self.args
+        sqs = get_client('sqs')
+        queues = {}
+        for queue, name in (('main', QUEUE_NAME), ('exit', EXIT_QUEUE_NAME)):
+            queue_url = sqs.create_queue(QueueName=name, Attributes={'VisibilityTimeout': str(args.visibility)})['QueueUrl']
+            queue_arn = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+            queues[queue] = (queue_url, queue_arn)
+
+        leaving = [random_plate(self.rng) for _ in range(args.exits)]
+        arriving = [random_plate(self.rng) for _ in range(args.entries)]
+        with mock.patch.object(s3getpassrek, 'time', self.clock), contextlib.redirect_stdout(io.StringIO()):
+            self.park(leaving)
+
+        uploads = [('exit', plate) for plate in leaving] + [('entry', plate) for plate in arriving]
+        self.rng.shuffle(uploads)
+        gates = {}
+        for gate, plate in uploads:
+            record = self.upload(gate, plate)
+            key = record['s3']['object']['key']
+            gates[key] = gate
+            sqs.send_message(QueueUrl=queues['main'][0], MessageBody=json.dumps({'Records': [record]}))
+            if gate == 'exit':
+                sqs.send_message(QueueUrl=queues['exit'][0], MessageBody=json.dumps({
+                    'version': '0',
+                    'detail-type': 'Object Created',
+                    'source': 'aws.s3',
+                    'detail': {
+                        'bucket': {'name': IMAGES_BUCKET},
+                        'object': {'key': key, 'etag': record['s3']['object']['eTag']}
+                    }
+                }))
+            self.queued_at[key] = time.monotonic()
+
+        shares = {'exit': args.quota * args.exit_share, 'entry': args.quota * (1 - args.exit_share)}
+        limiter = None
+        if not args.no_limiter:
+            limiter = PriorityLimiter({
+                throttling.EXIT_PRIORITY: throttling.TokenBucket(shares['exit'] * args.headroom, burst=1),
+                throttling.ENTRY_PRIORITY: throttling.TokenBucket(shares['entry'] * args.headroom, burst=1)
+            })
+        self.original_handle_record = s3getpassrek.handle_record
+        self.original_requeue = s3getpassrek.requeue
+        started = time.monotonic()
+        with mock.patch.object(s3getpassrek, 'time', self.clock), \
+                mock.patch.object(s3getpassrek, 'handle_record', self.handle_record), \
+                mock.patch.object(s3getpassrek, 'requeue', self.requeue), \
+                mock.patch.object(s3getpassrek, 'EXITS_QUEUED_SEPARATELY', self.exits_queued_separately), \
+                mock.patch.object(s3getpassrek, 'REQUEUE_DELAY', args.requeue_delay), \
+                mock.patch.object(recognition, 'rekognition_limiter', limiter), \
+                contextlib.redirect_stdout(io.StringIO()):
+            consumers = [
+                threading.Thread(target=self.consume, args=(queue, *queues[queue], len(uploads)))
+                for queue, concurrency in (('main', args.concurrency), ('exit', args.exit_concurrency))
+                for _ in range(concurrency)
+            ]
+            for consumer in consumers:
+                consumer.start()
+            for consumer in consumers:
+                consumer.join(timeout=args.max_seconds)
+        elapsed = time.monotonic() - started
+        if any(consumer.is_alive() for consumer in consumers):
+            sys.exit(f"The queue was not drained within {args.max_seconds}s")
+
+        waits = {'exit': [], 'entry': []}
+        for key, finished in self.finished.items():
+            if key in gates:
+                waits[gates[key]].append(finished - self.queued_at[key])
+        return {
+            'config': {key: value for key, value in vars(args).items() if key != 'json'},
+            'uploads': len(uploads),
+            'outcomes': dict(self.outcomes),
+            'elapsed_seconds': elapsed,
+            'uploads_per_second': len(uploads) / elapsed,
+            'rekognition_calls': self.reader.calls,
+            'rekognition_throttled': self.reader.throttled,
+            'utilisation': self.utilisation(('exit', 'entry'), args.quota),
+            'queue_utilisation': {
+                'exit': self.utilisation(('exit',), shares['exit']),
+                'entry': self.utilisation(('entry',), shares['entry'])
+            },
+            'deliveries': dict(self.deliveries),
+            'failed_deliveries': dict(self.failed_deliveries),
+            'max_receives': self.max_receives,
+            'requeued': self.requeued,
+            'wait_seconds': {
+                gate: {
+                    'p50': percentile(values, 0.5),
+                    'p90': percentile(values, 0.9),
+                    'max': max(values, default=0.0),
+                    'mean': statistics.mean(values) if values else 0.0
+                }
+                for gate, values in waits.items()
+            }
+        }
+
+def serialised(process_request):
+    # moto's backends are not thread-safe (a transaction copies and restores
+    # whole tables), so consumers take turns inside moto. Waiting on the
+    # limiter and on Rekognition still overlaps.
+    lock = threading.Lock()
+
+    def process(self, request):
+        with lock:
+            return process_request(self, request)
+    return process
+
+def check(report, args):
+    failures = []
+    outcomes = report['outcomes']
+    if outcomes.get('exits', 0) != args.exits or outcomes.get('entries', 0) != args.entries:
+        failures.append(f"expected {args.entries} entries and {args.exits} exits, recorded "
+                        f"{outcomes.get('entries', 0)} and {outcomes.get('exits', 0)}")
+    for gate, uploads in (('exit', args.exits), ('entry', args.entries)):
+        utilisation = report['queue_utilisation'][gate]
+        if uploads > 1 and utilisation < args.min_utilisation:
+            failures.append(f"{gate} consumers ran Rekognition at {utilisation:.0%} of their share, "
+                            f"below {args.min_utilisation:.0%}")
+    waits = report['wait_seconds']
+    for statistic, name in (('mean', 'on average'), ('p50', 'at the median')):
+        if args.exits and args.entries and waits['exit'][statistic] >= waits['entry'][statistic]:
+            failures.append(f"exits waited {waits['exit'][statistic]:.2f}s {name}, "
+                            f"entries {waits['entry'][statistic]:.2f}s")
+    if report['max_receives'] >= args.max_receives:
+        failures.append(f"a message was received {report['max_receives']} times and would be dead-lettered")
+    if report['botocore_attempts'] != 1:
+        failures.append(f"botocore sent a throttled Rekognition call {report['botocore_attempts']} times, "
+                        f"retrying outside the limiter")
+    return failures
+
+def print_report(report):
+    config = report['config']
+    print(f"Burst of {report['uploads']} uploads ({config['entries']} entries, {config['exits']} exits) "
+          f"against a quota of {config['quota']:g} TPS, {config['exit_share']:.0%} of it for exits, "
+          f"{config['concurrency']} main and {config['exit_concurrency']} exit consumers, "
+          f"limiter {'off' if config['no_limiter'] else 'on'}")
+    print(f"Drained in {report['elapsed_seconds']:.1f}s: {report['uploads_per_second']:.1f} uploads/s, "
+          f"Rekognition at {report['utilisation']:.0%} of the quota, exits at "
+          f"{report['queue_utilisation']['exit']:.0%} and entries at {report['queue_utilisation']['entry']:.0%} "
+          f"of their shares")
+    print(f"Rekognition calls: {report['rekognition_calls']}, throttled: {report['rekognition_throttled']}")
+    for queue, deliveries in report['deliveries'].items():
+        print(f"{queue.capitalize()} queue deliveries: {deliveries}, "
+              f"returned to the queue: {report['failed_deliveries'].get(queue, 0)}")
+    print(f"Deferred and requeued: {report['requeued']}, most receives of one message: {report['max_receives']}")
+    print(f"Attempts botocore makes at a throttled Rekognition call: {report['botocore_attempts']}")
+    print(f"Outcomes: {', '.join(f'{count} {name}' for name, count in sorted(report['outcomes'].items()))}")
+    print()
+    print(f"{'wait (s)':<10}{'mean':>8}{'p50':>8}{'p90':>8}{'max':>8}")
+    for gate, wait in report['wait_seconds'].items():
+        print(f"{gate:<10}{wait['mean']:>8.2f}{wait['p50']:>8.2f}{wait['p90']:>8.2f}{wait['max']:>8.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=60, help='arriving cars')
+    parser.add_argument('--exits', type=int, default=60, help='leaving cars')
+    parser.add_argument('--quota', type=float, default=10, help='Rekognition requests per second')
+    parser.add_argument('--headroom', type=float, default=0.9, help='share of the quota the limiter allows')
+    parser.add_argument('--concurrency', type=int, default=2, help='concurrent main queue consumers')
+    parser.add_argument('--exit-concurrency', type=int, default=2, help='concurrent exit queue consumers')
+    parser.add_argument('--exit-share', type=float, default=0.6, help='share of the quota given to the exit queue')
+    parser.add_argument('--ocr-latency', type=float, default=80, help='Rekognition latency in milliseconds')
+    parser.add_argument('--visibility', type=int, default=20, help='queue visibility timeout in seconds, above the function timeout')
+    parser.add_argument('--requeue-delay', type=int, default=1, help='seconds a deferred message waits')
+    parser.add_argument('--max-receives', type=int, default=5, help="the queues' maxReceiveCount")
+    parser.add_argument('--no-limiter', action='store_true', help='retry throttled calls without pacing them')
+    parser.add_argument('--min-utilisation', type=float, default=0.7, help="share of each queue's quota the run must reach")
+    parser.add_argument('--max-seconds', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    try:
+        from moto import mock_aws
+        from moto.core.botocore_stubber import BotocoreStubber
+    except ImportError:
+        sys.exit('The burst test needs moto: pip install moto')
+
+    with mock_aws(), mock.patch.object(BotocoreStubber, 'process_request', serialised(BotocoreStubber.process_request)):
+        burst = Burst(args)
+        set_client('rekognition', burst.reader)
+        create_resources()
+        report = burst.run()
+    report['botocore_attempts'] = botocore_attempts()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    failures = check(report, args)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
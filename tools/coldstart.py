@@ -0,0 +1,186 @@
+"""Profile the cold-start imports of every Lambda handler and guard against regressions.
+
+Each handler named in terraform/main.tf is imported in a fresh interpreter
+with -X importtime, as the Lambda runtime does during init. The report gives
+the median import time over --runs runs, the number of modules the handler
+pulls in and its most expensive imports.
+
+--check compares the result with tools/coldstart_baseline.json and exits
+with status 1 when a handler imports more modules than its baseline or its
+import time grows by more than --tolerance. Module counts do not depend on
+the machine, so they catch a new heavyweight import reliably, while the
+looser time check catches slow module-level work. Import times are compared
+as multiples of the time to import the standard library's http.client,
+measured in the same run, so that a faster or slower machine does not count
+as a change.
+
+Another Python version imports a different standard library, so the
+baseline is recorded with the Lambda runtime's version from
+terraform/main.tf, --update-baseline refuses any other, and --check fails
+when the baseline's major.minor version is not the interpreter's.
+
+    python3.10 tools/coldstart.py
+    python3.10 tools/coldstart.py --top 20 s3getpassrek
+    python3.10 tools/coldstart.py --check
+    python3.10 tools/coldstart.py --update-baseline
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LAMBDA_DIR = os.path.join(ROOT, 'lambda')
+TERRAFORM_FILE = os.path.join(ROOT, 'terraform', 'main.tf')
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'coldstart_baseline.json')
+# Import times are measured against this module's. It is standard library
+# only, so it does not change with the handlers, and takes long enough for
+# its median to be stable.
+REFERENCE_MODULE = 'http.client'
+
+def find_handlers():
+    with open(TERRAFORM_FILE) as terraform_file:
+        handlers = re.findall(r'^\s*handler\s*=\s*"([\w]+)\.\w+"', terraform_file.read(), re.MULTILINE)
+    return sorted(set(handlers))
+
+def find_runtime():
+    # The major.minor Python version every function runs on.
+    with open(TERRAFORM_FILE) as terraform_file:
+        runtimes = set(re.findall(r'^\s*runtime\s*=\s*"python([\d.]+)"', terraform_file.read(), re.MULTILINE))
+    if len(runtimes) != 1:
+        sys.exit(f"Expected one Python runtime in {TERRAFORM_FILE}, found {sorted(runtimes) or 'none'}")
+    return runtimes.pop()
+
+def minor_version(version):
+    return '.'.join(version.split('.')[:2])
+
+def import_once(module):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+        cwd=LAMBDA_DIR,
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        sys.exit(f"Importing {module} failed:\n{result.stderr}")
+
+    # Nested imports are printed before the module that imported them, so
+    # the handler's imports are the lines between the previous top-level
+    # import (the interpreter's own startup) and the handler itself.
+    imports = []
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)', line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        if not indent and name == module:
+            return int(cumulative_us), imports
+        if not indent:
+            imports = []
+        else:
+            imports.append((int(self_us), int(cumulative_us), len(indent) // 2, name))
+    sys.exit(f"No import time reported for {module}")
+
+def profile(module, runs):
+    times = []
+    imports = []
+    for _ in range(runs):
+        cumulative_us, imports = import_once(module)
+        times.append(cumulative_us)
+    return {
+        'import_ms': statistics.median(times) / 1000,
+        'modules': len(imports) + 1,
+        'heaviest': sorted(imports, key=lambda entry: -entry[1])
+    }
+
+def print_profile(module, result, top):
+    print(f"{module}: {result['import_ms']:.1f}ms, {result['modules']} modules")
+    for self_us, cumulative_us, depth, name in result['heaviest'][:top]:
+        print(f"  {cumulative_us / 1000:>8.1f}ms {self_us / 1000:>7.1f}ms self  {'  ' * (depth - 1)}{name}")
+
+def check(results, reference_ms, baseline, tolerance):
+    python = minor_version(platform.python_version())
+    if minor_version(baseline.get('python', '')) != python:
+        print(f"FAIL: baseline was recorded with Python {baseline.get('python')}, this is {python}; "
+              f"run --check with the Python the baseline was recorded on")
+        return False
+    if 'reference_ms' not in baseline:
+        print(f"Baseline has no {REFERENCE_MODULE} import time, run --update-baseline; import times are only reported")
+
+    regressions = []
+    for module, result in results.items():
+        expected = baseline['handlers'].get(module)
+        if expected is None:
+            print(f"{module}: no baseline, run --update-baseline")
+            continue
+        if result['modules'] > expected['modules']:
+            regressions.append(f"{module} imports {result['modules']} modules, baseline {expected['modules']}")
+        if 'reference_ms' not in baseline:
+            continue
+        ratio = result['import_ms'] / reference_ms
+        expected_ratio = expected['import_ms'] / baseline['reference_ms']
+        limit = expected_ratio * (1 + tolerance)
+        if ratio > limit:
+            regressions.append(f"{module} imports in {ratio:.1f} times the time of {REFERENCE_MODULE}, "
+                               f"limit {limit:.1f} (baseline {expected_ratio:.1f})")
+
+    for message in regressions:
+        print(f"REGRESSION: {message}")
+    if not regressions:
+        print('Cold-start imports are within the baseline')
+    return not regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('handlers', nargs='*', help='handler modules, all Terraform handlers by default')
+    parser.add_argument('--runs', type=int, default=5, help='imports per handler, the median is reported')
+    parser.add_argument('--top', type=int, default=10, help='heaviest imports to list per handler')
+    parser.add_argument('--check', action='store_true', help='fail when a handler is worse than the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed import time growth for --check')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    args = parser.parse_args()
+
+    runtime = find_runtime()
+    python = minor_version(platform.python_version())
+    if python != runtime:
+        if args.update_baseline:
+            sys.exit(f"The baseline must be recorded with the Lambda runtime's Python {runtime}, this is {python}")
+        print(f"WARNING: Lambda runs Python {runtime} but this is {python}; its standard library imports differently")
+        print()
+
+    reference_ms = profile(REFERENCE_MODULE, args.runs)['import_ms']
+    print(f"{REFERENCE_MODULE}: {reference_ms:.1f}ms")
+    print()
+    results = {}
+    for module in args.handlers or find_handlers():
+        results[module] = profile(module, args.runs)
+        print_profile(module, results[module], args.top)
+        print()
+
+    if args.update_baseline:
+        baseline = {
+            'python': platform.python_version(),
+            'reference_ms': round(reference_ms, 1),
+            'handlers': {
+                module: {'import_ms': round(result['import_ms'], 1), 'modules': result['modules']}
+                for module, result in results.items()
+            }
+        }
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2)
+            baseline_file.write('\n')
+        print(f"Baseline written to {args.baseline}")
+
+    if args.check:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if not check(results, reference_ms, baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
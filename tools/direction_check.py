@@ -0,0 +1,149 @@
+"""Check that s3getpassrek records entries and exits by the gate that read them.
+
+EXIT_GATES is set to 'exit', so uploads under uploads/<site>/exit/ are exits
+and those under uploads/<site>/entry/ are entries. Each case feeds records
+through s3getpassrek.process_batch, as one invocation would receive them,
+and delivers the records it defers again until none are left:
+
+    exit before entry   a short stay's exit and entry uploads in one batch,
+                        where the exit goes first; one session must be
+                        opened and closed, from the entry to the exit
+    orphan exit         an exit read, uploaded ORPHAN_EXIT_WAIT ago, of a car
+                        whose entry was never read; no session may be opened
+    missed exit         two entry reads of a car, hours apart, whose exit was
+                        not read; the first session must be closed, marked
+                        ExitNotRead, and a second one opened
+
+It exits with status 1 when a case ends with the wrong sessions.
+
+    python tools/direction_check.py
+
+Requires moto.
+"""
+import contextlib
+import io
+import os
+import sys
+from datetime import datetime, timezone
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+os.environ['METRICS_ENABLED'] = 'false'
+os.environ['EXIT_GATES'] = 'exit'
+os.environ['PREPROCESS_IMAGES'] = 'false'
+
+import s3getpassrek
+from clients import set_client
+from simulate import IMAGES_BUCKET, START_TIME, CallCounter, PlateReader, SimulatedClock, create_resources
+from tables import get_table
+
+SITE = 'check'
+# Deliveries of a deferred record before the check gives up on it.
+MAX_DELIVERIES = 5
+
+class Check:
+    def __init__(self):
+        self.reader = PlateReader(CallCounter())
+        self.clock = SimulatedClock(START_TIME)
+        self.uploads = 0
+
+    def upload(self, gate, plate, uploaded_at=None):
+        self.uploads += 1
+        key = f"uploads/{SITE}/{gate}/{self.uploads}.jpg"
+        self.reader.uploads[key] = plate
+        uploaded_at = self.clock.now if uploaded_at is None else uploaded_at
+        return (key, {
+            'eventTime': f"{datetime.fromtimestamp(uploaded_at, timezone.utc):%Y-%m-%dT%H:%M:%S.000Z}",
+            's3': {'bucket': {'name': IMAGES_BUCKET}, 'object': {'key': key, 'eTag': f"{self.uploads:032x}"}}
+        })
+
+    def deliver(self, records):
+        # Processes records as one invocation, then their deferred records as
+        # later ones, as the queue would send them back.
+        for _ in range(MAX_DELIVERIES):
+            with contextlib.redirect_stdout(io.StringIO()):
+                _, failed, deferred = s3getpassrek.process_batch(records)
+            if failed:
+                raise RuntimeError(f"records failed: {failed}")
+            if not deferred:
+                return
+            records = [record for record in records if record[0] in deferred]
+            self.clock.now += s3getpassrek.REQUEUE_DELAY
+        raise RuntimeError(f"records still deferred after {MAX_DELIVERIES} deliveries: {deferred}")
+
+    def sessions(self, plate):
+        items = get_table(s3getpassrek.SESSIONS_TABLE).scan()['Items']
+        return [item for item in items if item['CarRegistration'] == plate]
+
+def exit_before_entry(check):
+    failures = []
+    plate = 'AB12 CDE'
+    entry = check.upload('entry', plate)
+    check.clock.now += 240
+    exit_ = check.upload('exit', plate)
+    check.deliver([entry, exit_])
+    sessions = check.sessions(plate)
+    if len(sessions) != 1:
+        failures.append(f"exit before entry left {len(sessions)} sessions, not 1")
+    elif sessions[0]['EntryPhoto'] != entry[0] or sessions[0].get('ExitPhoto') != exit_[0]:
+        failures.append(f"exit before entry recorded {sessions[0]['EntryPhoto']} as the entry and "
+                        f"{sessions[0].get('ExitPhoto')} as the exit")
+    return failures
+
+def orphan_exit(check):
+    plate = 'XY34 ZZZ'
+    check.deliver([check.upload('exit', plate, check.clock.now - s3getpassrek.ORPHAN_EXIT_WAIT)])
+    sessions = check.sessions(plate)
+    if sessions:
+        return [f"an orphan exit opened {len(sessions)} sessions"]
+    return []
+
+def missed_exit(check):
+    plate = 'MX56 EXT'
+    first = check.upload('entry', plate)
+    check.deliver([first])
+    check.clock.now += 3 * 3600
+    second = check.upload('entry', plate)
+    check.deliver([second])
+    sessions = sorted(check.sessions(plate), key=lambda session: session['EntryTime'])
+    if len(sessions) != 2:
+        return [f"two entry reads left {len(sessions)} sessions, not 2"]
+    failures = []
+    if sessions[0].get('ExitReason') != 'ExitNotRead' or sessions[0].get('ExitPhoto'):
+        failures.append(f"the first session was closed with {sessions[0].get('ExitPhoto')} as its exit photo "
+                        f"and reason {sessions[0].get('ExitReason')}")
+    if sessions[1]['EntryPhoto'] != second[0] or 'ExitTime' in sessions[1]:
+        failures.append("the second entry read did not open a session")
+    return failures
+
+CASES = {
+    'exit before entry': exit_before_entry,
+    'orphan exit': orphan_exit,
+    'missed exit': missed_exit
+}
+
+def main():
+    try:
+        from moto import mock_aws
+    except ImportError:
+        sys.exit('The check needs moto: pip install moto')
+
+    failures = []
+    check = Check()
+    with mock_aws(), mock.patch.object(s3getpassrek, 'time', check.clock):
+        set_client('rekognition', check.reader)
+        create_resources()
+        for name, case in CASES.items():
+            case_failures = case(check)
+            print(f"{name}: {'FAIL' if case_failures else 'ok'}")
+            failures += case_failures
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
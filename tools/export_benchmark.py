@@ -0,0 +1,234 @@
+"""Measure session export throughput by scan segments, and check resuming.
+
+--sessions sessions are exported with export_sessions once for each of
+--segments. The table is an in-memory stand-in that answers segmented scans
+as DynamoDB does, hashing each item to one segment and returning pages of
+--page-size items, and delays every scan request by --backend-latency
+milliseconds for the network and the time DynamoDB takes to read a page.
+More segments overlap that waiting; the export's own row conversion and
+file writing share one interpreter, so they bound how far that goes.
+
+Each export is read back and must hold every session exactly once. An
+export with the largest segment count is then interrupted by a network
+outage after --interrupt-after scan requests, before every segment has
+flushed, and run again. The second run must resume from the checkpoint and
+complete the export without duplicates, and a run with a different segment
+count must refuse the checkpoint.
+
+The report gives items/s and scan requests for each segment count. It exits
+with status 1 when an export loses or duplicates sessions or the resume
+check fails.
+
+    python tools/export_benchmark.py
+    python tools/export_benchmark.py --sessions 1000000 --segments 1 4 16 --backend-latency 100
+
+Requires pyarrow.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from decimal import Decimal
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from simulate import START_TIME, random_plate
+
+import export_sessions
+
+class SessionsTable:
+    # Answers Scan as DynamoDB does for a table keyed by SessionID: each item
+    # belongs to one segment by the hash of its key, and a page ends with the
+    # key to continue from. Each request waits latency seconds, and every
+    # request after outage_after fails.
+    def __init__(self, items, latency):
+        self.items = items
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.scans = 0
+        self.outage_after = None
+        self.segments = {}
+
+    def segment_items(self, total_segments):
+        segments = self.segments.get(total_segments)
+        if segments is None:
+            segments = [[] for _ in range(total_segments)]
+            for item in self.items:
+                segments[zlib.crc32(item['SessionID'].encode()) % total_segments].append(item)
+            self.segments[total_segments] = segments
+        return segments
+
+    def scan(self, Segment, TotalSegments, Limit, ExclusiveStartKey=None):
+        with self.lock:
+            self.scans += 1
+            scans = self.scans
+            items = self.segment_items(TotalSegments)[Segment]
+        if self.outage_after is not None and scans > self.outage_after:
+            raise ConnectionError('Simulated network outage')
+        if self.latency:
+            time.sleep(self.latency)
+
+        start = int(ExclusiveStartKey['Position']) if ExclusiveStartKey else 0
+        response = {'Items': items[start:start + Limit]}
+        if start + Limit < len(items):
+            response['LastEvaluatedKey'] = {'Position': Decimal(start + Limit)}
+        return response
+
+def make_sessions(args, rng):
+    items = []
+    for i in range(args.sessions):
+        plate = random_plate(rng)
+        entry_time = START_TIME + rng.randrange(30 * 86400)
+        item = {
+            'SessionID': f"session-{i}",
+            'SiteID': 'default',
+            'CarRegistration': plate,
+            'PlateKey': plate.replace(' ', ''),
+            'EntryTime': Decimal(entry_time),
+            'EntryPhoto': f"uploads/default/entry/{i}.jpg"
+        }
+        if rng.random() < 0.9:
+            exit_time = entry_time + rng.randrange(600, 8 * 3600)
+            item.update(
+                ExitTime=Decimal(exit_time),
+                DurationHours=Decimal(-(-(exit_time - entry_time) // 3600)),
+                PaymentDue=Decimal(2 * -(-(exit_time - entry_time) // 3600))
+            )
+        items.append(item)
+    return items
+
+def exported_ids(output):
+    import pyarrow.parquet
+    ids = []
+    for directory, _, files in os.walk(output):
+        for name in files:
+            if name.endswith('.parquet'):
+                ids.extend(pyarrow.parquet.read_table(os.path.join(directory, name), columns=['SessionID'])
+                           .column('SessionID').to_pylist())
+    return ids
+
+def export_args(args, output, segments, flush_rows=None):
+    return export_sessions.parse_args([
+        output, '--segments', str(segments),
+        '--page-size', str(args.page_size), '--flush-rows', str(flush_rows or args.flush_rows)
+    ])
+
+def completeness(args, output):
+    # A failure message, or None when every session was exported once.
+    ids = exported_ids(output)
+    missing = args.sessions - len(set(ids))
+    duplicates = len(ids) - len(set(ids))
+    if missing or duplicates:
+        return f"{missing} sessions missing and {duplicates} duplicated"
+    return None
+
+def throughput(args, table, segments):
+    table.segment_items(segments)
+    with tempfile.TemporaryDirectory() as output:
+        table.scans = 0
+        exported, elapsed, errors = export_sessions.export(export_args(args, output, segments))
+        problem = completeness(args, output)
+    return {
+        'items_per_second': exported / elapsed if elapsed else 0,
+        'seconds': elapsed,
+        'scan_requests': table.scans,
+        'errors': len(errors),
+        'problem': problem
+    }
+
+def resume_failures(args, table, segments):
+    # Every page is flushed, so the segments that ran before the outage are
+    # in the checkpoint and the rest are not.
+    failures = []
+    with tempfile.TemporaryDirectory() as output:
+        table.scans = 0
+        table.outage_after = args.interrupt_after
+        _, _, errors = export_sessions.export(export_args(args, output, segments, args.page_size))
+        table.outage_after = None
+        if not errors:
+            failures.append('the interrupted export did not fail')
+        with open(os.path.join(output, '_checkpoint.json')) as checkpoint_file:
+            flushed = len(json.load(checkpoint_file)['segments'])
+        if not 0 < flushed < segments:
+            failures.append(f"{flushed} of {segments} segments flushed before the outage; "
+                            f"choose --interrupt-after so that only some do")
+
+        try:
+            export_sessions.export(export_args(args, output, segments + 1, args.page_size))
+            failures.append(f"an export with {segments + 1} segments accepted a {segments}-segment checkpoint")
+        except SystemExit:
+            pass
+
+        try:
+            _, _, errors = export_sessions.export(export_args(args, output, segments, args.page_size))
+        except SystemExit as e:
+            failures.append(f"resuming with {segments} segments was refused: {e}")
+            return flushed, failures
+        if errors:
+            failures.append(f"{len(errors)} segments failed when resuming")
+        problem = completeness(args, output)
+        if problem:
+            failures.append(f"the resumed export has {problem}")
+    return flushed, failures
+
+def print_report(report):
+    config = report['config']
+    print(f"Export of {config['sessions']} sessions, {config['backend_latency']:g}ms per scan request, "
+          f"pages of {config['page_size']}")
+    print()
+    print(f"{'segments':>8}{'items/s':>10}{'seconds':>9}{'scans':>7}")
+    for segments, stats in report['runs'].items():
+        print(f"{segments:>8}{stats['items_per_second']:>10.0f}{stats['seconds']:>9.2f}{stats['scan_requests']:>7}")
+    print()
+    print(f"Interrupted after {config['interrupt_after']} scan requests with "
+          f"{report['resume']['segments_flushed']} segments flushed, then resumed")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=200000)
+    parser.add_argument('--segments', type=int, nargs='+', default=[1, 4, 16], help='segment counts to compare')
+    parser.add_argument('--page-size', type=int, default=1000, help='items per scan request')
+    parser.add_argument('--flush-rows', type=int, default=10000, help='rows buffered per segment before writing')
+    parser.add_argument('--backend-latency', type=float, default=50, help='milliseconds added to each scan request')
+    parser.add_argument('--interrupt-after', type=int, default=6, help='scan requests before the outage')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    export_sessions.load_pyarrow('parquet')
+
+    table = SessionsTable(make_sessions(args, random.Random(args.seed)), args.backend_latency / 1000)
+    with mock.patch.object(export_sessions, 'get_table', lambda name: table):
+        runs = {segments: throughput(args, table, segments) for segments in args.segments}
+        flushed, failures = resume_failures(args, table, max(args.segments))
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+        'runs': runs,
+        'resume': {'segments_flushed': flushed, 'failures': failures}
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    for segments, stats in runs.items():
+        if stats['errors']:
+            failures.append(f"{stats['errors']} segments failed in the {segments}-segment export")
+        if stats['problem']:
+            failures.append(f"the {segments}-segment export has {stats['problem']}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""Export the ParkingSessions history to Parquet or Arrow files.
+
+The table is read with a parallel segmented scan, one thread per segment.
+Items are buffered per segment and flushed into files partitioned by the UTC
+day of their EntryTime, so memory stays bounded by --flush-rows per segment.
+After every flush the segment's scan position is saved to a checkpoint in the
+output directory, and running the same command again resumes from it.
+
+    python tools/export_sessions.py export/ --segments 16
+    python tools/export_sessions.py export/ --format arrow --table ParkingSessions
+
+Requires pyarrow.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from tables import get_table
+
+COLUMNS = [
+    ('SessionID', 'string'),
+    ('SiteID', 'string'),
+    ('CarRegistration', 'string'),
+    ('PlateKey', 'string'),
+    ('EntryTime', 'int64'),
+    ('ExitTime', 'int64'),
+    ('DurationHours', 'int64'),
+    ('PaymentDue', 'float64'),
+    ('EntryPhoto', 'string'),
+    ('ExitPhoto', 'string')
+]
+
+class Checkpoint:
+    # Segments only appear once they have flushed, so the segment count the
+    # export was started with is saved on its own, before any segment runs.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.segments = {}
+        self.total_segments = None
+        if os.path.exists(path):
+            with open(path) as checkpoint_file:
+                saved = json.load(checkpoint_file)
+            self.segments = saved['segments']
+            self.total_segments = saved.get('total_segments')
+
+    def start(self, total_segments):
+        if self.total_segments is not None and self.total_segments != total_segments:
+            sys.exit(f"{os.path.dirname(self.path)} holds a checkpoint for {self.total_segments} segments, "
+                     f"not {total_segments}")
+        self.total_segments = total_segments
+        with self.lock:
+            self.write()
+
+    def get(self, segment):
+        return self.segments.get(str(segment), {'last_key': None, 'part': 0, 'items': 0, 'done': False})
+
+    def save(self, segment, state):
+        with self.lock:
+            self.segments[str(segment)] = state
+            self.write()
+
+    def write(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump({'total_segments': self.total_segments, 'segments': self.segments}, checkpoint_file, default=str)
+        os.replace(temp_path, self.path)
+
+class SegmentExporter:
+    def __init__(self, args, segment, checkpoint, pyarrow_modules):
+        self.args = args
+        self.segment = segment
+        self.checkpoint = checkpoint
+        self.pa, self.writer = pyarrow_modules
+        self.schema = self.pa.schema([(name, getattr(self.pa, column_type)()) for name, column_type in COLUMNS])
+        self.state = checkpoint.get(segment)
+        self.buffers = {}
+        self.buffered = 0
+
+    def to_row(self, item):
+        row = {}
+        for name, column_type in COLUMNS:
+            value = item.get(name)
+            if isinstance(value, Decimal):
+                value = float(value) if column_type == 'float64' else int(value)
+            row[name] = value
+        return row
+
+    def flush(self, last_key):
+        # File names come from the checkpointed part number, so a flush that is
+        # repeated after an interruption overwrites its own earlier output.
+        for day, rows in self.buffers.items():
+            directory = os.path.join(self.args.output, f"day={day}")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"part-{self.segment:03d}-{self.state['part']:06d}.{self.args.format}")
+            self.writer(self.pa.Table.from_pylist(rows, schema=self.schema), path)
+
+        self.state = {
+            'last_key': last_key,
+            'part': self.state['part'] + 1,
+            'items': self.state['items'] + self.buffered,
+            'done': last_key is None
+        }
+        self.checkpoint.save(self.segment, self.state)
+        self.buffers = {}
+        self.buffered = 0
+
+    def run(self):
+        if self.state['done']:
+            return 0
+
+        scan_params = {
+            'Segment': self.segment,
+            'TotalSegments': self.args.segments,
+            'Limit': self.args.page_size
+        }
+        if self.state['last_key']:
+            scan_params['ExclusiveStartKey'] = self.state['last_key']
+
+        table = get_table(self.args.table)
+        scanned = 0
+        while True:
+            response = table.scan(**scan_params)
+            for item in response['Items']:
+                day = f"{datetime.fromtimestamp(int(item['EntryTime']), timezone.utc):%Y-%m-%d}"
+                self.buffers.setdefault(day, []).append(self.to_row(item))
+            self.buffered += len(response['Items'])
+            scanned += len(response['Items'])
+
+            last_key = response.get('LastEvaluatedKey')
+            if last_key is None or self.buffered >= self.args.flush_rows:
+                self.flush(last_key)
+            if last_key is None:
+                return scanned
+            scan_params['ExclusiveStartKey'] = last_key
+
+def load_pyarrow(file_format):
+    try:
+        import pyarrow
+        if file_format == 'parquet':
+            import pyarrow.parquet
+            return pyarrow, pyarrow.parquet.write_table
+        import pyarrow.feather
+        return pyarrow, pyarrow.feather.write_feather
+    except ImportError:
+        sys.exit('The session export needs pyarrow: pip install pyarrow')
+
+def export(args):
+    # Returns the items exported by this run, the seconds taken and the
+    # (segment, error) pairs of segments that failed.
+    os.makedirs(args.output, exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(args.output, '_checkpoint.json'))
+    checkpoint.start(args.segments)
+
+    pyarrow_modules = load_pyarrow(args.format)
+    exporters = [SegmentExporter(args, segment, checkpoint, pyarrow_modules) for segment in range(args.segments)]
+    results = [0] * args.segments
+    errors = []
+
+    def run_segment(segment):
+        try:
+            results[segment] = exporters[segment].run()
+        except Exception as e:
+            errors.append((segment, e))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=run_segment, args=(segment,)) for segment in range(args.segments)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(results), time.perf_counter() - started, errors
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output', help='output directory, also holding the checkpoint')
+    parser.add_argument('--table', default=os.environ.get('SESSIONS_TABLE', 'ParkingSessions'))
+    parser.add_argument('--segments', type=int, default=4, help='parallel scan segments')
+    parser.add_argument('--format', choices=['parquet', 'arrow'], default='parquet')
+    parser.add_argument('--page-size', type=int, default=1000, help='items per scan request')
+    parser.add_argument('--flush-rows', type=int, default=50000, help='rows buffered per segment before writing')
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    exported, elapsed, errors = export(args)
+    print(f"Exported {exported} items with {args.segments} segments in {elapsed:.2f}s "
+          f"({exported / elapsed if elapsed else 0:.0f} items/s)")
+    for segment, error in errors:
+        print(f"Segment {segment} failed and will resume from its checkpoint: {error}")
+    if errors:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
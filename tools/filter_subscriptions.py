@@ -0,0 +1,94 @@
+"""Add UserID filter policies to payment notification subscriptions.
+
+Users subscribed before notifications carried a UserID message attribute
+receive every message published to the topic. Each confirmed email
+subscription whose address belongs to a profile in CarParkUsers is given a
+filter policy for that user's ID. Subscriptions that already have a policy
+are left alone. So are addresses with no profile, such as the operator's
+notification_email, which keep receiving every message. Subscriptions still
+pending confirmation cannot be changed and are listed instead.
+
+    python tools/filter_subscriptions.py --topic-arn arn:aws:sns:...:car-park-payment-notifications
+    python tools/filter_subscriptions.py --dry-run
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from clients import get_client
+from plates import PLATE_OWNER_PREFIX
+from tables import get_table
+from userprofile import USERS_TABLE
+
+def user_ids_by_email():
+    users = {}
+    scan_params = {
+        'ProjectionExpression': 'UserID, Email',
+        'FilterExpression': 'attribute_exists(Email)'
+    }
+    while True:
+        response = get_table(USERS_TABLE).scan(**scan_params)
+        for item in response['Items']:
+            # Plate mapping items copy their owner's email.
+            if item['UserID'].startswith(PLATE_OWNER_PREFIX) or not item['Email']:
+                continue
+            users.setdefault(item['Email'].lower(), set()).add(item['UserID'])
+        if 'LastEvaluatedKey' not in response:
+            return users
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def email_subscriptions(topic_arn):
+    params = {'TopicArn': topic_arn}
+    while True:
+        response = get_client('sns').list_subscriptions_by_topic(**params)
+        for subscription in response['Subscriptions']:
+            if subscription['Protocol'] == 'email':
+                yield subscription
+        if not response.get('NextToken'):
+            return
+        params['NextToken'] = response['NextToken']
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--topic-arn', default=os.environ.get('SNS_TOPIC_ARN'), help='defaults to $SNS_TOPIC_ARN')
+    parser.add_argument('--dry-run', action='store_true', help='report what would change without changing it')
+    args = parser.parse_args()
+    if not args.topic_arn:
+        sys.exit('Pass --topic-arn or set SNS_TOPIC_ARN')
+
+    sns = get_client('sns')
+    users = user_ids_by_email()
+    counts = {'filtered': 0, 'already filtered': 0, 'no profile': 0, 'pending': 0}
+    for subscription in email_subscriptions(args.topic_arn):
+        email = subscription['Endpoint']
+        if subscription['SubscriptionArn'] == 'PendingConfirmation':
+            print(f"Pending confirmation, not changed: {email}")
+            counts['pending'] += 1
+            continue
+
+        attributes = sns.get_subscription_attributes(SubscriptionArn=subscription['SubscriptionArn'])['Attributes']
+        if attributes.get('FilterPolicy'):
+            counts['already filtered'] += 1
+            continue
+        user_ids = users.get(email.lower())
+        if not user_ids:
+            print(f"No profile, still receives every message: {email}")
+            counts['no profile'] += 1
+            continue
+
+        print(f"{'Would filter' if args.dry_run else 'Filtering'} {email} to {', '.join(sorted(user_ids))}")
+        if not args.dry_run:
+            sns.set_subscription_attributes(
+                SubscriptionArn=subscription['SubscriptionArn'],
+                AttributeName='FilterPolicy',
+                AttributeValue=json.dumps({'UserID': sorted(user_ids)})
+            )
+        counts['filtered'] += 1
+
+    print(', '.join(f"{count} {name}" for name, count in counts.items()))
+
+if __name__ == '__main__':
+    main()
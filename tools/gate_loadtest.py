@@ -0,0 +1,250 @@
+"""Load test the gate API's barrier decisions.
+
+--cars cars are parked at one site through s3getpassrek's entry path, having
+arrived over the last --max-stay hours. The barriers then ask gateapi for
+--requests exit decisions: mostly for parked plates, some read with a
+confusable character (--misread-rate) and some for plates with no session
+(--unknown-rate). Every decision reads the plate's OpenSessions pointer.
+
+A Lambda container serves one request at a time, so requests are sent one
+after another and decisions/s is what one container sustains.
+
+DynamoDB is moto, so every AWS call is delayed by --backend-latency
+milliseconds to stand for the network. moto's own processing time is also
+included, which makes the figures an upper bound. Every decision
+is checked: parked plates, misread or not, must be let out with the amount
+the tariff gives, and other plates must be referred to an attendant. Then
+--returns of the parked cars leave and come straight back, and each must be
+priced from its second stay. Finally --undirected requests are sent
+without a direction from a gate that is not configured as an entry or exit:
+parked plates must be priced as exits and other plates let in.
+
+The report gives decisions/s, latency percentiles and AWS calls per
+decision. It exits with status 1 when a decision or a return is wrong or
+the p99 is above --max-p99 milliseconds.
+
+    python tools/gate_loadtest.py
+    python tools/gate_loadtest.py --cars 2000 --requests 10000
+    python tools/gate_loadtest.py --backend-latency 0 --json gate.json
+
+Requires moto.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+# Decisions are timed without the metrics line each invocation would print.
+os.environ['METRICS_ENABLED'] = 'false'
+
+import gateapi
+import s3getpassrek
+from clients import get_session
+from sessions import find_open_session
+from simulate import IMAGES_BUCKET, SimulatedClock, create_resources, misread, percentile, random_plate
+from tariff import get_tariff
+
+SITE = 'loadtest'
+NOW = 1767625200  # Monday 5 January 2026, 15:00 UTC
+
+class Backend:
+    # Counts AWS calls during a run and adds network latency before each.
+    def __init__(self, latency):
+        self.latency = latency
+        self.counting = False
+        self.calls = 0
+
+    def before_call(self, **kwargs):
+        if not self.counting:
+            return
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+def park(args, rng):
+    # Returns {plate: entry time} for the cars parked.
+    parked = {}
+    while len(parked) < args.cars:
+        plate = random_plate(rng)
+        entry_time = NOW - int(rng.uniform(300, args.max_stay * 3600))
+        try:
+            s3getpassrek.record_entry(
+                plate, IMAGES_BUCKET, f"uploads/{SITE}/entry/{len(parked)}.jpg", f"{rng.getrandbits(128):032x}",
+                entry_time, SITE, 'entry'
+            )
+        except ClientError as e:
+            if not s3getpassrek.lost_condition_race(e):
+                raise
+            continue
+        parked[plate] = entry_time
+    return parked
+
+def make_requests(args, rng, parked):
+    # (plate sent, plate parked or None) pairs.
+    plates = list(parked)
+    requests = []
+    for _ in range(args.requests):
+        draw = rng.random()
+        if draw < args.unknown_rate:
+            plate = random_plate(rng)
+            requests.append((plate, plate if plate in parked else None))
+            continue
+        plate = rng.choice(plates)
+        if draw < args.unknown_rate + args.misread_rate:
+            requests.append((misread(rng, plate), plate))
+        else:
+            requests.append((plate, plate))
+    return requests
+
+def decide(plate, direction='exit'):
+    body = {'siteId': SITE, 'gateId': 'exit', 'plate': plate}
+    if direction:
+        body['direction'] = direction
+    response = gateapi.main({'body': json.dumps(body)}, None)
+    return json.loads(response['body'])
+
+def check_decision(decision, parked_plate, entry_time, tariff):
+    if parked_plate is None:
+        return decision.get('decision') == 'refer'
+    return (decision.get('decision') == 'open'
+            and decision.get('entryTime') == entry_time
+            and decision.get('amountDue') == str(tariff.price(entry_time, NOW)))
+
+def run(requests, parked, backend):
+    tariff = get_tariff(SITE)
+    latencies = []
+    wrong = 0
+    backend.calls = 0
+    backend.counting = True
+    started = time.perf_counter()
+    for plate, parked_plate in requests:
+        request_started = time.perf_counter()
+        decision = decide(plate)
+        latencies.append(time.perf_counter() - request_started)
+        if not check_decision(decision, parked_plate, parked.get(parked_plate), tariff):
+            wrong += 1
+    elapsed = time.perf_counter() - started
+    backend.counting = False
+    return {
+        'decisions': len(latencies),
+        'wrong_decisions': wrong,
+        'elapsed_seconds': elapsed,
+        'decisions_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p90_ms': percentile(latencies, 0.9) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies) * 1000,
+        'aws_calls_per_decision': backend.calls / max(1, len(latencies))
+    }
+
+def check_returns(args, rng, parked):
+    # Returns the number of returning cars that were priced from their
+    # earlier stay. Each leaves through the gate API, has its exit recorded
+    # by s3getpassrek and arrives again five minutes before NOW.
+    wrong = 0
+    for index, plate in enumerate(rng.sample(sorted(parked), min(args.returns, len(parked)))):
+        decide(plate)
+        pointer = find_open_session(plate, SITE)
+        s3getpassrek.record_exit(pointer, f"uploads/{SITE}/exit/return-{index}.jpg", NOW - 600, 'exit')
+        s3getpassrek.record_entry(
+            plate, IMAGES_BUCKET, f"uploads/{SITE}/entry/return-{index}.jpg", f"{rng.getrandbits(128):032x}",
+            NOW - 300, SITE, 'entry'
+        )
+        if decide(plate).get('entryTime') != NOW - 300:
+            wrong += 1
+    return wrong
+
+def check_undirected(args, rng, parked):
+    # Returns the number of requests without a direction decided wrongly.
+    # The gate is not in EXIT_GATES, so a parked plate must be recognised as
+    # an exit from its open session.
+    tariff = get_tariff(SITE)
+    wrong = 0
+    for plate in rng.sample(sorted(parked), min(args.undirected, len(parked))):
+        decision = decide(plate, direction=None)
+        if decision.get('direction') != 'exit' or not check_decision(decision, plate, parked[plate], tariff):
+            wrong += 1
+    for _ in range(args.undirected):
+        plate = random_plate(rng)
+        if plate in parked:
+            continue
+        decision = decide(plate, direction=None)
+        if decision.get('direction') != 'entry' or decision.get('decision') != 'open':
+            wrong += 1
+    return wrong
+
+def print_report(report):
+    config = report['config']
+    stats = report['decisions']
+    print(f"{config['requests']} exit decisions for {config['cars']} parked cars, "
+          f"{config['backend_latency']:g}ms added to each AWS call")
+    print()
+    print(f"{'per s':>9}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}{'AWS/call':>10}{'wrong':>7}")
+    print(f"{stats['decisions_per_second']:>9.0f}{stats['p50_ms']:>9.2f}{stats['p90_ms']:>9.2f}"
+          f"{stats['p99_ms']:>9.2f}{stats['max_ms']:>9.2f}"
+          f"{stats['aws_calls_per_decision']:>10.2f}{stats['wrong_decisions']:>7}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cars', type=int, default=500, help='parked cars')
+    parser.add_argument('--requests', type=int, default=3000, help='decisions per run')
+    parser.add_argument('--max-stay', type=float, default=8, help='longest stay so far in hours')
+    parser.add_argument('--misread-rate', type=float, default=0.02, help='share of plates read with a confusable character')
+    parser.add_argument('--unknown-rate', type=float, default=0.05, help='share of plates with no session')
+    parser.add_argument('--backend-latency', type=float, default=5, help='milliseconds added to each AWS call')
+    parser.add_argument('--returns', type=int, default=20, help='parked cars that leave and come back')
+    parser.add_argument('--undirected', type=int, default=20, help='requests without a direction for parked and other plates each')
+    parser.add_argument('--max-p99', type=float, default=100, help='p99 in milliseconds the decisions must stay within')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    try:
+        from moto import mock_aws
+    except ImportError:
+        sys.exit('The load test needs moto: pip install moto')
+
+    rng = random.Random(args.seed)
+    backend = Backend(args.backend_latency / 1000)
+    with mock_aws(), mock.patch.object(gateapi, 'time', SimulatedClock(NOW)):
+        get_session().register('before-call', backend.before_call)
+        create_resources()
+        parked = park(args, rng)
+        requests = make_requests(args, rng, parked)
+        report = {
+            'config': {key: value for key, value in vars(args).items() if key != 'json'},
+            'decisions': run(requests, parked, backend)
+        }
+        report['wrong_undirected'] = check_undirected(args, rng, parked)
+        report['wrong_returns'] = check_returns(args, rng, parked)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    failures = []
+    stats = report['decisions']
+    if stats['wrong_decisions']:
+        failures.append(f"{stats['wrong_decisions']} wrong decisions")
+    if report['wrong_returns']:
+        failures.append(f"{report['wrong_returns']} of {min(args.returns, args.cars)} returning cars priced from their last stay")
+    if report['wrong_undirected']:
+        failures.append(f"{report['wrong_undirected']} wrong decisions for requests without a direction")
+    if stats['p99_ms'] > args.max_p99:
+        failures.append(f"p99 of {stats['p99_ms']:.1f}ms is above {args.max_p99:g}ms")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""Compare the latest-session lookup of regplateapi with a table scan.
+
+ParkingSessions is filled to each of --sessions sessions, made by a pool of
+plates that come back time and again, in an in-memory stand-in that keeps
+PlateEntryTimeIndex and CarRegistrationIndex sorted as DynamoDB does
+(tools/standin.py). --legacy-rate of plates only have sessions written
+before PlateKey existed, and --unknown-rate of lookups are for plates never
+seen; both fall back to the CarRegistrationIndex query.
+
+At each size, --lookups plates are looked up with
+regplateapi.get_latest_session, and --scan-lookups with a paginated scan
+that keeps the latest matching session, as regplateapi did before the
+index. Every request waits --latency milliseconds. The report gives latency
+percentiles, requests and items read per lookup for both. Items read are
+what DynamoDB charges read capacity for.
+
+It exits with status 1 when the two disagree on a plate's latest session,
+when an indexed lookup of a plate with PlateKey takes more than one request,
+or when the median indexed lookup on the largest table is more than
+--max-slowdown times that on the smallest.
+
+    python tools/lookup_benchmark.py
+    python tools/lookup_benchmark.py --sessions 10000 100000 1000000 --latency 5 --scan-lookups 3
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from simulate import START_TIME, percentile, random_plate
+from standin import StandInTable
+
+from plates import normalise_plate
+from regplateapi import get_latest_session
+
+def make_sessions(args, rng, count):
+    # Yields sessions in entry order. Each plate makes about
+    # --visits-per-plate visits over the table's lifetime.
+    plates = [random_plate(rng) for _ in range(max(1, count // args.visits_per_plate))]
+    legacy = set(rng.sample(plates, int(len(plates) * args.legacy_rate)))
+    entry_time = START_TIME
+    for i in range(count):
+        plate = rng.choice(plates)
+        entry_time += rng.randrange(0, 120)
+        session = {
+            'SessionID': f"session-{i}",
+            'SiteID': 'default',
+            'CarRegistration': plate,
+            'EntryTime': entry_time,
+            'ExitTime': entry_time + rng.randrange(600, 8 * 3600)
+        }
+        if plate not in legacy:
+            session['PlateKey'] = normalise_plate(plate)
+        yield plate, session
+
+def scan_latest(table, reg_plate):
+    # A scan of every page, keeping the newest session of the plate.
+    plate_key = normalise_plate(reg_plate)
+    scan_params = {}
+    latest = None
+    while True:
+        response = table.scan(**scan_params)
+        for entry in response['Items']:
+            if normalise_plate(entry['CarRegistration']) == plate_key:
+                if latest is None or entry['EntryTime'] > latest['EntryTime']:
+                    latest = entry
+        if 'LastEvaluatedKey' not in response:
+            return latest
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def timed(table, lookup, plate):
+    table.reset_counts()
+    started = time.perf_counter()
+    session = lookup(table, plate)
+    return session, time.perf_counter() - started, table.requests, table.items_read
+
+def summarise(samples):
+    latencies = [elapsed for elapsed, _, _ in samples]
+    return {
+        'lookups': len(samples),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'requests': sum(requests for _, requests, _ in samples) / max(1, len(samples)),
+        'items_read': sum(items for _, _, items in samples) / max(1, len(samples))
+    }
+
+def run(args):
+    rng = random.Random(args.seed)
+    table = StandInTable('SessionID', {
+        'PlateEntryTimeIndex': ('PlateKey', 'EntryTime'),
+        'CarRegistrationIndex': ('CarRegistration', None)
+    }, latency=args.latency / 1000)
+    sessions = make_sessions(args, rng, max(args.sessions))
+
+    results = {}
+    failures = []
+    plates = []
+    for size in sorted(args.sessions):
+        while len(table.items) < size:
+            plate, session = next(sessions)
+            table.put(session)
+            plates.append(plate)
+
+        def pick():
+            if rng.random() < args.unknown_rate:
+                return random_plate(rng)
+            return rng.choice(plates)
+
+        indexed = []
+        for _ in range(args.lookups):
+            plate = pick()
+            session, elapsed, requests, items = timed(table, get_latest_session, plate)
+            indexed.append((elapsed, requests, items))
+            if session is not None and 'PlateKey' in session and requests != 1:
+                failures.append(f"looking up {plate} among {size} sessions took {requests} requests")
+
+        scanned = []
+        for _ in range(args.scan_lookups):
+            plate = pick()
+            expected, elapsed, requests, items = timed(table, scan_latest, plate)
+            scanned.append((elapsed, requests, items))
+            session = get_latest_session(table, plate)
+            if (session and session['SessionID']) != (expected and expected['SessionID']):
+                failures.append(f"{plate}'s latest session among {size} is {expected and expected['SessionID']} "
+                                f"by scan and {session and session['SessionID']} by index")
+
+        results[size] = {'index': summarise(indexed), 'scan': summarise(scanned)}
+    return results, failures
+
+def print_report(report):
+    config = report['config']
+    print(f"Latest session for a plate, {config['latency']:g}ms per request, "
+          f"{config['lookups']} indexed and {config['scan_lookups']} scanned lookups per size")
+    print()
+    print(f"{'sessions':>9}{'method':>7}{'p50 ms':>10}{'p99 ms':>10}{'requests':>10}{'items read':>12}")
+    for size, methods in report['runs'].items():
+        for method, stats in methods.items():
+            print(f"{size:>9}{method:>7}{stats['p50_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+                  f"{stats['requests']:>10.1f}{stats['items_read']:>12.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, nargs='+', default=[10000, 100000, 1000000], help='table sizes')
+    parser.add_argument('--visits-per-plate', type=int, default=10)
+    parser.add_argument('--legacy-rate', type=float, default=0.05, help='share of plates with sessions from before PlateKey')
+    parser.add_argument('--unknown-rate', type=float, default=0.1, help='share of lookups for plates never seen')
+    parser.add_argument('--lookups', type=int, default=1000, help='indexed lookups per size')
+    parser.add_argument('--scan-lookups', type=int, default=3, help='scanned lookups per size')
+    parser.add_argument('--latency', type=float, default=5, help='milliseconds per request')
+    parser.add_argument('--max-slowdown', type=float, default=2.0,
+                        help='largest allowed ratio of the median indexed lookup on the largest table to the smallest')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    runs, failures = run(args)
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+        'runs': runs
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    smallest, largest = runs[min(args.sessions)]['index'], runs[max(args.sessions)]['index']
+    if largest['p50_ms'] > args.max_slowdown * smallest['p50_ms']:
+        failures.append(f"the median indexed lookup took {largest['p50_ms']:.2f}ms with {max(args.sessions)} sessions "
+                        f"and {smallest['p50_ms']:.2f}ms with {min(args.sessions)}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""Measure how well noisy plate reads find their open session, and how fast.
+
+OpenSessions is filled with --open-sessions pointers, as s3getpassrek writes
+them at entry, in an in-memory stand-in that keeps PlateSkeletonIndex as
+DynamoDB does (tools/standin.py). --closed-rate as many closed pointers are
+added, as left by cars that have gone, and --lookalike-rate of parked cars
+share the car park with a plate differing only in characters OCR confuses,
+whose misreads cannot always be told apart. Each size is then read --reads
+times:
+
+    exact      the text read at entry, at an exit
+    format     the same characters with spacing and case changed, at an exit
+    misread    one or two characters swapped for ones OCR confuses them with,
+               at an exit
+    unknown    a plate with no session, at an exit, which must not match one
+    lookalike  a new car whose plate is a misread of a parked car's,
+               arriving at an entry, which must not match the parked car
+
+Every read is looked up with sessions.find_open_session, with the skeleton
+fallback at exits only, as s3getpassrek does at a known entry gate, and, for
+comparison, by its stripped text alone, as s3getpassrek did before plates
+were normalised. The report gives the share of reads matched to the right
+session by each, and the latency, requests and items read per lookup.
+
+It exits with status 1 when fewer than --min-accuracy of the reads of
+parked cars find their session, when an unknown plate or a lookalike matches
+an open session, or when a lookup takes more than two requests.
+
+    python tools/match_benchmark.py
+    python tools/match_benchmark.py --open-sessions 1000 100000 --reads 20000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from simulate import START_TIME, misread, percentile, random_plate
+from standin import StandInTable
+
+import sessions
+from plates import normalise_plate, plate_skeleton
+from sites import DEFAULT_SITE, site_key
+
+KINDS = ('exact', 'format', 'misread', 'unknown', 'lookalike')
+# Reads of cars that have no session.
+NEW_CARS = ('unknown', 'lookalike')
+
+def pointer(plate, index, closed):
+    item = {
+        'PlateKey': site_key(DEFAULT_SITE, normalise_plate(plate)),
+        'PlateSkeleton': site_key(DEFAULT_SITE, plate_skeleton(plate)),
+        'SessionID': f"session-{index}",
+        'SiteID': DEFAULT_SITE,
+        'CarRegistration': plate,
+        'EntryTime': START_TIME + index
+    }
+    if closed:
+        item['ExitTime'] = START_TIME + index + 3600
+    return item
+
+def reformat(rng, plate):
+    compact = plate.replace(' ', '')
+    spaced = rng.choice([compact, plate, f" {plate} ", compact[:2] + ' ' + compact[2:]])
+    return spaced.lower() if rng.random() < 0.5 else spaced
+
+def noisy_read(rng, kind, plate):
+    if kind == 'exact':
+        return plate
+    if kind == 'format':
+        return reformat(rng, plate)
+    text = misread(rng, plate)
+    if rng.random() < 0.5:
+        text = misread(rng, text)
+    return text
+
+def run(args):
+    rng = random.Random(args.seed)
+    table = StandInTable('PlateKey', {'PlateSkeletonIndex': ('PlateSkeleton', None)}, latency=args.latency / 1000)
+    by_text = {}
+    open_plates = []
+    seen = set()
+
+    def new_plate():
+        while True:
+            plate = random_plate(rng)
+            if normalise_plate(plate) not in seen:
+                seen.add(normalise_plate(plate))
+                return plate
+
+    results = {}
+    failures = []
+    with mock.patch.object(sessions, 'get_table', lambda name: table):
+        for size in sorted(args.open_sessions):
+            while len(open_plates) < size:
+                plate = new_plate()
+                parked = [plate]
+                lookalike = misread(rng, plate)
+                if rng.random() < args.lookalike_rate and normalise_plate(lookalike) not in seen:
+                    seen.add(normalise_plate(lookalike))
+                    parked.append(lookalike)
+                for parked_plate in parked:
+                    item = pointer(parked_plate, len(table.items), closed=False)
+                    table.put(item)
+                    by_text[parked_plate] = item
+                    open_plates.append((parked_plate, item['SessionID']))
+                if rng.random() < args.closed_rate:
+                    table.put(pointer(new_plate(), len(table.items), closed=True))
+
+            reads = {kind: {'reads': 0, 'matched': 0, 'matched_by_text': 0} for kind in KINDS}
+            samples = []
+            requests = items_read = 0
+            for _ in range(args.reads):
+                kind = rng.choice(KINDS)
+                if kind == 'unknown':
+                    plate, session_id = new_plate(), None
+                    text = noisy_read(rng, kind, plate)
+                elif kind == 'lookalike':
+                    text, session_id = misread(rng, rng.choice(open_plates)[0]), None
+                    while normalise_plate(text) in seen:
+                        text = misread(rng, rng.choice(open_plates)[0])
+                else:
+                    plate, session_id = rng.choice(open_plates)
+                    text = noisy_read(rng, kind, plate)
+                    while kind == 'misread' and text == plate:
+                        plate, session_id = rng.choice(open_plates)
+                        text = noisy_read(rng, kind, plate)
+
+                table.reset_counts()
+                started = time.perf_counter()
+                found = sessions.find_open_session(text, DEFAULT_SITE, fuzzy=kind != 'lookalike')
+                samples.append(time.perf_counter() - started)
+                requests += table.requests
+                items_read += table.items_read
+                if table.requests > 2:
+                    failures.append(f"looking up {text!r} among {size} open sessions took {table.requests} requests")
+
+                found_id = found['SessionID'] if found and 'ExitTime' not in found else None
+                by_text_id = by_text.get(text.strip(), {}).get('SessionID')
+                reads[kind]['reads'] += 1
+                reads[kind]['matched'] += found_id == session_id
+                reads[kind]['matched_by_text'] += by_text_id == session_id
+                if kind in NEW_CARS and found_id is not None:
+                    failures.append(f"{text!r}, which has no session, matched {found_id} among {size} open sessions")
+
+            parked = [stats for kind, stats in reads.items() if kind not in NEW_CARS]
+            accuracy = sum(stats['matched'] for stats in parked) / max(1, sum(stats['reads'] for stats in parked))
+            if accuracy < args.min_accuracy:
+                failures.append(f"{accuracy:.2%} of reads of parked cars found their session among {size}")
+            results[size] = {
+                'reads': reads,
+                'accuracy': accuracy,
+                'p50_us': percentile(samples, 0.5) * 1e6,
+                'p99_us': percentile(samples, 0.99) * 1e6,
+                'requests': requests / args.reads,
+                'items_read': items_read / args.reads
+            }
+    return results, failures
+
+def print_report(report):
+    config = report['config']
+    print(f"Open-session lookups of noisy reads, {config['reads']} reads per size, "
+          f"{config['latency']:g}ms per request")
+    for size, result in report['runs'].items():
+        print()
+        print(f"{size} open sessions: p50 {result['p50_us']:.0f}us, p99 {result['p99_us']:.0f}us, "
+              f"{result['requests']:.2f} requests and {result['items_read']:.2f} items read per lookup")
+        print(f"  {'read':<9}{'reads':>7}{'matched':>9}{'by text':>9}")
+        for kind, stats in result['reads'].items():
+            total = max(1, stats['reads'])
+            print(f"  {kind:<9}{stats['reads']:>7}{stats['matched'] / total:>9.1%}{stats['matched_by_text'] / total:>9.1%}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--open-sessions', type=int, nargs='+', default=[1000, 10000, 100000], help='table sizes')
+    parser.add_argument('--closed-rate', type=float, default=0.5, help='closed pointers per open one')
+    parser.add_argument('--lookalike-rate', type=float, default=0.01,
+                        help='share of parked cars with a lookalike plate also parked')
+    parser.add_argument('--reads', type=int, default=10000, help='reads looked up per size')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds per request')
+    parser.add_argument('--min-accuracy', type=float, default=0.99,
+                        help='smallest allowed share of reads of parked cars that find their session')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    runs, failures = run(args)
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+        'runs': runs
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,414 @@
+"""Count what payment notifications cost per 1,000 ended sessions in each mode.
+
+--sessions sessions end over --hours hours, shared between --users
+registered drivers. Visits are skewed so that a few drivers make many
+short visits, and --unregistered-rate of sessions belong to plates with no
+profile. The sessions stream is delivered to notifications.main in batches
+of 100, as its event source mapping does. --redelivery-rate of batches are
+delivered twice, as Lambda does after a failed or timed-out invocation.
+--update-rate of sessions are updated again after they close.
+
+Deliveries also fail, and are retried up to --stream-retries times as the
+stream retries a failed batch: --timeout-rate of invocations time out
+after claiming their sessions and before publishing, and --publish-failure-rate
+of PublishBatch calls fail. A session whose publish did not go through must
+still be notified once its record is retried. The retry of an invocation
+that timed out comes after its claims' lease has ended, as it does once
+Lambda has stopped the invocation.
+
+Two deliveries of one batch are also overlapped in immediate mode: the
+second runs from start to finish while the first is publishing, and each
+session must be published once. A registered plate read in three spellings
+in one batch must resolve to its driver with a single lookup and a single
+cache entry.
+
+The same stream is replayed in three modes:
+
+    no-dedupe  one message per ended session, with nothing to stop a
+               redelivery sending it again
+    immediate  one message per ended session, claimed in NotificationLog first
+    digest     sessions queue in NotificationLog and send_digests, run once
+               per window, sends each driver one summary
+
+Drivers subscribe through userprofile, with a filter policy on their
+UserID. Emails delivered are counted for those subscriptions and for the
+unfiltered subscriptions every driver had before.
+
+The report gives, per 1,000 sessions, PublishBatch calls, messages
+published, emails delivered and the DynamoDB writes spent on
+deduplication. It also gives the most emails any driver received. It exits
+with status 1 when a deduplicating mode notifies a session twice or misses
+one, when overlapping deliveries both publish a session, or when spellings
+of one plate are looked up separately.
+
+    python tools/notification_benchmark.py
+    python tools/notification_benchmark.py --sessions 10000 --users 2000 --redelivery-rate 0.2
+
+Requires moto.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+os.environ['METRICS_ENABLED'] = 'false'
+
+# simulate sets the topic ARN the handlers read at import time.
+from simulate import START_TIME, SimulatedClock, create_resources, random_plate
+
+import notifications
+import userprofile
+from cache import TTLCache
+from clients import get_client, get_session
+
+STREAM_BATCH_SIZE = 100  # as in terraform/main.tf
+STREAM_RETRIES = 5  # maximum_retry_attempts in terraform/main.tf
+MODES = ('no-dedupe', 'immediate', 'digest')
+LOG_WRITES = ('dynamodb.PutItem', 'dynamodb.UpdateItem', 'dynamodb.DeleteItem')
+
+class InvocationTimeout(Exception):
+    pass
+
+class Recorder:
+    # Counts AWS calls and keeps every published message.
+    def __init__(self):
+        self.calls = {}
+        self.messages = []
+
+    def before_call(self, model, **kwargs):
+        name = f"{model.service_model.service_name}.{model.name}"
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def before_publish_batch(self, params, **kwargs):
+        self.messages.extend(params['PublishBatchRequestEntries'])
+
+def register_drivers(args, rng):
+    # Returns the plates of registered drivers, by user ID.
+    drivers = {}
+    for i in range(args.users):
+        user_id = f"user-{i}"
+        plate = random_plate(rng)
+        userprofile.main({
+            'requestContext': {
+                'http': {'method': 'POST'},
+                'authorizer': {'jwt': {'claims': {'sub': user_id, 'email': f"driver{i}@example.com"}}}
+            },
+            'rawPath': '/profile',
+            'body': json.dumps({'name': f"Driver {i}", 'regPlates': [plate]})
+        }, None)
+        drivers[user_id] = plate
+    return drivers
+
+def stream_records(args, rng, drivers):
+    # Returns the stream records in order, and {session ID: owner} for the
+    # sessions of registered drivers.
+    plates = list(drivers.values())
+    owners = {plate: user_id for user_id, plate in drivers.items()}
+    # Visit counts follow a power law, so a few drivers make most visits.
+    weights = [rng.paretovariate(1.2) for _ in plates]
+    end_time = START_TIME + int(args.hours * 3600)
+
+    sessions = []
+    for i in range(args.sessions):
+        if rng.random() < args.unregistered_rate:
+            plate = random_plate(rng)
+        else:
+            plate = rng.choices(plates, weights)[0]
+        exit_time = rng.randrange(START_TIME + 1800, end_time)
+        entry_time = exit_time - rng.randrange(300, 3 * 3600)
+        sessions.append((exit_time, f"session-{i}", plate, entry_time))
+    sessions.sort()
+
+    records = []
+    expected = {}
+    for exit_time, session_id, plate, entry_time in sessions:
+        open_image = {
+            'SessionID': {'S': session_id},
+            'CarRegistration': {'S': plate},
+            'EntryTime': {'N': str(entry_time)}
+        }
+        closed_image = dict(open_image, ExitTime={'N': str(exit_time)}, PaymentDue={'N': str(2 * -(-(exit_time - entry_time) // 3600))})
+        records.append({'eventName': 'MODIFY', 'dynamodb': {'OldImage': open_image, 'NewImage': closed_image}})
+        if rng.random() < args.update_rate:
+            updated_image = dict(closed_image, ExitGate={'S': 'gate-1'})
+            records.append({'eventName': 'MODIFY', 'dynamodb': {'OldImage': closed_image, 'NewImage': updated_image}})
+        if plate in owners:
+            expected[session_id] = owners[plate]
+    for sequence_number, record in enumerate(records):
+        record['dynamodb']['SequenceNumber'] = str(sequence_number)
+    return records, expected
+
+def create_log_table(name):
+    get_client('dynamodb').create_table(
+        TableName=name,
+        BillingMode='PAY_PER_REQUEST',
+        AttributeDefinitions=[
+            {'AttributeName': 'SessionID', 'AttributeType': 'S'},
+            {'AttributeName': 'DigestWindow', 'AttributeType': 'N'},
+            {'AttributeName': 'UserID', 'AttributeType': 'S'}
+        ],
+        KeySchema=[{'AttributeName': 'SessionID', 'KeyType': 'HASH'}],
+        GlobalSecondaryIndexes=[{
+            'IndexName': 'DigestWindowIndex',
+            'KeySchema': [
+                {'AttributeName': 'DigestWindow', 'KeyType': 'HASH'},
+                {'AttributeName': 'UserID', 'KeyType': 'RANGE'}
+            ],
+            'Projection': {'ProjectionType': 'ALL'}
+        }]
+    )
+
+def subscriptions():
+    # {subscription ARN: user IDs its filter policy accepts}.
+    sns = get_client('sns')
+    policies = {}
+    for subscription in sns.list_subscriptions_by_topic(TopicArn=notifications.SNS_TOPIC_ARN)['Subscriptions']:
+        attributes = sns.get_subscription_attributes(SubscriptionArn=subscription['SubscriptionArn'])['Attributes']
+        policies[subscription['SubscriptionArn']] = set(json.loads(attributes.get('FilterPolicy', '{}')).get('UserID', []))
+    return policies
+
+def deliver(batch, retries, clock):
+    # Delivers a stream batch, and again while the invocation fails or
+    # reports failed records, as the event source mapping does. Returns the
+    # number of retries.
+    for attempt in range(retries + 1):
+        try:
+            response = notifications.main({'Records': batch}, None)
+            if not response.get('batchItemFailures'):
+                return attempt
+        except InvocationTimeout:
+            clock.now += notifications.CLAIM_LEASE
+    return retries
+
+def run(mode, args, rng, records, expected, recorder):
+    clock = SimulatedClock(START_TIME)
+    failure_rng = random.Random(args.seed)
+    claim_sessions = notifications.claim_sessions
+
+    def claim_then_time_out(pending, owner, executor):
+        claimed = claim_sessions(pending, owner, executor)
+        if failure_rng.random() < args.timeout_rate:
+            raise InvocationTimeout('timed out after claiming')
+        return claimed
+
+    def fail_publish(**kwargs):
+        if failure_rng.random() < args.publish_failure_rate:
+            raise RuntimeError('Simulated publish failure')
+
+    patches = [
+        mock.patch.object(notifications, 'NOTIFICATIONS_TABLE', f"NotificationLog-{mode}"),
+        mock.patch.object(notifications, 'DEDUPE_NOTIFICATIONS', mode != 'no-dedupe'),
+        mock.patch.object(notifications, 'NOTIFICATION_MODE', 'digest' if mode == 'digest' else 'immediate'),
+        mock.patch.object(notifications, 'DIGEST_WINDOW', args.digest_window),
+        mock.patch.object(notifications, 'user_cache', TTLCache(max_size=2048, ttl=300)),
+        mock.patch.object(notifications, 'time', clock),
+        mock.patch.object(notifications, 'claim_sessions', claim_then_time_out)
+    ]
+    with contextlib.ExitStack() as stack, contextlib.redirect_stdout(io.StringIO()):
+        for patch in patches:
+            stack.enter_context(patch)
+        create_log_table(notifications.NOTIFICATIONS_TABLE)
+        recorder.calls = {}
+        recorder.messages = []
+        session = get_session()
+        session.register('before-call.sns.PublishBatch', fail_publish)
+        stack.callback(session.unregister, 'before-call.sns.PublishBatch', fail_publish)
+        retries = 0
+
+        # The digest sender runs at the start of every window, and the
+        # stream is delivered as sessions end.
+        next_digest = (START_TIME // args.digest_window + 1) * args.digest_window
+        for start in range(0, len(records), STREAM_BATCH_SIZE):
+            batch = records[start:start + STREAM_BATCH_SIZE]
+            clock.now = int(batch[-1]['dynamodb']['NewImage']['ExitTime']['N'])
+            while mode == 'digest' and clock.now >= next_digest:
+                with mock.patch.object(clock, 'now', next_digest):
+                    notifications.send_digests({}, None)
+                next_digest += args.digest_window
+            deliveries = 2 if rng.random() < args.redelivery_rate else 1
+            for _ in range(deliveries):
+                retries += deliver(batch, args.stream_retries, clock)
+        if mode == 'digest':
+            # Digests that failed are sent by the next run; the last window
+            # is sent until it goes through.
+            clock.now = next_digest
+            for _ in range(args.stream_retries + 1):
+                if notifications.send_digests({}, None)['statusCode'] == 200:
+                    break
+
+    notified = {}
+    for entry in recorder.messages:
+        message = json.loads(entry['Message'])
+        for session in message.get('sessions', [message]):
+            notified[session['sessionId']] = notified.get(session['sessionId'], 0) + 1
+
+    policies = subscriptions()
+    emails = {}
+    for entry in recorder.messages:
+        user_id = entry['MessageAttributes']['UserID']['StringValue']
+        emails[user_id] = emails.get(user_id, 0) + 1
+    filtered = sum(1 for entry in recorder.messages for accepted in policies.values()
+                   if entry['MessageAttributes']['UserID']['StringValue'] in accepted)
+
+    per_thousand = 1000 / max(1, args.sessions)
+    return {
+        'publish_calls': recorder.calls.get('sns.PublishBatch', 0) * per_thousand,
+        'messages': len(recorder.messages) * per_thousand,
+        'emails_filtered': filtered * per_thousand,
+        'emails_unfiltered': len(recorder.messages) * len(policies) * per_thousand,
+        'log_writes': sum(recorder.calls.get(name, 0) for name in LOG_WRITES) * per_thousand,
+        'most_emails_to_one_driver': max(emails.values(), default=0),
+        'sessions_notified_twice': sum(1 for times in notified.values() if times > 1),
+        'sessions_missed': sum(1 for session_id in expected if session_id not in notified),
+        'retries': retries * per_thousand
+    }
+
+def overlap_failures(records, recorder):
+    # The second delivery must publish nothing and fail the records it could
+    # not claim, and its retry once the first has finished must find them
+    # sent.
+    batch = records[:STREAM_BATCH_SIZE]
+    clock = SimulatedClock(START_TIME)
+    publish_entries = notifications.publish_entries
+    overlapping = threading.Lock()
+    overlapped = []
+
+    def publish_during_redelivery(entries):
+        if overlapping.acquire(blocking=False):
+            overlapped.append(notifications.main({'Records': batch}, None))
+        return publish_entries(entries)
+
+    patches = [
+        mock.patch.object(notifications, 'NOTIFICATIONS_TABLE', 'NotificationLog-overlap'),
+        mock.patch.object(notifications, 'DEDUPE_NOTIFICATIONS', True),
+        mock.patch.object(notifications, 'NOTIFICATION_MODE', 'immediate'),
+        mock.patch.object(notifications, 'user_cache', TTLCache(max_size=2048, ttl=300)),
+        mock.patch.object(notifications, 'time', clock),
+        mock.patch.object(notifications, 'publish_entries', publish_during_redelivery)
+    ]
+    with contextlib.ExitStack() as stack, contextlib.redirect_stdout(io.StringIO()):
+        for patch in patches:
+            stack.enter_context(patch)
+        create_log_table(notifications.NOTIFICATIONS_TABLE)
+        recorder.messages = []
+        notifications.main({'Records': batch}, None)
+        published = [json.loads(entry['Message'])['sessionId'] for entry in recorder.messages]
+        retry = notifications.main({'Records': batch}, None)
+
+    failures = []
+    twice = len(published) - len(set(published))
+    if twice:
+        failures.append(f"{twice} sessions published by both of two overlapping deliveries")
+    if not overlapped or not overlapped[0]['batchItemFailures']:
+        failures.append("the overlapping delivery did not fail the records it could not claim")
+    if retry['batchItemFailures'] or len(recorder.messages) != len(published):
+        failures.append("the overlapping delivery's retry did not find its sessions sent")
+    return failures
+
+def spelling_failures(drivers):
+    user_id, plate = next(iter(drivers.items()))
+    spellings = {plate, plate.replace(' ', ''), plate.lower()}
+    looked_up = []
+    get_plate_owners = notifications.get_plate_owners
+
+    def recording_get_plate_owners(keys):
+        looked_up.extend(keys)
+        return get_plate_owners(keys)
+
+    cache = TTLCache(max_size=2048, ttl=300)
+    with mock.patch.object(notifications, 'user_cache', cache), \
+            mock.patch.object(notifications, 'get_plate_owners', recording_get_plate_owners), \
+            ThreadPoolExecutor() as executor:
+        users, failed = notifications.get_users_by_car_regs(spellings, executor)
+
+    failures = []
+    if len(looked_up) != 1 or cache.stats()['size'] != 1:
+        failures.append(f"{len(spellings)} spellings of {plate} took {len(looked_up)} lookups "
+                        f"and {cache.stats()['size']} cache entries")
+    for spelling in spellings:
+        if spelling in failed or notifications.user_id_of(users.get(spelling) or {'UserID': None}) != user_id:
+            failures.append(f"{spelling!r} did not resolve to {user_id}")
+    return failures
+
+def print_report(report):
+    config = report['config']
+    print(f"{config['sessions']} sessions ending over {config['hours']:g}h for {config['users']} drivers, "
+          f"{config['redelivery_rate']:.0%} of batches redelivered, digest window {config['digest_window'] // 60} minutes")
+    print(f"{config['timeout_rate']:.0%} of invocations time out before publishing, "
+          f"{config['publish_failure_rate']:.0%} of publishes fail")
+    print()
+    print("per 1,000 sessions")
+    print(f"{'mode':<12}{'publishes':>11}{'messages':>10}{'emails':>9}{'unfiltered':>12}{'log writes':>12}"
+          f"{'most/driver':>13}{'twice':>7}{'missed':>8}{'retries':>9}")
+    for mode, stats in report['modes'].items():
+        print(f"{mode:<12}{stats['publish_calls']:>11.1f}{stats['messages']:>10.1f}{stats['emails_filtered']:>9.1f}"
+              f"{stats['emails_unfiltered']:>12.0f}{stats['log_writes']:>12.1f}{stats['most_emails_to_one_driver']:>13}"
+              f"{stats['sessions_notified_twice']:>7}{stats['sessions_missed']:>8}{stats['retries']:>9.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=100, help='registered drivers')
+    parser.add_argument('--hours', type=float, default=24, help='time over which sessions end')
+    parser.add_argument('--unregistered-rate', type=float, default=0.3, help='share of sessions with no profile')
+    parser.add_argument('--redelivery-rate', type=float, default=0.1, help='share of stream batches delivered twice')
+    parser.add_argument('--update-rate', type=float, default=0.05, help='share of sessions updated after closing')
+    parser.add_argument('--timeout-rate', type=float, default=0.05,
+                        help='share of invocations that time out between claiming and publishing')
+    parser.add_argument('--publish-failure-rate', type=float, default=0.05, help='share of PublishBatch calls that fail')
+    parser.add_argument('--stream-retries', type=int, default=STREAM_RETRIES, help='retries of a failed batch')
+    parser.add_argument('--digest-window', type=int, default=notifications.DIGEST_WINDOW, help='seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    try:
+        from moto import mock_aws
+    except ImportError:
+        sys.exit('The benchmark needs moto: pip install moto')
+
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+    with mock_aws():
+        session = get_session()
+        session.register('before-call', recorder.before_call)
+        session.register('before-parameter-build.sns.PublishBatch', recorder.before_publish_batch)
+        create_resources()
+        drivers = register_drivers(args, rng)
+        records, expected = stream_records(args, rng, drivers)
+        report = {
+            'config': {key: value for key, value in vars(args).items() if key != 'json'},
+            'modes': {mode: run(mode, args, random.Random(args.seed), records, expected, recorder) for mode in MODES}
+        }
+        overlap = overlap_failures(records, recorder)
+        spelling = spelling_failures(drivers)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    failures = []
+    for mode in ('immediate', 'digest'):
+        stats = report['modes'][mode]
+        if stats['sessions_notified_twice'] or stats['sessions_missed']:
+            failures.append(f"{mode} notified {stats['sessions_notified_twice']} sessions twice "
+                            f"and missed {stats['sessions_missed']}")
+    failures.extend(overlap)
+    failures.extend(spelling)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
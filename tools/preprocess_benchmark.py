@@ -0,0 +1,302 @@
+"""Measure what plate-region preprocessing saves before OCR.
+
+Without preprocessing the recognition backend reads every full-resolution
+frame from S3. With it the Lambda streams the frame, finds the plate with the
+edge heuristic in lambda/imaging.py and sends a small crop inline. For each
+frame the benchmark reports the bytes moved both ways, the time the stage
+adds, whether the crop contains the plate and, over bursts of frames of the
+same car, how many OCR calls the recent-frame cache skips and how many
+frames it wrongly answers with the plate of the car before. The cache keeps
+every car of the run, where the handler's keeps ten seconds of them, so its
+lookup time is an upper bound.
+
+Frames are synthetic shots from one camera by default: cars stopping at
+about the same place in front of the same signs, each with a plate at a
+known position, and sensor noise. --images uses real JPEGs
+instead, for which crop accuracy cannot be checked. --ocr local also times
+Tesseract on the full frame and on the crop (needs pytesseract).
+
+It exits with status 1 when the cache answers a frame with another car's
+plate.
+
+    python tools/preprocess_benchmark.py
+    python tools/preprocess_benchmark.py --cars 50 --width 3840 --height 2160
+    python tools/preprocess_benchmark.py --images ~/camera-frames --ocr local
+
+Requires Pillow.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+import imaging
+from cache import MISSING
+from plates import PLATE_ASPECT_RATIO
+
+SIGN_TEXT = ['PAY HERE', 'EXIT', 'MAX STAY 2 HOURS', 'NO PARKING', 'LEVEL 2', 'DISABLED BAYS', 'TARIFF 1.50 PER HOUR']
+
+def require_pillow():
+    pillow = imaging.get_pillow()
+    if pillow is None:
+        sys.exit('The benchmark needs Pillow: pip install Pillow')
+    from PIL import ImageDraw, ImageFont
+    return pillow[0], ImageDraw, ImageFont
+
+def random_plate(rng):
+    letters = string.ascii_uppercase
+    return (''.join(rng.choices(letters, k=2)) + ''.join(rng.choices(string.digits, k=2)) + ' '
+            + ''.join(rng.choices(letters, k=3)))
+
+def draw_text(image, text, box, fill):
+    # Renders text to fill box, scaling the default font so this works
+    # whether or not Pillow was built with FreeType.
+    Image, ImageDraw, ImageFont = require_pillow()
+    font = ImageFont.load_default()
+    left, top, right, bottom = font.getbbox(text)
+    label = Image.new('L', (right - left + 2, bottom - top + 2), 0)
+    ImageDraw.Draw(label).text((1 - left, 1 - top), text, fill=255, font=font)
+    width, height = box[2] - box[0], box[3] - box[1]
+    label = label.resize((width, height), Image.NEAREST)
+    image.paste(fill, box[:2], label)
+
+class SceneGenerator:
+    # One camera's view. The signs, the plate size and where cars stop stay
+    # the same for every car, as they do at a barrier, so that only the car
+    # tells two frames apart.
+    def __init__(self, width, height, seed):
+        self.width = width
+        self.height = height
+        self.rng = random.Random(seed)
+        self.plate_width = int(width * self.rng.uniform(0.1, 0.22))
+        self.plate_x = self.rng.uniform(0.25, 0.75) * width - self.plate_width / 2
+        self.plate_y = self.rng.uniform(0.55, 0.8) * height
+        self.signs = [
+            (self.rng.choice(SIGN_TEXT), self.rng.uniform(0.02, 0.7), self.rng.uniform(0.03, 0.3),
+             self.rng.uniform(0.12, 0.28))
+            for _ in range(self.rng.randint(1, 3))
+        ]
+
+    def car(self):
+        # The parts of a scene that stay the same across a car's frames.
+        rng = self.rng
+        return {
+            'plate': random_plate(rng),
+            'plate_width': self.plate_width,
+            'plate_x': self.plate_x + rng.uniform(-0.02, 0.02) * self.width,
+            'plate_y': self.plate_y + rng.uniform(-0.02, 0.02) * self.height,
+            'body': tuple(rng.randint(30, 220) for _ in range(3)),
+            'signs': self.signs,
+            'seed': rng.random()
+        }
+
+    def frame(self, car, shift=0):
+        # A frame of the car, moved shift pixels along as it approaches.
+        Image, ImageDraw, _ = require_pillow()
+        width, height = self.width, self.height
+        image = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+        draw = ImageDraw.Draw(image)
+
+        for text, x, y, sign_width in car['signs']:
+            left, top = int(x * width), int(y * height)
+            right = left + int(sign_width * width)
+            bottom = top + int(sign_width * width / 6)
+            draw.rectangle((left, top, right, bottom), fill=(20, 60, 150))
+            draw_text(image, text, (left + 8, top + 8, right - 8, bottom - 8), (240, 240, 240))
+
+        plate_width = car['plate_width']
+        plate_height = int(plate_width / PLATE_ASPECT_RATIO)
+        plate_left = int(car['plate_x']) + shift
+        plate_top = int(car['plate_y']) + shift // 3
+        draw.rounded_rectangle(
+            (plate_left - plate_width // 2, plate_top - plate_height * 3, plate_left + plate_width * 3 // 2, plate_top + plate_height * 2),
+            radius=plate_height, fill=car['body']
+        )
+        plate_box = (plate_left, plate_top, plate_left + plate_width, plate_top + plate_height)
+        draw.rectangle(plate_box, fill=(235, 235, 225), outline=(0, 0, 0), width=max(1, plate_height // 20))
+        inset = plate_height // 6
+        draw_text(image, car['plate'], (plate_left + inset * 2, plate_top + inset, plate_left + plate_width - inset * 2, plate_top + plate_height - inset), (0, 0, 0))
+
+        # Sensor noise, different in every frame.
+        noise = Image.effect_noise((width // 4, height // 4), 24).resize((width, height))
+        image = Image.blend(image, Image.merge('RGB', (noise, noise, noise)), 0.12)
+
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=90)
+        return output.getvalue(), plate_box
+
+def contains(regions, box, scale):
+    # Whether a crop, in decoded pixels, holds the plate box given in
+    # original pixels.
+    left, top, right, bottom = (value * scale for value in box)
+    return any(
+        region[0] <= left and region[1] <= top and region[2] >= right and region[3] >= bottom
+        for region in regions
+    )
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def local_ocr():
+    import recognition
+    try:
+        backend = recognition.LocalBackend()
+    except RuntimeError as e:
+        sys.exit(str(e))
+
+    def read(data):
+        started = time.perf_counter()
+        plate = recognition.best_plate(backend.detect_bytes(data))
+        return plate, time.perf_counter() - started
+    return read
+
+def load_frames(args):
+    if args.images:
+        names = sorted(name for name in os.listdir(args.images) if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+        for name in names:
+            with open(os.path.join(args.images, name), 'rb') as image_file:
+                yield name, image_file.read(), None, None
+        return
+
+    generator = SceneGenerator(args.width, args.height, args.seed)
+    for car_number in range(args.cars):
+        car = generator.car()
+        for frame_number in range(args.frames_per_car):
+            data, plate_box = generator.frame(car, shift=frame_number * args.width // 200)
+            yield f"car-{car_number}", data, plate_box, car['plate']
+
+def run(args):
+    require_pillow()
+    frames = imaging.RecentFrameCache(max_size=64, ttl=3600, max_change=args.max_change)
+    read = local_ocr() if args.ocr == 'local' else None
+
+    results = []
+    for name, data, plate_box, plate in load_frames(args):
+        started = time.perf_counter()
+        frame = imaging.prepare_image(data)
+        prepare_seconds = time.perf_counter() - started
+        if frame is None:
+            print(f"Skipping {name}: not an image")
+            continue
+
+        # Every frame comes from one camera, so a car can also be mistaken
+        # for the one before it.
+        started = time.perf_counter()
+        seen = frames.get('camera', frame)
+        match_seconds = time.perf_counter() - started
+        result = {
+            'frame': name,
+            'object_bytes': len(data),
+            'sent_bytes': len(frame.data),
+            'prepare_ms': prepare_seconds * 1000,
+            'match_ms': match_seconds * 1000,
+            'cropped': frame.cropped,
+            'deduplicated': seen is not MISSING,
+            'wrong_dedupe': plate is not None and seen is not MISSING and seen != plate
+        }
+        if plate_box is not None:
+            scale = frame.image.size[0] / args.width
+            result['plate_in_crop'] = contains(frame.regions, plate_box, scale)
+        # The handler only remembers frames whose crops gave a read.
+        if seen is MISSING and result.get('plate_in_crop', True):
+            frames.add('camera', frame, plate)
+        if read is not None:
+            full_plate, full_seconds = read(data)
+            crop_plate, crop_seconds = read(frame.data)
+            result.update({
+                'ocr_full_ms': full_seconds * 1000,
+                'ocr_crop_ms': crop_seconds * 1000,
+                'read_full': bool(full_plate),
+                'read_crop': bool(crop_plate)
+            })
+        results.append(result)
+    return results
+
+def summarise(results):
+    if not results:
+        sys.exit('No frames were processed')
+    frames = len(results)
+    summary = {
+        'frames': frames,
+        'object_bytes_mean': statistics.mean(result['object_bytes'] for result in results),
+        'sent_bytes_mean': statistics.mean(result['sent_bytes'] for result in results),
+        'prepare_ms': {
+            'mean': statistics.mean(result['prepare_ms'] for result in results),
+            'p50': percentile([result['prepare_ms'] for result in results], 0.5),
+            'p99': percentile([result['prepare_ms'] for result in results], 0.99)
+        },
+        'match_ms': statistics.mean(result['match_ms'] for result in results),
+        'cropped': sum(result['cropped'] for result in results) / frames,
+        'deduplicated': sum(result['deduplicated'] for result in results) / frames,
+        'wrong_dedupes': sum(result['wrong_dedupe'] for result in results)
+    }
+    checked = [result['plate_in_crop'] for result in results if 'plate_in_crop' in result]
+    if checked:
+        summary['plate_in_crop'] = sum(checked) / len(checked)
+    if 'ocr_full_ms' in results[0]:
+        for name in ('ocr_full_ms', 'ocr_crop_ms'):
+            summary[name] = statistics.mean(result[name] for result in results)
+        summary['read_full'] = sum(result['read_full'] for result in results) / frames
+        summary['read_crop'] = sum(result['read_crop'] for result in results) / frames
+    return summary
+
+def print_summary(summary):
+    object_kb = summary['object_bytes_mean'] / 1024
+    sent_kb = summary['sent_bytes_mean'] / 1024
+    ocr_calls = 1 - summary['deduplicated']
+    print(f"Frames: {summary['frames']}")
+    print()
+    print(f"{'per frame':<28}{'without stage':>16}{'with stage':>16}")
+    print(f"{'bytes read by the Lambda':<28}{0:>15.1f}K{object_kb:>15.1f}K")
+    print(f"{'bytes read by OCR':<28}{object_kb:>15.1f}K{sent_kb * ocr_calls:>15.1f}K")
+    print(f"{'OCR calls':<28}{1:>16.2f}{ocr_calls:>16.2f}")
+    prepare = summary['prepare_ms']
+    print(f"{'Lambda CPU time (ms)':<28}{0:>16.1f}{prepare['mean']:>16.1f}"
+          f"   (p50 {prepare['p50']:.1f}, p99 {prepare['p99']:.1f})")
+    print(f"{'cache lookup time (ms)':<28}{0:>16.1f}{summary['match_ms']:>16.1f}")
+    if 'ocr_full_ms' in summary:
+        print(f"{'OCR time (ms)':<28}{summary['ocr_full_ms']:>16.1f}{summary['ocr_crop_ms']:>16.1f}")
+        print(f"{'plates read':<28}{summary['read_full']:>16.1%}{summary['read_crop']:>16.1%}")
+    print()
+    print(f"Frames cropped to a plate region: {summary['cropped']:.1%}")
+    if 'plate_in_crop' in summary:
+        print(f"Crops containing the whole plate: {summary['plate_in_crop']:.1%}")
+    print(f"Frames answered by the recent-frame cache: {summary['deduplicated']:.1%} "
+          f"({summary['wrong_dedupes']} matched a different car)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', help='directory of camera frames to use instead of synthetic ones')
+    parser.add_argument('--cars', type=int, default=20)
+    parser.add_argument('--frames-per-car', type=int, default=3, help='frames a camera takes of each car')
+    parser.add_argument('--width', type=int, default=2592, help='synthetic frame width')
+    parser.add_argument('--height', type=int, default=1944, help='synthetic frame height')
+    parser.add_argument('--max-change', type=float, default=float(os.environ.get('FRAME_MATCH_CHANGE', '0.01')),
+                        help='share of a plate region that may change between frames of the same car')
+    parser.add_argument('--ocr', choices=['none', 'local'], default='none', help='also time OCR on the full frame and the crop')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args()
+
+    summary = summarise(run(args))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+
+    if summary['wrong_dedupes']:
+        print(f"FAIL: {summary['wrong_dedupes']} frames were given the plate of a different car")
+        sys.exit(1)
+    if not args.json:
+        print('PASS')
+
+if __name__ == '__main__':
+    main()
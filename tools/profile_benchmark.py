@@ -0,0 +1,405 @@
+"""Count the DynamoDB calls a profile save makes, check plate ownership, and
+time GET /profile as the users table grows.
+
+For each of --plates, a driver creates a profile with that many plates
+(POST /profile), then saves it three times with PUT /profile: once
+replacing one plate, once with every plate replaced, and once changing only
+the name. Each save's DynamoDB calls are counted. A name-only save should
+take one call, and a save with plates two: reading the profile, then one
+transaction writing the changed mappings with the profile, whatever the
+number of plates. A save changing 100 or more plates, more than the
+transaction holds, must be refused with a 400 and change nothing.
+
+Ownership is then checked: a second driver saving plates the first driver
+already holds gets a 409 naming them, those mappings still resolve to the
+first driver, and the plates are left off the second driver's profile. When
+the second driver drops a plate it never held, the first driver's mapping
+must survive. A driver who clears every plate must no longer be found as
+the owner of any of them, by mapping item or by CarRegistrationIndex.
+
+A save whose mapping transaction fails must return an error and leave the
+profile's plates as they were, so that retrying it writes the mappings and
+the plates then resolve to the driver. Two saves of the same profile that
+race, each reading it before the other writes, must both succeed and leave
+a mapping item for exactly the plates the profile ends up listing.
+
+Finally the users table is filled to each of --users profiles, --legacy of
+them saved the way profiles were before plate mapping items existed: with
+their last plate in CarRegistration, or with no plate at all. --reads
+random profiles are read with GET /profile at each size. A read should be
+one GetItem whatever the size of the table, and the first read of a legacy
+profile migrates it, after which it is one GetItem too and still lists its
+plate. The median read may be at most --max-slowdown times slower on the
+largest table than on the smallest.
+
+    python tools/profile_benchmark.py
+    python tools/profile_benchmark.py --plates 1 5 20 40
+    python tools/profile_benchmark.py --users 1000 100000 1000000 --reads 1000
+
+Requires moto.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+os.environ['METRICS_ENABLED'] = 'false'
+
+from simulate import create_resources, percentile, random_plate
+
+import notifications
+import userprofile
+from botocore.exceptions import ClientError
+
+from clients import get_client, get_session
+from plates import plate_owner_key
+from tables import get_table
+
+class Recorder:
+    def __init__(self):
+        self.calls = []
+
+    def before_call(self, model, **kwargs):
+        if model.service_model.service_name == 'dynamodb':
+            self.calls.append(model.name)
+
+def request(method, user_id, body):
+    event = {
+        'requestContext': {
+            'http': {'method': method},
+            'authorizer': {'jwt': {'claims': {'sub': user_id, 'email': f"{user_id}@example.com"}}}
+        },
+        'rawPath': '/profile',
+        'body': json.dumps(body)
+    }
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        return userprofile.main(event, None)
+
+def measure(recorder, method, user_id, body):
+    recorder.calls = []
+    response = request(method, user_id, body)
+    if response['statusCode'] != 200:
+        raise RuntimeError(f"{method} /profile returned {response['statusCode']}: {response['body']}")
+    return len(recorder.calls)
+
+def owner(plate):
+    item = get_table(userprofile.USERS_TABLE).get_item(Key={'UserID': plate_owner_key(plate)}).get('Item')
+    return item and item['OwnerID']
+
+def profile_plates(user_id):
+    return get_table(userprofile.USERS_TABLE).get_item(Key={'UserID': user_id})['Item'].get('RegPlates', [])
+
+def save_calls(args, rng, recorder):
+    results = {}
+    for count in args.plates:
+        user_id = f"driver-{count}"
+        plates = [random_plate(rng) for _ in range(count)]
+        replaced = [random_plate(rng)] + plates[1:]
+        renewed = [random_plate(rng) for _ in range(count)]
+        results[count] = {
+            'create': measure(recorder, 'POST', user_id, {'name': 'Driver', 'regPlates': plates}),
+            'one_plate_changed': measure(recorder, 'PUT', user_id, {'regPlates': replaced}),
+            'all_plates_changed': measure(recorder, 'PUT', user_id, {'regPlates': renewed}),
+            'name_only': measure(recorder, 'PUT', user_id, {'name': 'Renamed'})
+        }
+    return results
+
+def ownership_failures(rng):
+    failures = []
+    held = [random_plate(rng) for _ in range(3)]
+    request('POST', 'first-driver', {'regPlates': held})
+
+    own = random_plate(rng)
+    response = request('PUT', 'second-driver', {'regPlates': [own, held[0], held[1]]})
+    if response['statusCode'] != 409:
+        failures.append(f"saving another driver's plates returned {response['statusCode']}, not 409")
+    elif sorted(json.loads(response['body'])['conflictingPlates']) != sorted(held[:2]):
+        failures.append(f"conflicting plates reported as {json.loads(response['body'])['conflictingPlates']}")
+    if profile_plates('second-driver') != [own]:
+        failures.append(f"second driver's profile kept {profile_plates('second-driver')}")
+    for plate in held:
+        if owner(plate) != 'first-driver':
+            failures.append(f"{plate} now resolves to {owner(plate)}")
+    if owner(own) != 'second-driver':
+        failures.append(f"{own} was not mapped to the second driver")
+
+    # The conflict is reported in one spelling, and every spelling of the
+    # plate must leave the profile with it.
+    spare = random_plate(rng)
+    spellings = [held[0].replace(' ', '').lower(), held[0]]
+    request('PUT', 'third-driver', {'regPlates': [spare] + spellings})
+    if profile_plates('third-driver') != [spare]:
+        failures.append(f"saving {spellings} left {profile_plates('third-driver')} on the profile")
+
+    # A profile saved before its mappings existed still lists the plate, and
+    # dropping it must not delete the first driver's mapping.
+    get_table(userprofile.USERS_TABLE).put_item(Item={
+        'UserID': 'legacy-driver',
+        'RegPlates': [held[2]],
+        'PlateOwnerItems': True
+    })
+    request('PUT', 'legacy-driver', {'regPlates': []})
+    if owner(held[2]) != 'first-driver':
+        failures.append(f"dropping {held[2]} from another profile removed the first driver's mapping")
+
+    # Notifications resolve plates without a mapping item on
+    # CarRegistrationIndex, so clearing the profile must take it off there too.
+    sold = [random_plate(rng) for _ in range(2)]
+    request('POST', 'former-driver', {'regPlates': sold})
+    request('PUT', 'former-driver', {'regPlates': []})
+    with ThreadPoolExecutor() as executor:
+        users, _ = notifications.get_users_by_car_regs(sold, executor)
+    for plate in sold:
+        if users.get(plate):
+            failures.append(f"{plate} still resolves to {users[plate].get('UserID')} after its profile was cleared")
+    return failures
+
+class FailingTransactions:
+    # Stands in for the DynamoDB client and cancels every TransactWriteItems
+    # call with a transaction conflict, as DynamoDB does when another request
+    # writes one of its items at the same time.
+    def __getattr__(self, name):
+        return getattr(get_client('dynamodb'), name)
+
+    def transact_write_items(self, TransactItems):
+        raise ClientError({
+            'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+            'CancellationReasons': [{'Code': 'TransactionConflict'} for _ in TransactItems]
+        }, 'TransactWriteItems')
+
+class RacingSave:
+    # Stands in for the DynamoDB client and, before the first
+    # TransactWriteItems call goes through, runs another save to completion,
+    # so that both saves have read the profile before either writes it.
+    def __init__(self, race):
+        self.race = race
+
+    def __getattr__(self, name):
+        return getattr(get_client('dynamodb'), name)
+
+    def transact_write_items(self, **params):
+        race, self.race = self.race, None
+        if race:
+            race()
+        return get_client('dynamodb').transact_write_items(**params)
+
+@contextlib.contextmanager
+def dynamodb_client(stand_in):
+    real_get_client = userprofile.get_client
+    userprofile.get_client = lambda service: stand_in if service == 'dynamodb' else real_get_client(service)
+    try:
+        yield
+    finally:
+        userprofile.get_client = real_get_client
+
+def owned_keys(user_id):
+    keys = set()
+    scan_params = {
+        'FilterExpression': 'OwnerID = :me',
+        'ExpressionAttributeValues': {':me': user_id}
+    }
+    while True:
+        response = get_table(userprofile.USERS_TABLE).scan(**scan_params)
+        keys.update(item['UserID'] for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return keys
+        scan_params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def retry_failures(rng):
+    failures = []
+    for method in ('POST', 'PUT'):
+        user_id = f"retrying-{method.lower()}-driver"
+        kept = random_plate(rng)
+        request('POST', user_id, {'regPlates': [kept]})
+        plates = [kept, random_plate(rng)]
+        with dynamodb_client(FailingTransactions()):
+            response = request(method, user_id, {'regPlates': plates})
+        if response['statusCode'] != 500:
+            failures.append(f"{method} /profile with a cancelled transaction returned {response['statusCode']}, not 500")
+        if profile_plates(user_id) != [kept]:
+            failures.append(f"{method} /profile with a cancelled transaction saved {profile_plates(user_id)}")
+
+        response = request(method, user_id, {'regPlates': plates})
+        if response['statusCode'] != 200:
+            failures.append(f"retrying {method} /profile returned {response['statusCode']}")
+        for plate in plates:
+            if owner(plate) != user_id:
+                failures.append(f"after retrying {method} /profile, {plate} resolves to {owner(plate)}")
+    return failures
+
+def race_failures(rng):
+    failures = []
+    for method in ('POST', 'PUT'):
+        user_id = f"racing-{method.lower()}-driver"
+        first = random_plate(rng)
+        request('POST', user_id, {'regPlates': [first]})
+        plates, racing_plates = [random_plate(rng)], [random_plate(rng)]
+        responses = []
+        racing_save = RacingSave(lambda: responses.append(request(method, user_id, {'regPlates': racing_plates})))
+        with dynamodb_client(racing_save):
+            responses.append(request(method, user_id, {'regPlates': plates}))
+        statuses = [response['statusCode'] for response in responses]
+        if statuses != [200, 200]:
+            failures.append(f"racing {method} /profile saves returned {statuses}")
+
+        # The save that read first is written last, after reading again.
+        if profile_plates(user_id) != plates:
+            failures.append(f"racing {method} /profile saves left {profile_plates(user_id)}, not {plates}")
+        expected = {plate_owner_key(plate) for plate in profile_plates(user_id)}
+        orphaned = owned_keys(user_id) - expected
+        if orphaned:
+            failures.append(f"racing {method} /profile saves left mappings {sorted(orphaned)} the profile does not list")
+        if not expected <= owned_keys(user_id):
+            failures.append(f"racing {method} /profile saves left {sorted(expected - owned_keys(user_id))} unmapped")
+    return failures
+
+def too_many_failures(rng):
+    failures = []
+    plates = [random_plate(rng) for _ in range(userprofile.TRANSACT_WRITE_SIZE)]
+    for method in ('POST', 'PUT'):
+        user_id = f"crowded-{method.lower()}-driver"
+        response = request(method, user_id, {'regPlates': plates})
+        if response['statusCode'] != 400:
+            failures.append(f"{method} /profile with {len(plates)} new plates returned {response['statusCode']}, not 400")
+        if owned_keys(user_id):
+            failures.append(f"a refused {method} /profile mapped {len(owned_keys(user_id))} plates")
+    return failures
+
+def fill_users(args, rng, start, count, legacy):
+    # Returns the plate each legacy profile should list after migration,
+    # by user ID.
+    legacy_plates = {}
+    with get_table(userprofile.USERS_TABLE).batch_writer() as writer:
+        for i in range(start, count):
+            user_id = f"user-{i}"
+            plate = random_plate(rng)
+            item = {'UserID': user_id, 'Email': f"{user_id}@example.com", 'Name': 'Driver'}
+            if rng.random() < args.legacy:
+                if rng.random() < 0.5:
+                    item['CarRegistration'] = plate
+                    legacy_plates[user_id] = [plate]
+                else:
+                    legacy_plates[user_id] = []
+            else:
+                item.update(RegPlates=[plate], CarRegistration=plate, PlateOwnerItems=True)
+            writer.put_item(Item=item)
+    legacy.update(legacy_plates)
+
+def timed_read(recorder, user_id):
+    recorder.calls = []
+    started = time.perf_counter()
+    response = request('GET', user_id, None)
+    elapsed = time.perf_counter() - started
+    if response['statusCode'] != 200:
+        raise RuntimeError(f"GET /profile returned {response['statusCode']}: {response['body']}")
+    return elapsed, list(recorder.calls), json.loads(response['body'])
+
+def read_latency(args, rng, recorder):
+    results = {}
+    failures = []
+    legacy = {}
+    filled = 0
+    for users in sorted(args.users):
+        fill_users(args, rng, filled, users, legacy)
+        filled = users
+
+        latencies = []
+        for user_id in (f"user-{rng.randrange(users)}" for _ in range(args.reads)):
+            was_legacy = user_id in legacy
+            elapsed, calls, profile = timed_read(recorder, user_id)
+            if not was_legacy:
+                latencies.append(elapsed)
+                if calls != ['GetItem']:
+                    failures.append(f"reading {user_id} from {users} users took {calls}")
+                continue
+            plates = legacy.pop(user_id)
+            _, calls, profile = timed_read(recorder, user_id)
+            if calls != ['GetItem']:
+                failures.append(f"reading migrated {user_id} from {users} users took {calls}")
+            if profile.get('RegPlates') != plates:
+                failures.append(f"migrated {user_id} lists {profile.get('RegPlates')}, not {plates}")
+            if plates and owner(plates[0]) != user_id:
+                failures.append(f"migrated {user_id}'s plate {plates[0]} resolves to {owner(plates[0])}")
+
+        results[users] = {
+            'reads': len(latencies),
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000
+        }
+    return results, failures
+
+def print_report(report):
+    print("DynamoDB calls per profile save")
+    print(f"{'plates':>6}{'create':>8}{'one changed':>13}{'all changed':>13}{'name only':>11}")
+    for count, calls in report['saves'].items():
+        print(f"{count:>6}{calls['create']:>8}{calls['one_plate_changed']:>13}{calls['all_plates_changed']:>13}"
+              f"{calls['name_only']:>11}")
+    print()
+    print("GET /profile latency (ms)")
+    print(f"{'users':>9}{'reads':>7}{'p50':>8}{'p99':>8}")
+    for users, stats in report['reads'].items():
+        print(f"{users:>9}{stats['reads']:>7}{stats['p50_ms']:>8.2f}{stats['p99_ms']:>8.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--plates', type=int, nargs='+', default=[1, 5, 20], help='plates per profile')
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 100000], help='profiles in the table for each read run')
+    parser.add_argument('--legacy', type=float, default=0.1, help='fraction of profiles saved before plate mapping items')
+    parser.add_argument('--reads', type=int, default=500, help='GET /profile requests at each table size')
+    parser.add_argument('--max-slowdown', type=float, default=2.0,
+                        help='largest allowed ratio of the median read on the largest table to the smallest')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+    if max(args.plates) * 2 >= userprofile.TRANSACT_WRITE_SIZE:
+        parser.error(f"--plates must be below {userprofile.TRANSACT_WRITE_SIZE // 2}, "
+                     "so that replacing every plate fits one transaction")
+
+    try:
+        from moto import mock_aws
+    except ImportError:
+        sys.exit('The benchmark needs moto: pip install moto')
+
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+    with mock_aws():
+        get_session().register('before-call', recorder.before_call)
+        create_resources()
+        report = {'saves': save_calls(args, rng, recorder)}
+        failures = ownership_failures(rng)
+        failures += retry_failures(rng)
+        failures += race_failures(rng)
+        failures += too_many_failures(rng)
+        report['reads'], read_failures = read_latency(args, rng, recorder)
+        failures += read_failures
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    for count, calls in report['saves'].items():
+        for save in ('create', 'one_plate_changed', 'all_plates_changed'):
+            if calls[save] > 2:
+                failures.append(f"{save.replace('_', ' ')} with {count} plates took {calls[save]} calls, not 2")
+        if calls['name_only'] > 1:
+            failures.append(f"a name-only save with {count} plates took {calls['name_only']} calls")
+    smallest, largest = report['reads'][min(args.users)], report['reads'][max(args.users)]
+    if largest['p50_ms'] > args.max_slowdown * smallest['p50_ms']:
+        failures.append(f"the median read took {largest['p50_ms']:.2f}ms with {max(args.users)} users "
+                        f"and {smallest['p50_ms']:.2f}ms with {min(args.users)}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""Time plate recognition per image for each recognition backend.
+
+Every frame of a fixture set is read with each of --backends, the way
+s3getpassrek reads an upload when preprocessing is off: the backend's
+detections for the whole frame are ranked and the best candidate is kept.
+The report gives per-image latency percentiles, the share of plates read
+correctly and the Rekognition calls made.
+
+Frames are the synthetic camera shots of tools/preprocess_benchmark.py by
+default: a car with a known plate, signs with other text and sensor noise.
+--images uses real JPEGs instead, for which reads cannot be checked.
+
+Rekognition is a stand-in unless --live is given. It answers with the
+fixture's plate, at the plate's position, and the sign texts, after
+--rekognition-latency milliseconds. The local and local-first backends need
+Pillow, pytesseract and the tesseract binary, and are reported as
+unavailable without them.
+
+With the stand-in, each frame is then recognised a second time with the
+same ETag, as when an event is redelivered. That read must come from the
+memo without calling Rekognition.
+
+    python tools/recognition_benchmark.py
+    python tools/recognition_benchmark.py --backends local local-first --cars 50
+    python tools/recognition_benchmark.py --images ~/camera-frames --live
+
+It exits with status 1 when a redelivered frame reaches a backend.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+# Reads are timed one at a time, so the quota is not paced, and frames are
+# read whole, as with preprocessing off.
+os.environ.setdefault('REKOGNITION_TPS', '0')
+os.environ['PREPROCESS_IMAGES'] = 'false'
+os.environ['METRICS_ENABLED'] = 'false'
+
+from preprocess_benchmark import SIGN_TEXT, load_frames, percentile, require_pillow
+
+import recognition
+from clients import set_client
+from plates import normalise_plate
+
+FIXTURE_BUCKET = 'fixtures'
+
+class FixtureRekognition:
+    # Stands in for Rekognition's DetectText. Frames are registered with the
+    # plate box and text they show, which come back as confident LINE and
+    # WORD detections next to the signs in the scene. Frames are found by
+    # their bytes, or by key when sent by reference.
+    def __init__(self, latency, width, height):
+        self.latency = latency
+        self.width = width
+        self.height = height
+        self.frames = {}
+        self.calls = 0
+
+    def register(self, key, data, plate, plate_box):
+        self.frames[key] = self.frames[hashlib.sha1(data).hexdigest()] = (plate, plate_box)
+
+    def detect_text(self, Image):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if 'S3Object' in Image:
+            plate, plate_box = self.frames[Image['S3Object']['Name']]
+        else:
+            plate, plate_box = self.frames.get(hashlib.sha1(Image['Bytes']).hexdigest(), (None, None))
+
+        detections = [
+            recognition.make_detection(text, 'LINE', 95.0, (0, index * 40, 600, 100), self.width, self.height)
+            for index, text in enumerate(SIGN_TEXT[:2])
+        ]
+        if plate:
+            left, top, right, bottom = plate_box
+            for detection_type in ('LINE', 'WORD'):
+                detections.append(recognition.make_detection(
+                    plate, detection_type, 98.0, (left, top, right - left, bottom - top), self.width, self.height
+                ))
+        return {'TextDetections': detections}
+
+def frame_key(index):
+    return f"uploads/fixtures/frame-{index}.jpg"
+
+def create_backend(name):
+    try:
+        return recognition.BACKENDS[name](), None
+    except RuntimeError as e:
+        return None, str(e)
+
+def measure(name, frames, rekognition):
+    backend, unavailable = create_backend(name)
+    if backend is None:
+        return {'unavailable': unavailable}
+
+    latencies = []
+    correct = 0
+    checked = 0
+    calls_before = rekognition.calls if rekognition else 0
+    for _, data, _, plate in frames:
+        started = time.perf_counter()
+        read = recognition.best_plate(backend.detect_bytes(data))
+        latencies.append(time.perf_counter() - started)
+        if plate is not None:
+            checked += 1
+            correct += bool(read) and normalise_plate(read) == normalise_plate(plate)
+
+    result = {
+        'frames': len(latencies),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p90_ms': percentile(latencies, 0.9) * 1000,
+        'max_ms': max(latencies) * 1000,
+        'rekognition_calls': rekognition.calls - calls_before if rekognition else None
+    }
+    if checked:
+        result['read_correctly'] = correct / checked
+    return result
+
+def redelivery_failures(frames, rekognition):
+    # Every frame is recognised twice with the same ETag, by reference as
+    # s3getpassrek does; the second read must come from the memo.
+    failures = []
+    memo = recognition.TTLCache(max_size=len(frames) + 1, ttl=3600)
+    with mock.patch.object(recognition, 'recognition_cache', memo), \
+            mock.patch.object(recognition, '_backend', recognition.RekognitionBackend()):
+        for index, (_, data, _, _) in enumerate(frames):
+            etag = hashlib.md5(data).hexdigest()
+            first = recognition.recognise_plate(FIXTURE_BUCKET, frame_key(index), etag)
+            calls = rekognition.calls
+            second = recognition.recognise_plate(FIXTURE_BUCKET, frame_key(index), etag)
+            if rekognition.calls != calls:
+                failures.append(f"the redelivered {frame_key(index)} was read again")
+            elif second != first:
+                failures.append(f"the redelivered {frame_key(index)} read {second!r}, not {first!r}")
+    return failures
+
+def print_report(report):
+    config = report['config']
+    source = config['images'] or f"{config['cars']} synthetic cars"
+    rekognition = 'live Rekognition' if config['live'] else f"a Rekognition stand-in at {config['rekognition_latency']:g}ms"
+    print(f"Per-image recognition latency, {report['frames']} frames from {source}, {rekognition}")
+    print()
+    print(f"{'backend':<13}{'p50 ms':>9}{'p90 ms':>9}{'max ms':>9}{'correct':>9}{'Rekognition calls':>19}")
+    for name, result in report['backends'].items():
+        if 'unavailable' in result:
+            print(f"{name:<13}unavailable: {result['unavailable']}")
+            continue
+        correct = f"{result['read_correctly']:.0%}" if 'read_correctly' in result else '-'
+        calls = result['rekognition_calls'] if result['rekognition_calls'] is not None else '-'
+        print(f"{name:<13}{result['p50_ms']:>9.1f}{result['p90_ms']:>9.1f}{result['max_ms']:>9.1f}{correct:>9}{calls:>19}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', nargs='+', choices=sorted(recognition.BACKENDS),
+                        default=sorted(recognition.BACKENDS), help='backends to compare')
+    parser.add_argument('--images', help='directory of camera frames to use instead of synthetic ones')
+    parser.add_argument('--cars', type=int, default=20)
+    parser.add_argument('--frames-per-car', type=int, default=1, help='frames a camera takes of each car')
+    parser.add_argument('--width', type=int, default=1280, help='synthetic frame width')
+    parser.add_argument('--height', type=int, default=960, help='synthetic frame height')
+    parser.add_argument('--live', action='store_true', help='call Rekognition with the default AWS credentials')
+    parser.add_argument('--rekognition-latency', type=float, default=0,
+                        help='milliseconds the Rekognition stand-in takes per call')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    if not args.images:
+        require_pillow()
+    frames = list(load_frames(args))
+    if not frames:
+        sys.exit('No frames to recognise')
+
+    rekognition = None
+    if not args.live:
+        rekognition = FixtureRekognition(args.rekognition_latency / 1000, args.width, args.height)
+        for index, (_, data, plate_box, plate) in enumerate(frames):
+            rekognition.register(frame_key(index), data, plate, plate_box)
+        set_client('rekognition', rekognition)
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'json'},
+        'frames': len(frames),
+        'backends': {name: measure(name, frames, rekognition) for name in args.backends}
+    }
+    failures = redelivery_failures(frames, rekognition) if rekognition else []
+    report['redelivery_failures'] = failures
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Rebuild the CarParkStats counters from a stream capture or a table export.
+
+Input files hold one JSON object per line, either DynamoDB stream records
+({"eventName": ..., "dynamodb": {...}}) or items from a DynamoDB JSON export
+({"Item": {...}}). Counters are recomputed in memory and written back as
+absolute values, replacing whatever drift the live counters have.
+
+    python tools/replay_counters.py export/*.json
+    python tools/replay_counters.py --dry-run stream.jsonl
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+import aggregates
+from tables import get_table
+
+def read_records(paths):
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as records_file:
+            for line in records_file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if 'Item' in record:
+                    yield {'eventName': 'INSERT', 'dynamodb': {'NewImage': record['Item']}}
+                else:
+                    yield record
+
+def write_counters(totals):
+    # Every shard of each rebuilt counter is overwritten: shard 0 takes the
+    # total and the others are reset.
+    counters = {}
+    for (counter, _), attributes in totals.items():
+        counter_totals = counters.setdefault(counter, {})
+        for name, value in attributes.items():
+            counter_totals[name] = counter_totals.get(name, 0) + value
+
+    with get_table(aggregates.STATS_TABLE).batch_writer() as batch:
+        for counter, attributes in counters.items():
+            for shard in range(aggregates.COUNTER_SHARDS):
+                item = {'Counter': counter, 'Shard': shard}
+                item.update(attributes if shard == 0 else {name: 0 for name in attributes})
+                batch.put_item(Item=item)
+    return len(counters)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='stream or export files (optionally gzipped)')
+    parser.add_argument('--dry-run', action='store_true', help='compute counters without writing them')
+    args = parser.parse_args()
+
+    replayed = 0
+
+    def counted(records):
+        nonlocal replayed
+        for record in records:
+            replayed += 1
+            yield record
+
+    started = time.perf_counter()
+    totals = aggregates.collect_deltas(counted(read_records(args.paths)))
+    elapsed = time.perf_counter() - started
+    print(f"Replayed {replayed} records into {len(totals)} counter shards "
+          f"in {elapsed:.2f}s ({replayed / elapsed if elapsed else 0:.0f} records/s)")
+
+    if not args.dry_run:
+        print(f"Wrote {write_counters(totals)} counters to {aggregates.STATS_TABLE}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,762 @@
+"""Run the parking pipeline offline and report its throughput.
+
+S3, DynamoDB (with streams) and SNS are provided in process by moto, and
+Rekognition by a stand-in that reads back the plate the simulated camera
+uploaded, so no AWS account is needed. Cars arrive at --gates gates of each of
+--sites car parks with --bays bays, stay for a while and leave. Images are
+uploaded to uploads/<site>/<gate>/ with their capture time as metadata, which
+s3getpassrek reads when READ_OBJECT_METADATA=true. Every camera event is sent
+to s3getpassrek, and the sessions stream is fed to notifications and
+aggregates in the batch sizes and windows Terraform configures. Drivers
+register through userprofile and look their plates up through regplateapi.
+At each departure the exit barrier asks gateapi for a decision before the
+exit image is uploaded.
+
+--stream-redelivery-rate of stream batches are delivered twice, as Lambda
+does when an invocation times out after its writes, and records a consumer
+reports as failed are delivered again from the first of them, up to three
+times.
+
+After the run, --stress-plates cars at a separate site enter and leave with
+every event raced: each entry and exit is uploaded by two cameras at once,
+each upload is delivered twice, and all of them are processed in parallel.
+Cars whose plates look like theirs, sharing a skeleton, then enter just
+after they leave. Every plate must end up with exactly one session, closed
+or open as expected.
+
+The report gives events/s, latency percentiles for each handler and the AWS
+calls made per camera event. --json writes the same report so that runs can
+be tracked over time. It exits with status 1 when a site's occupancy counter
+disagrees with its open sessions, stream records still fail after their
+retries or the stress test finds a plate with the wrong sessions.
+
+    python tools/simulate.py --bays 200 --gates 4 --hours 12
+    python tools/simulate.py --sites 8 --hot-site-factor 5
+    python tools/simulate.py --seed 7 --json simulate.json
+
+Requires moto.
+"""
+import argparse
+import contextlib
+import heapq
+import io
+import json
+import math
+import os
+import random
+import string
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest import mock
+from urllib.parse import quote_plus
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+# Handlers read their configuration at import time.
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-2')
+TOPIC_NAME = 'car-park-payment-notifications'
+os.environ['SNS_TOPIC_ARN'] = f"arn:aws:sns:{os.environ['AWS_DEFAULT_REGION']}:123456789012:{TOPIC_NAME}"
+# Simulated uploads are placeholders rather than images, so they go to the
+# stand-in reader by reference. tools/preprocess_benchmark.py covers the
+# preprocessing stage.
+os.environ['PREPROCESS_IMAGES'] = 'false'
+
+import aggregates
+import cache
+import gateapi
+import notifications
+import regplateapi
+import recognition
+import s3getpassrek
+import reporting
+import userprofile
+from clients import get_client, get_session, set_client
+from plates import PLATE_ASPECT_RATIO, normalise_plate, plate_skeleton
+from sites import DEFAULT_SITE
+from tables import get_table
+
+IMAGES_BUCKET = 'car-park-images-simulated'
+START_TIME = 1767600000  # Monday 5 January 2026, 08:00 UTC
+CONFUSABLE = {'0': 'O', 'O': '0', '1': 'I', 'I': '1', '2': 'Z', 'Z': '2', '5': 'S', 'S': '5', '8': 'B', 'B': '8'}
+
+# Deliveries of a batch's failed records before the harness gives up on them.
+STREAM_RETRIES = 3
+STRESS_SITE = 'stress'
+# Attempts at a raced camera event, as Lambda retries a failed S3 invocation.
+STRESS_ATTEMPTS = 3
+
+# (function, batch size, batching window in seconds), as in terraform/main.tf
+STREAM_CONSUMERS = {
+    'notifications': (notifications.main, 100, 5),
+    'aggregates': (aggregates.main, 500, 10)
+}
+
+class CallCounter:
+    # Counts the AWS calls made while a handler is running, by handler and
+    # operation. The harness's own setup and stream polling are not counted.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handler = None
+        self.calls = {}
+        self.messages = 0
+
+    def record(self, operation):
+        if self.handler is None:
+            return
+        with self.lock:
+            calls = self.calls.setdefault(self.handler, {})
+            calls[operation] = calls.get(operation, 0) + 1
+
+    def before_call(self, model, **kwargs):
+        self.record(f"{model.service_model.service_name}.{model.name}")
+
+    def before_publish_batch(self, params, **kwargs):
+        if self.handler is not None:
+            with self.lock:
+                self.messages += len(params['PublishBatchRequestEntries'])
+
+class PlateReader:
+    # Stands in for Rekognition. The camera registers the plate text of each
+    # upload, which comes back as one confident line with a plate-shaped box.
+    def __init__(self, counter):
+        self.counter = counter
+        self.uploads = {}
+
+    def detect_text(self, Image):
+        self.counter.record('rekognition.DetectText')
+        text = self.uploads[Image['S3Object']['Name']]
+        width = 0.3
+        box = {
+            'Left': 0.35,
+            'Top': 0.6,
+            'Width': width,
+            'Height': width * recognition.IMAGE_ASPECT_RATIO / PLATE_ASPECT_RATIO
+        }
+        return {
+            'TextDetections': [
+                {'DetectedText': text, 'Type': detection_type, 'Confidence': 98.5, 'Geometry': {'BoundingBox': box}}
+                for detection_type in ('LINE', 'WORD')
+            ]
+        }
+
+class SimulatedClock:
+    # Replaces the time module in s3getpassrek, gateapi and the caches so
+    # that sessions last, and cached entries expire after, simulated hours
+    # rather than the few milliseconds of the run.
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+class SerialClient:
+    # moto rolls a cancelled transaction back by restoring a copy of each
+    # table it touched, which undoes whatever other threads wrote meanwhile.
+    # DynamoDB applies each request atomically, so during the stress test
+    # requests are sent one at a time; the handlers' reads and writes still
+    # interleave between them.
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            with self.lock:
+                return attribute(*args, **kwargs)
+        return call
+
+def create_resources():
+    dynamodb = get_client('dynamodb')
+
+    def attributes(**types):
+        return [{'AttributeName': name, 'AttributeType': attribute_type} for name, attribute_type in types.items()]
+
+    def index(name, hash_key, range_key=None, projection=None):
+        key_schema = [{'AttributeName': hash_key, 'KeyType': 'HASH'}]
+        if range_key:
+            key_schema.append({'AttributeName': range_key, 'KeyType': 'RANGE'})
+        return {'IndexName': name, 'KeySchema': key_schema, 'Projection': projection or {'ProjectionType': 'ALL'}}
+
+    dynamodb.create_table(
+        TableName=userprofile.USERS_TABLE,
+        BillingMode='PAY_PER_REQUEST',
+        AttributeDefinitions=attributes(UserID='S', CarRegistration='S'),
+        KeySchema=[{'AttributeName': 'UserID', 'KeyType': 'HASH'}],
+        GlobalSecondaryIndexes=[index('CarRegistrationIndex', 'CarRegistration')]
+    )
+    dynamodb.create_table(
+        TableName=s3getpassrek.SESSIONS_TABLE,
+        BillingMode='PAY_PER_REQUEST',
+        AttributeDefinitions=attributes(SessionID='S', CarRegistration='S', EntryTime='N', PlateKey='S', EntryBucket='S', EntryDay='S'),
+        KeySchema=[{'AttributeName': 'SessionID', 'KeyType': 'HASH'}],
+        GlobalSecondaryIndexes=[
+            index('CarRegistrationIndex', 'CarRegistration'),
+            index('PlateEntryTimeIndex', 'PlateKey', 'EntryTime'),
+            index('EntryTimeIndex', 'EntryTime'),
+            index('EntryBucketIndex', 'EntryBucket', 'EntryTime'),
+            index('EntryDayIndex', 'EntryDay', 'EntryTime')
+        ],
+        StreamSpecification={'StreamEnabled': True, 'StreamViewType': 'NEW_AND_OLD_IMAGES'}
+    )
+    dynamodb.create_table(
+        TableName=s3getpassrek.OPEN_SESSIONS_TABLE,
+        BillingMode='PAY_PER_REQUEST',
+        AttributeDefinitions=attributes(PlateKey='S', PlateSkeleton='S'),
+        KeySchema=[{'AttributeName': 'PlateKey', 'KeyType': 'HASH'}],
+        GlobalSecondaryIndexes=[index('PlateSkeletonIndex', 'PlateSkeleton')]
+    )
+    dynamodb.create_table(
+        TableName=notifications.NOTIFICATIONS_TABLE,
+        BillingMode='PAY_PER_REQUEST',
+        AttributeDefinitions=attributes(SessionID='S', DigestWindow='N', UserID='S'),
+        KeySchema=[{'AttributeName': 'SessionID', 'KeyType': 'HASH'}],
+        GlobalSecondaryIndexes=[index('DigestWindowIndex', 'DigestWindow', 'UserID')]
+    )
+    dynamodb.create_table(
+        TableName=aggregates.STATS_TABLE,
+        BillingMode='PAY_PER_REQUEST',
+        AttributeDefinitions=attributes(Counter='S', Shard='N'),
+        KeySchema=[{'AttributeName': 'Counter', 'KeyType': 'HASH'}, {'AttributeName': 'Shard', 'KeyType': 'RANGE'}]
+    )
+
+    get_client('s3').create_bucket(
+        Bucket=IMAGES_BUCKET,
+        CreateBucketConfiguration={'LocationConstraint': os.environ['AWS_DEFAULT_REGION']}
+    )
+    topic_arn = get_client('sns').create_topic(Name=TOPIC_NAME)['TopicArn']
+    if topic_arn != os.environ['SNS_TOPIC_ARN']:
+        sys.exit(f"Unexpected topic ARN {topic_arn}")
+
+class StreamReader:
+    # Polls every shard of the sessions stream, in order, from the start.
+    def __init__(self):
+        self.streams = get_client('dynamodbstreams')
+        stream_arn = get_client('dynamodb').describe_table(TableName=s3getpassrek.SESSIONS_TABLE)['Table']['LatestStreamArn']
+        shards = self.streams.describe_stream(StreamArn=stream_arn)['StreamDescription']['Shards']
+        self.iterators = [
+            self.streams.get_shard_iterator(
+                StreamArn=stream_arn,
+                ShardId=shard['ShardId'],
+                ShardIteratorType='TRIM_HORIZON'
+            )['ShardIterator']
+            for shard in shards
+        ]
+
+    def read(self):
+        records = []
+        for i, iterator in enumerate(self.iterators):
+            response = self.streams.get_records(ShardIterator=iterator)
+            self.iterators[i] = response['NextShardIterator']
+            for record in response['Records']:
+                # Lambda delivers the creation time as epoch seconds.
+                created = record['dynamodb'].get('ApproximateCreationDateTime')
+                if isinstance(created, datetime):
+                    record['dynamodb']['ApproximateCreationDateTime'] = int(created.timestamp())
+                records.append(record)
+        return records
+
+def random_plate(rng):
+    letters = string.ascii_uppercase
+    return (''.join(rng.choices(letters, k=2)) + ''.join(rng.choices(string.digits, k=2)) + ' '
+            + ''.join(rng.choices(letters, k=3)))
+
+def misread(rng, plate):
+    positions = [i for i, char in enumerate(plate) if char in CONFUSABLE]
+    if not positions:
+        return plate
+    i = rng.choice(positions)
+    return plate[:i] + CONFUSABLE[plate[i]] + plate[i + 1:]
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.stream_rng = random.Random(args.seed)
+        self.stream_redeliveries = 0
+        self.counter = CallCounter()
+        self.reader = PlateReader(self.counter)
+        self.clock = SimulatedClock(START_TIME)
+        self.latencies = {}
+        self.stage_times = {}
+        self.records = {}
+        self.failed_records = {}
+        self.unprocessed_records = {}
+        self.outcomes = {'entries': 0, 'exits': 0, 'duplicates': 0, 'unread': 0, 'errors': 0}
+        self.gate_decisions = {}
+        self.pending = {name: [] for name in STREAM_CONSUMERS}
+        self.pending_since = {}
+        self.uploads = 0
+
+    def invoke(self, name, function, event, records=1):
+        output = io.StringIO()
+        self.counter.handler = name
+        started = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(output):
+                response = function(event, None)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.counter.handler = None
+            if self.args.verbose:
+                sys.stdout.write(output.getvalue())
+        self.latencies.setdefault(name, []).append(elapsed)
+        self.collect_stage_times(name, output.getvalue())
+        self.records[name] = self.records.get(name, 0) + records
+        failures = response.get('batchItemFailures', []) if isinstance(response, dict) else []
+        self.failed_records[name] = self.failed_records.get(name, 0) + len(failures)
+        return response
+
+    def collect_stage_times(self, name, output):
+        # Handlers print one embedded-metric-format line per invocation, with
+        # stage times when it was sampled.
+        stage_times = self.stage_times.setdefault(name, {})
+        for line in output.splitlines():
+            if not line.startswith('{"_aws"'):
+                continue
+            metrics = json.loads(line)
+            for metric in metrics['_aws']['CloudWatchMetrics'][0]['Metrics']:
+                if metric['Unit'] == 'Milliseconds' and metric['Name'] != 'Duration':
+                    stage_times[metric['Name']] = stage_times.get(metric['Name'], 0.0) + metrics[metric['Name']]
+
+    def register_drivers(self, plates):
+        for i, plate in enumerate(plates):
+            if self.rng.random() >= self.args.registered:
+                continue
+            self.invoke('userprofile', userprofile.main, {
+                'requestContext': {
+                    'http': {'method': 'POST'},
+                    'authorizer': {'jwt': {'claims': {'sub': f"user-{i}", 'email': f"driver{i}@example.com"}}}
+                },
+                'rawPath': '/profile',
+                'body': json.dumps({'name': f"Driver {i}", 'regPlates': [plate]})
+            })
+
+    def camera_event(self, site_id, gate, plate, key=None, etag=None):
+        # Returns the key and ETag so that a redelivery can reuse them.
+        if key is None:
+            self.uploads += 1
+            key = f"uploads/{site_id}/gate-{gate}/{self.clock.now}-{self.uploads}.jpg"
+            etag = f"{self.rng.getrandbits(128):032x}"
+            text = misread(self.rng, plate) if self.rng.random() < self.args.misread_rate else plate
+            get_client('s3').put_object(
+                Bucket=IMAGES_BUCKET,
+                Key=key,
+                Body=text.encode(),
+                Metadata={'capture-time': str(self.clock.now)}
+            )
+            self.reader.uploads[key] = text
+
+        try:
+            response = self.invoke('s3getpassrek', s3getpassrek.main, {'Records': [{
+                'eventSource': 'aws:s3',
+                'eventName': 'ObjectCreated:Put',
+                's3': {
+                    'bucket': {'name': IMAGES_BUCKET},
+                    'object': {'key': quote_plus(key), 'eTag': etag}
+                }
+            }]})
+        except Exception as e:
+            # The invocation failed, which is what makes Lambda retry an S3 event.
+            print(f"s3getpassrek failed for {key}: {str(e)}")
+            self.outcomes['errors'] += 1
+            self.failed_records['s3getpassrek'] = self.failed_records.get('s3getpassrek', 0) + 1
+            return key, etag
+        for result in json.loads(response['body']):
+            body = result['body']
+            if result['statusCode'] == 500:
+                self.outcomes['errors'] += 1
+            elif result['statusCode'] == 400:
+                self.outcomes['unread'] += 1
+            elif body.startswith('Duplicate'):
+                self.outcomes['duplicates'] += 1
+            elif body.startswith('Exit'):
+                self.outcomes['exits'] += 1
+            else:
+                self.outcomes['entries'] += 1
+        return key, etag
+
+    def stress_upload(self, gate, plate, at):
+        self.uploads += 1
+        key = f"uploads/{STRESS_SITE}/gate-{gate}/{at}-{self.uploads}.jpg"
+        get_client('s3').put_object(Bucket=IMAGES_BUCKET, Key=key, Body=plate.encode(),
+                                    Metadata={'capture-time': str(at)})
+        self.reader.uploads[key] = plate
+        return {'Records': [{
+            'eventSource': 'aws:s3',
+            'eventName': 'ObjectCreated:Put',
+            's3': {
+                'bucket': {'name': IMAGES_BUCKET},
+                'object': {'key': quote_plus(key), 'eTag': f"{self.rng.getrandbits(128):032x}"}
+            }
+        }]}
+
+    def race(self, plates, at):
+        # Two cameras upload each car at the same moment and each upload is
+        # delivered twice, all processed at once. Returns the events that
+        # still failed after their retries.
+        self.clock.now = at
+        events = []
+        for plate in plates:
+            for gate in (0, 1):
+                event = self.stress_upload(gate, plate, at)
+                events.extend([event, event])
+        self.rng.shuffle(events)
+
+        def attempt(event):
+            try:
+                s3getpassrek.main(event, None)
+                return None
+            except Exception:
+                return event
+
+        failed = events
+        for _ in range(STRESS_ATTEMPTS):
+            with ThreadPoolExecutor(max_workers=self.args.stress_workers) as executor:
+                failed = [event for event in executor.map(attempt, failed) if event is not None]
+            if not failed:
+                break
+        return len(failed)
+
+    def plate_sessions(self, plate):
+        response = get_table(s3getpassrek.SESSIONS_TABLE).query(
+            IndexName='PlateEntryTimeIndex',
+            KeyConditionExpression='PlateKey = :plate_key',
+            ExpressionAttributeValues={':plate_key': normalise_plate(plate)}
+        )
+        return [item for item in response['Items'] if item.get('SiteID') == STRESS_SITE]
+
+    def session_failures(self, plates, closed, phase):
+        failures = []
+        for plate in plates:
+            sessions = self.plate_sessions(plate)
+            if len(sessions) != 1:
+                failures.append(f"{plate} has {len(sessions)} sessions after {phase}")
+            elif ('ExitTime' in sessions[0]) != closed:
+                failures.append(f"{plate}'s session is {'open' if 'ExitTime' not in sessions[0] else 'closed'} after {phase}")
+        return failures
+
+    def stress(self):
+        # Returns failure messages.
+        rng = self.rng
+        plates = {}
+        lookalikes = []
+        while len(plates) < self.args.stress_plates:
+            plate = random_plate(rng)
+            lookalike = misread(rng, plate)
+            skeleton = plate_skeleton(plate)
+            if lookalike != plate and skeleton not in plates:
+                plates[skeleton] = plate
+                lookalikes.append(lookalike)
+        plates = list(plates.values())
+
+        failures = []
+        with contextlib.ExitStack() as stack:
+            for module in (s3getpassrek, gateapi, cache):
+                stack.enter_context(mock.patch.object(module, 'time', self.clock))
+            # The limiter paces by the wall clock, which would only slow the
+            # race down; the simulated clock barely moves during it.
+            stack.enter_context(mock.patch.object(recognition, 'rekognition_limiter', None))
+            # Each delivery is handled as if by another container, so
+            # duplicates reach the session checks rather than the memo of
+            # processed events.
+            stack.enter_context(mock.patch.object(s3getpassrek, 'processed_events', cache.TTLCache(0, 0)))
+            dynamodb = get_client('dynamodb')
+            set_client('dynamodb', SerialClient(dynamodb))
+            stack.callback(set_client, 'dynamodb', dynamodb)
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+            at = self.clock.now + 3600
+            unfinished = self.race(plates, at)
+            failures += self.session_failures(plates, False, 'racing entries')
+            unfinished += self.race(plates, at + 7200)
+            failures += self.session_failures(plates, True, 'racing exits')
+            # Inside the debounce window of the exits, whose pointers the
+            # lookalikes find through the skeleton index.
+            unfinished += self.race(lookalikes, at + 7200 + s3getpassrek.DEBOUNCE_SECONDS // 2)
+            failures += self.session_failures(lookalikes, False, 'lookalikes entered')
+            failures += self.session_failures(plates, True, 'lookalikes entered')
+        if unfinished:
+            failures.append(f"{unfinished} raced events still failed after {STRESS_ATTEMPTS} attempts")
+        return failures
+
+    def gate_decision(self, site_id, gate, plate):
+        response = self.invoke('gateapi', gateapi.main, {'body': json.dumps({
+            'siteId': site_id,
+            'gateId': f"gate-{gate}",
+            'direction': 'exit',
+            'plate': plate
+        })})
+        decision = json.loads(response['body']).get('decision', 'error')
+        self.gate_decisions[decision] = self.gate_decisions.get(decision, 0) + 1
+
+    def pump_stream(self, stream, flush=False):
+        records = stream.read()
+        for name, (function, batch_size, window) in STREAM_CONSUMERS.items():
+            pending = self.pending[name]
+            if records and not pending:
+                self.pending_since[name] = self.clock.now
+            pending.extend(records)
+            while pending and (flush or len(pending) >= batch_size
+                               or self.clock.now - self.pending_since[name] >= window):
+                batch, self.pending[name] = pending[:batch_size], pending[batch_size:]
+                pending = self.pending[name]
+                self.pending_since[name] = self.clock.now
+                self.deliver_stream_batch(name, function, batch)
+
+    def deliver_stream_batch(self, name, function, batch):
+        response = self.invoke(name, function, {'Records': batch}, records=len(batch))
+        if self.stream_rng.random() < self.args.stream_redelivery_rate:
+            self.stream_redeliveries += 1
+            response = self.invoke(name, function, {'Records': batch}, records=len(batch))
+        for attempt in range(STREAM_RETRIES + 1):
+            failed = {failure['itemIdentifier'] for failure in (response or {}).get('batchItemFailures', [])}
+            if not failed:
+                return
+            first = min(i for i, record in enumerate(batch) if record['dynamodb']['SequenceNumber'] in failed)
+            batch = batch[first:]
+            if attempt < STREAM_RETRIES:
+                response = self.invoke(name, function, {'Records': batch}, records=len(batch))
+        # Lambda would give up on these records and describe them on the
+        # stream failures queue.
+        self.unprocessed_records[name] = self.unprocessed_records.get(name, 0) + len(batch)
+
+    def run(self):
+        args = self.args
+        # The first site is --hot-site-factor times the size of the others.
+        site_ids = [DEFAULT_SITE] if args.sites == 1 else [f"site-{i + 1}" for i in range(args.sites)]
+        bays = {site_id: int(args.bays * (args.hot_site_factor if i == 0 else 1)) for i, site_id in enumerate(site_ids)}
+        plates = {
+            site_id: [random_plate(self.rng) for _ in range(args.cars or site_bays * 3)]
+            for site_id, site_bays in bays.items()
+        }
+        all_plates = [plate for site_plates in plates.values() for plate in site_plates]
+        self.register_drivers(all_plates)
+        stream = StreamReader()
+        stream.read()
+
+        # Arrivals at each site are a Poisson process sized to keep it at the
+        # target occupancy; stays are log-normal around --mean-stay hours.
+        arrival_rates = {site_id: site_bays * args.occupancy / (args.mean_stay * 3600) for site_id, site_bays in bays.items()}
+        sigma = 0.8
+        mu = math.log(args.mean_stay * 3600) - sigma * sigma / 2
+        end_time = START_TIME + int(args.hours * 3600)
+
+        events = []
+        sequence = 0
+
+        def schedule(at, kind, *details):
+            nonlocal sequence
+            sequence += 1
+            heapq.heappush(events, (int(at), sequence, kind, details))
+
+        for site_id, arrival_rate in arrival_rates.items():
+            schedule(START_TIME + self.rng.expovariate(arrival_rate), 'arrival', site_id)
+        parked = {site_id: set() for site_id in site_ids}
+        turned_away = 0
+        camera_events = 0
+        redeliveries = 0
+
+        started = time.perf_counter()
+        with mock.patch.object(s3getpassrek, 'time', self.clock), mock.patch.object(gateapi, 'time', self.clock), \
+                mock.patch.object(cache, 'time', self.clock):
+            while events and events[0][0] < end_time:
+                at, _, kind, details = heapq.heappop(events)
+                self.clock.now = max(self.clock.now, at)
+
+                if kind == 'arrival':
+                    site_id, = details
+                    schedule(at + self.rng.expovariate(arrival_rates[site_id]), 'arrival', site_id)
+                    free = [plate for plate in plates[site_id] if plate not in parked[site_id]]
+                    if len(parked[site_id]) >= bays[site_id] or not free:
+                        turned_away += 1
+                        continue
+                    plate = self.rng.choice(free)
+                    parked[site_id].add(plate)
+                    schedule(at, 'camera', site_id, self.rng.randrange(args.gates), plate, None, None)
+                    stay = max(300, self.rng.lognormvariate(mu, sigma))
+                    schedule(at + stay, 'departure', site_id, plate)
+                elif kind == 'departure':
+                    site_id, plate = details
+                    parked[site_id].discard(plate)
+                    gate = self.rng.randrange(args.gates)
+                    self.gate_decision(site_id, gate, plate)
+                    schedule(at, 'camera', site_id, gate, plate, None, None)
+                elif kind == 'camera':
+                    site_id, gate, plate, key, etag = details
+                    camera_events += 1
+                    if key is not None:
+                        redeliveries += 1
+                    key, etag = self.camera_event(site_id, gate, plate, key, etag)
+                    if details[3] is None and self.rng.random() < args.duplicate_rate:
+                        schedule(at + self.rng.uniform(1, 30), 'camera', site_id, gate, plate, key, etag)
+                    if self.rng.random() < args.lookup_rate:
+                        self.invoke('regplateapi', regplateapi.main, {
+                            'body': json.dumps({'regPlate': self.rng.choice(all_plates)})
+                        })
+
+                self.pump_stream(stream)
+            self.pump_stream(stream, flush=True)
+        elapsed = time.perf_counter() - started
+
+        # Counters and the open sessions in the entry-hour index are read
+        # per site, which also checks that no site sees another's sessions.
+        occupancy = {
+            site_id: {
+                'bays': bays[site_id],
+                'expected': len(parked[site_id]),
+                'counted': int(aggregates.get_occupancy(site_id)),
+                'open_sessions': sum(1 for _ in reporting.sessions_between(
+                    START_TIME, end_time, open_only=True, site_id=site_id
+                ))
+            }
+            for site_id in site_ids
+        }
+        handlers = {}
+        for name, latencies in self.latencies.items():
+            calls = self.counter.calls.get(name, {})
+            handlers[name] = {
+                'invocations': len(latencies),
+                'records': self.records[name],
+                'failed_records': self.failed_records[name],
+                'p50_ms': percentile(latencies, 0.5) * 1000,
+                'p90_ms': percentile(latencies, 0.9) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'max_ms': max(latencies) * 1000,
+                'backend_calls': calls,
+                'stage_ms': {stage: total / len(latencies) for stage, total in self.stage_times.get(name, {}).items()}
+            }
+
+        pipeline = ('s3getpassrek', 'notifications', 'aggregates')
+        calls_per_event = {}
+        for name in pipeline:
+            for operation, count in self.counter.calls.get(name, {}).items():
+                calls_per_event[operation] = calls_per_event.get(operation, 0) + count / max(1, camera_events)
+
+        return {
+            'config': {key: value for key, value in vars(args).items() if key not in ('json', 'verbose')},
+            'camera_events': camera_events,
+            'redeliveries': redeliveries,
+            'stream_redeliveries': self.stream_redeliveries,
+            'turned_away': turned_away,
+            'outcomes': self.outcomes,
+            'gate_decisions': self.gate_decisions,
+            'notifications_published': self.counter.messages,
+            'elapsed_seconds': elapsed,
+            'events_per_second': camera_events / elapsed if elapsed else 0.0,
+            'handlers': handlers,
+            'pipeline_calls_per_event': calls_per_event,
+            'occupancy': occupancy,
+            'unprocessed_records': self.unprocessed_records
+        }
+
+def print_report(report):
+    config = report['config']
+    outcomes = report['outcomes']
+    print(f"Simulated {config['hours']:g}h at {config['sites']} sites with {config['gates']} gates each: "
+          f"{report['camera_events']} camera events ({report['redeliveries']} redelivered), "
+          f"{report['turned_away']} cars turned away; {report['stream_redeliveries']} stream batches redelivered")
+    print(f"Outcomes: {outcomes['entries']} entries, {outcomes['exits']} exits, {outcomes['duplicates']} duplicates, "
+          f"{outcomes['unread']} unread, {outcomes['errors']} errors; "
+          f"{report['notifications_published']} notifications published")
+    print("Exit barrier decisions: " + ', '.join(
+        f"{count} {decision}" for decision, count in sorted(report['gate_decisions'].items())
+    ))
+    print(f"Processed in {report['elapsed_seconds']:.2f}s: {report['events_per_second']:.1f} events/s")
+    print()
+    print(f"{'handler':<15}{'calls':>8}{'records':>9}{'failed':>8}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}{'AWS/call':>10}")
+    for name, stats in sorted(report['handlers'].items()):
+        backend_calls = sum(stats['backend_calls'].values()) / stats['invocations']
+        print(f"{name:<15}{stats['invocations']:>8}{stats['records']:>9}{stats['failed_records']:>8}"
+              f"{stats['p50_ms']:>9.2f}{stats['p90_ms']:>9.2f}{stats['p99_ms']:>9.2f}{stats['max_ms']:>9.2f}"
+              f"{backend_calls:>10.2f}")
+        stages = ', '.join(f"{stage} {ms:.2f}ms" for stage, ms in sorted(stats['stage_ms'].items()))
+        if stages:
+            print(f"{'':<15}mean per call: {stages}")
+    print()
+    calls_per_event = report['pipeline_calls_per_event']
+    print(f"AWS calls per camera event through the pipeline: {sum(calls_per_event.values()):.2f}")
+    for operation, count in sorted(calls_per_event.items(), key=lambda item: -item[1]):
+        print(f"  {operation:<40}{count:>8.3f}")
+    print()
+    if report.get('stress', {}).get('plates'):
+        print(f"Stress test: {report['stress']['plates']} cars and as many lookalikes raced through the gates, "
+              f"{len(report['stress']['failures'])} problems")
+        print()
+    print(f"{'site':<15}{'bays':>8}{'parked':>8}{'counted':>9}{'open':>8}")
+    for site_id, occupancy in report['occupancy'].items():
+        print(f"{site_id:<15}{occupancy['bays']:>8}{occupancy['expected']:>8}{occupancy['counted']:>9}"
+              f"{occupancy['open_sessions']:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sites', type=int, default=1)
+    parser.add_argument('--bays', type=int, default=100, help='bays per site')
+    parser.add_argument('--hot-site-factor', type=float, default=1, help='size of the first site relative to the others')
+    parser.add_argument('--gates', type=int, default=2, help='gates per site')
+    parser.add_argument('--hours', type=float, default=12, help='simulated time')
+    parser.add_argument('--cars', type=int, help='distinct plates per site, three per bay by default')
+    parser.add_argument('--occupancy', type=float, default=0.8, help='target share of bays in use')
+    parser.add_argument('--mean-stay', type=float, default=2, help='mean stay in hours')
+    parser.add_argument('--registered', type=float, default=0.6, help='share of drivers with a profile')
+    parser.add_argument('--duplicate-rate', type=float, default=0.05, help='share of S3 events delivered twice')
+    parser.add_argument('--stress-plates', type=int, default=50, help='cars raced through the stress test, 0 to skip it')
+    parser.add_argument('--stress-workers', type=int, default=8, help='events processed at once in the stress test')
+    parser.add_argument('--stream-redelivery-rate', type=float, default=0.05, help='share of stream batches delivered twice')
+    parser.add_argument('--misread-rate', type=float, default=0.02, help='share of images read with a confusable character')
+    parser.add_argument('--lookup-rate', type=float, default=0.2, help='plate lookups per camera event')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--verbose', action='store_true', help='show handler output')
+    args = parser.parse_args()
+
+    try:
+        from moto import mock_aws
+    except ImportError:
+        sys.exit('The simulation needs moto: pip install moto')
+
+    with mock_aws():
+        simulation = Simulation(args)
+        session = get_session()
+        session.register('before-call', simulation.counter.before_call)
+        session.register('before-parameter-build.sns.PublishBatch', simulation.counter.before_publish_batch)
+        set_client('rekognition', simulation.reader)
+        create_resources()
+        report = simulation.run()
+        stress_failures = simulation.stress() if args.stress_plates else []
+        report['stress'] = {'plates': args.stress_plates, 'failures': stress_failures}
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    failures = [
+        f"{site_id} counted {occupancy['counted']} cars with {occupancy['open_sessions']} open sessions"
+        for site_id, occupancy in report['occupancy'].items() if occupancy['counted'] != occupancy['open_sessions']
+    ] + [
+        f"{count} {name} records still failed after {STREAM_RETRIES} retries"
+        for name, count in report['unprocessed_records'].items()
+    ] + stress_failures
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
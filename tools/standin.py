@@ -0,0 +1,127 @@
+"""An in-memory DynamoDB table for benchmarks that need millions of items.
+
+moto answers a query on a global secondary index by walking every item in
+the table, so its latency grows with the table however well the index fits
+the query. StandInTable keeps each index sorted, as DynamoDB does, and
+answers the subset of Query and Scan the handlers use:
+
+    KeyConditionExpression  H = :h, optionally AND R = :r, R < :r, R <= :r,
+                            R > :r, R >= :r or R BETWEEN :a AND :b
+    FilterExpression        attribute_exists(A) or attribute_not_exists(A)
+    ScanIndexForward, Limit, ExclusiveStartKey
+
+It takes the deserialized items tables.Table takes, so it can be patched in
+for get_table. Each request waits latency seconds, pages stop at page_size
+items as DynamoDB's stop at 1 MB, and every request records the items it
+read, which is what DynamoDB charges read capacity for.
+"""
+import bisect
+import re
+import threading
+import time
+
+KEY_CONDITION = re.compile(
+    r'^(\w+) = (:\w+)(?: AND (\w+) (?:BETWEEN (:\w+) AND (:\w+)|(=|<=|<|>=|>) (:\w+)))?$'
+)
+FILTER = re.compile(r'^(attribute_exists|attribute_not_exists)\((\w+)\)$')
+# Items of a few hundred bytes, of which DynamoDB returns up to 1 MB a page.
+DEFAULT_PAGE_SIZE = 4000
+
+class StandInTable:
+    def __init__(self, hash_key, indexes=None, latency=0, page_size=DEFAULT_PAGE_SIZE):
+        # indexes maps an index name to its (hash key, range key or None).
+        self.hash_key = hash_key
+        self.indexes = {name: (index_hash, index_range, {}) for name, (index_hash, index_range) in (indexes or {}).items()}
+        self.latency = latency
+        self.page_size = page_size
+        self.items = {}
+        self.scan_keys = None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.items_read = 0
+
+    def put(self, item):
+        # Loads an item without counting a request. Items are not replaced.
+        key = item[self.hash_key]
+        self.items[key] = item
+        self.scan_keys = None
+        for index_hash, index_range, partitions in self.indexes.values():
+            if index_hash not in item or (index_range and index_range not in item):
+                continue
+            entries = partitions.setdefault(item[index_hash], [])
+            bisect.insort(entries, (item[index_range] if index_range else 0, key))
+
+    def record(self, items_read):
+        with self.lock:
+            self.requests += 1
+            self.items_read += items_read
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset_counts(self):
+        self.requests = 0
+        self.items_read = 0
+
+    def get_item(self, Key, **params):
+        item = self.items.get(Key[self.hash_key])
+        self.record(1)
+        return {'Item': item} if item is not None else {}
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues, IndexName=None, FilterExpression=None,
+              ScanIndexForward=True, Limit=None, ExclusiveStartKey=None, **params):
+        match = KEY_CONDITION.match(KeyConditionExpression)
+        if match is None or IndexName not in self.indexes:
+            raise NotImplementedError(f"Query on {IndexName}: {KeyConditionExpression}")
+        hash_name, hash_value, range_name, low, high, operator, operand = match.groups()
+        index_hash, index_range, partitions = self.indexes[IndexName]
+        if hash_name != index_hash or (range_name and range_name != index_range):
+            raise NotImplementedError(f"{KeyConditionExpression} does not match the keys of {IndexName}")
+
+        entries = partitions.get(ExpressionAttributeValues[hash_value], [])
+        start, end = 0, len(entries)
+        if low:
+            start, end = self.range_bounds(entries, '>=', ExpressionAttributeValues[low])[0], \
+                self.range_bounds(entries, '<=', ExpressionAttributeValues[high])[1]
+        elif operator:
+            start, end = self.range_bounds(entries, operator, ExpressionAttributeValues[operand])
+        keys = [key for _, key in entries[start:max(start, end)]]
+        if not ScanIndexForward:
+            keys.reverse()
+        return self.page(keys, FilterExpression, Limit, ExclusiveStartKey)
+
+    def range_bounds(self, entries, operator, value):
+        # The slice of entries whose range key satisfies operator value.
+        lower = bisect.bisect_left(entries, (value,))
+        upper = bisect.bisect_left(entries, (value, chr(0x10FFFF)))
+        return {
+            '=': (lower, upper),
+            '<': (0, lower),
+            '<=': (0, upper),
+            '>': (upper, len(entries)),
+            '>=': (lower, len(entries))
+        }[operator]
+
+    def scan(self, FilterExpression=None, Limit=None, ExclusiveStartKey=None, **params):
+        if self.scan_keys is None:
+            self.scan_keys = list(self.items)
+        return self.page(self.scan_keys, FilterExpression, Limit, ExclusiveStartKey)
+
+    def page(self, keys, filter_expression, limit, exclusive_start_key):
+        # Pages hold up to page_size items, or Limit if smaller, counted before
+        # the filter as DynamoDB counts them. LastEvaluatedKey is a position.
+        position = int(exclusive_start_key['Position']) if exclusive_start_key else 0
+        size = min(limit or self.page_size, self.page_size)
+        evaluated = [self.items[key] for key in keys[position:position + size]]
+        self.record(len(evaluated))
+
+        if filter_expression:
+            match = FILTER.match(filter_expression)
+            if match is None:
+                raise NotImplementedError(f"Filter: {filter_expression}")
+            function, attribute = match.groups()
+            evaluated = [item for item in evaluated if (attribute in item) == (function == 'attribute_exists')]
+
+        response = {'Items': evaluated, 'Count': len(evaluated), 'ScannedCount': min(size, len(keys) - position)}
+        if position + size < len(keys):
+            response['LastEvaluatedKey'] = {'Position': position + size}
+        return response
@@ -0,0 +1,198 @@
+"""Compare each handler's cold start with its warm requests.
+
+For every handler named in terraform/main.tf, the import time is measured in
+a fresh interpreter as tools/coldstart.py does. A second interpreter then
+runs the handler in process against moto, as tools/simulate.py does, with
+the AWS clients and botocore session discarded first, as in a new
+container. It times the first request, which creates the clients and loads
+their service models, then --requests warm requests, then --requests more
+with the clients discarded before each, as when handlers built a client or
+resource on every invocation. Every request is for a plate, driver or
+session not seen before, so no cache of the handler answers it.
+
+The report gives, per handler, the import time, the first request, the
+median warm request and the median request with new clients. Import and
+first request together are what a cold start adds before the first
+response. It exits with status 1 when a warm request creates a client.
+
+    python tools/startup_benchmark.py
+    python tools/startup_benchmark.py --requests 50 gateapi regplateapi
+
+Requires moto.
+"""
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+os.environ['METRICS_ENABLED'] = 'false'
+os.environ.setdefault('REKOGNITION_TPS', '0')
+
+from coldstart import find_handlers, profile
+from simulate import IMAGES_BUCKET, Simulation, StreamReader, create_resources, percentile, random_plate
+
+import cache
+import clients
+import gateapi
+import s3getpassrek
+from sites import DEFAULT_SITE
+
+def prepare(simulation, handler, count):
+    # Returns count events for handler, made with the harness or with other
+    # handlers so that the measured handler itself has not yet run.
+    plates = [random_plate(simulation.rng) for _ in range(count)]
+    if handler == 'userprofile':
+        return [{
+            'requestContext': {
+                'http': {'method': 'POST'},
+                'authorizer': {'jwt': {'claims': {'sub': f"user-{i}", 'email': f"driver{i}@example.com"}}}
+            },
+            'rawPath': '/profile',
+            'body': json.dumps({'name': f"Driver {i}", 'regPlates': [plate]})
+        } for i, plate in enumerate(plates)]
+
+    if handler == 's3getpassrek':
+        events = []
+        for plate in plates:
+            simulation.uploads += 1
+            key = f"uploads/{DEFAULT_SITE}/gate-0/{simulation.clock.now}-{simulation.uploads}.jpg"
+            clients.get_client('s3').put_object(Bucket=IMAGES_BUCKET, Key=key, Body=plate.encode())
+            simulation.reader.uploads[key] = plate
+            events.append({'Records': [{
+                'eventSource': 'aws:s3',
+                'eventName': 'ObjectCreated:Put',
+                's3': {
+                    'bucket': {'name': IMAGES_BUCKET},
+                    'object': {'key': key, 'eTag': f"{simulation.rng.getrandbits(128):032x}"}
+                }
+            }]})
+        return events
+
+    stream = StreamReader()
+    simulation.register_drivers(plates)
+    for plate in plates:
+        simulation.camera_event(DEFAULT_SITE, 0, plate)
+    if handler == 'regplateapi':
+        return [{'body': json.dumps({'regPlate': plate})} for plate in plates]
+    if handler == 'gateapi':
+        return [{'body': json.dumps({'siteId': DEFAULT_SITE, 'gateId': 'gate-1', 'direction': 'exit', 'plate': plate})}
+                for plate in plates]
+
+    # The stream handlers get each car's exit, which ends its session.
+    stream.read()
+    simulation.clock.now += 2 * 3600
+    for plate in plates:
+        simulation.camera_event(DEFAULT_SITE, 1, plate)
+    return [{'Records': [record]} for record in stream.read() if record['eventName'] == 'MODIFY']
+
+def run_handler(args, mock_aws):
+    # Runs in its own interpreter, so the handler starts cold.
+    function = getattr(__import__(args.handler), 'main')
+    with mock_aws(), contextlib.ExitStack() as stack:
+        simulation = Simulation(argparse.Namespace(seed=args.seed, verbose=False, misread_rate=0, registered=1))
+        for module in (s3getpassrek, gateapi, cache):
+            stack.enter_context(mock.patch.object(module, 'time', simulation.clock))
+        clients.set_client('rekognition', simulation.reader)
+        create_resources()
+        events = prepare(simulation, args.handler, 2 * args.requests + 1)
+        if len(events) < 2 * args.requests + 1:
+            sys.exit(f"Only {len(events)} events could be made for {args.handler}")
+
+        created = []
+
+        def cold_start(session):
+            clients.reset_clients(session=session)
+            clients.set_client('rekognition', simulation.reader)
+            clients.get_session().register('creating-client-class', lambda **kwargs: created.append(1))
+
+        cold_start(session=False)
+        simulation.invoke('first', function, events[0])
+
+        created.clear()
+        for event in events[1:args.requests + 1]:
+            simulation.invoke('warm', function, event)
+        warm_clients = len(created)
+
+        for event in events[args.requests + 1:]:
+            cold_start(session=True)
+            simulation.invoke('new_clients', function, event)
+
+    latencies = simulation.latencies
+    print(json.dumps({
+        'first_ms': latencies['first'][0] * 1000,
+        'warm_p50_ms': percentile(latencies['warm'], 0.5) * 1000,
+        'new_clients_p50_ms': percentile(latencies['new_clients'], 0.5) * 1000,
+        'warm_clients_created': warm_clients
+    }))
+
+def measure(args, handler):
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', '--requests', str(args.requests),
+         '--seed', str(args.seed), handler],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        sys.exit(f"Running {handler} failed:\n{result.stderr}")
+    timings = json.loads(result.stdout.splitlines()[-1])
+    timings['import_ms'] = profile(handler, args.runs)['import_ms']
+    return timings
+
+def print_report(report):
+    config = report['config']
+    print(f"Cold start and warm requests per handler, {config['requests']} requests each, "
+          f"import time the median of {config['runs']} runs")
+    print()
+    print(f"{'handler':<14}{'import ms':>10}{'first ms':>10}{'cold ms':>9}{'warm p50':>10}{'new clients p50':>17}")
+    for handler, timings in report['handlers'].items():
+        print(f"{handler:<14}{timings['import_ms']:>10.1f}{timings['first_ms']:>10.1f}"
+              f"{timings['import_ms'] + timings['first_ms']:>9.1f}{timings['warm_p50_ms']:>10.1f}"
+              f"{timings['new_clients_p50_ms']:>17.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('handler', nargs='*', help='handlers to measure, all by default')
+    parser.add_argument('--requests', type=int, default=20, help='warm requests, and requests with new clients')
+    parser.add_argument('--runs', type=int, default=5, help='imports per handler')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    try:
+        from moto import mock_aws
+    except ImportError:
+        sys.exit('The startup benchmark needs moto: pip install moto')
+
+    if args.child:
+        args.handler = args.handler[0]
+        run_handler(args, mock_aws)
+        return
+
+    handlers = args.handler or find_handlers()
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('json', 'child', 'handler')},
+        'handlers': {handler: measure(args, handler) for handler in handlers}
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    failures = [
+        f"{timings['warm_clients_created']} clients were created during {handler}'s warm requests"
+        for handler, timings in report['handlers'].items() if timings['warm_clients_created']
+    ]
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
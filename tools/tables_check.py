@@ -0,0 +1,220 @@
+"""Check lambda/tables.py against the boto3 layer it replaces.
+
+Handlers talk to DynamoDB through tables.Table, a small stand-in for boto3's
+Table resource built on the botocore client. This runs offline and checks:
+
+    types      tables.serialize and deserialize convert every attribute type
+               as boto3's TypeSerializer and TypeDeserializer do, and reject
+               the values boto3 rejects
+    requests   the same puts, gets, updates, batch writes, paged queries,
+               scans and deletes, sent through tables.Table to one moto table
+               and through boto3's Table resource to another, return the
+               same items
+    backoff    BatchWriter sends at most 25 requests a call and resubmits
+               unprocessed items, waiting after each partial batch for a
+               jittered pause that doubles up to BATCH_BACKOFF_CAP and starts
+               again after a batch goes through, until every item is written
+               exactly once
+
+It exits with status 1 when any check fails.
+
+    python tools/tables_check.py
+
+Requires boto3 and moto, which only this check and the other tools use.
+"""
+import argparse
+import os
+import random
+import sys
+from decimal import Decimal
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-2')
+
+import tables
+from clients import get_client, set_client
+
+TABLE_NAME = 'TablesCheck'
+BOTO3_TABLE_NAME = 'TablesCheckBoto3'
+# Empty sets are left out: DynamoDB rejects them however they are typed.
+SAMPLE_VALUES = [
+    None, True, False, 0, -5, 10 ** 30, Decimal('3.14'), Decimal('1.50'), Decimal('-0'),
+    '', 'text', 'ünïcödé', b'', b'\x00\xff', bytearray(b'ab'),
+    {'a', 'b'}, frozenset({'q'}), {Decimal(1), 2}, {b'x', b'y'},
+    [], {}, (1, 'two'), {'nested': [1, 'a', {'deeper': None, 'flag': True}], 'set': {'s'}}
+]
+REJECTED_VALUES = [1.5, {'price': 2.5}, object(), {1, 'mixed'}]
+
+def type_failures(serializer, deserializer):
+    failures = []
+    for value in SAMPLE_VALUES:
+        serialized = tables.serialize(value)
+        expected = serializer.serialize(value)
+        if serialized != expected:
+            failures.append(f"{value!r} serialized to {serialized}, not {expected}")
+        if tables.deserialize(serialized) != deserializer.deserialize(expected):
+            failures.append(f"{serialized} deserialized to {tables.deserialize(serialized)!r}, "
+                            f"not {deserializer.deserialize(expected)!r}")
+    for value in REJECTED_VALUES:
+        for name, serialize in (('tables', tables.serialize), ('boto3', serializer.serialize)):
+            try:
+                serialize(value)
+                failures.append(f"{name} serialized {value!r}, which DynamoDB cannot store")
+            except TypeError:
+                pass
+    return failures
+
+def content(response):
+    # What handlers read from a response, without its metadata.
+    return {key: value for key, value in response.items() if key not in ('ResponseMetadata', 'ConsumedCapacity')}
+
+def request_failures(boto3):
+    failures = []
+    for table_name in (TABLE_NAME, BOTO3_TABLE_NAME):
+        get_client('dynamodb').create_table(
+            TableName=table_name,
+            BillingMode='PAY_PER_REQUEST',
+            AttributeDefinitions=[{'AttributeName': 'Owner', 'AttributeType': 'S'},
+                                  {'AttributeName': 'Item', 'AttributeType': 'N'}],
+            KeySchema=[{'AttributeName': 'Owner', 'KeyType': 'HASH'}, {'AttributeName': 'Item', 'KeyType': 'RANGE'}]
+        )
+    ours = tables.get_table(TABLE_NAME)
+    theirs = boto3.resource('dynamodb').Table(BOTO3_TABLE_NAME)
+
+    def compare(description, operation, **params):
+        response = getattr(ours, operation)(**params)
+        expected = getattr(theirs, operation)(**params)
+        if content(response) != content(expected):
+            failures.append(f"{description}: {content(response)} through tables, {content(expected)} through boto3")
+        return response
+
+    item = {'Owner': 'driver', 'Item': 0, 'Plates': {'AB12 CDE'}, 'Visits': [Decimal('1.5'), 'x'],
+            'Profile': {'name': 'A Driver', 'verified': True, 'photo': b'\x89PNG'}}
+    compare('put_item', 'put_item', Item=item)
+    compare('get_item', 'get_item', Key={'Owner': 'driver', 'Item': 0}, ConsistentRead=True)
+    compare('update_item', 'update_item', Key={'Owner': 'driver', 'Item': 0},
+            UpdateExpression='SET Visits = list_append(Visits, :more) ADD Plates :plate',
+            ExpressionAttributeValues={':more': [Decimal(2)], ':plate': {'XY99 ZZZ'}},
+            ReturnValues='ALL_OLD')
+    compare('get_item of a missing key', 'get_item', Key={'Owner': 'nobody', 'Item': 0})
+
+    for table in (ours, theirs):
+        with table.batch_writer() as batch:
+            for i in range(1, 60):
+                batch.put_item(Item={'Owner': 'driver', 'Item': i, 'Even': i % 2 == 0})
+    params = {'KeyConditionExpression': 'Owner = :owner AND Item > :after',
+              'ExpressionAttributeValues': {':owner': 'driver', ':after': 0}, 'Limit': 25}
+    pages = 0
+    while True:
+        response = compare(f"query page {pages + 1}", 'query', **params)
+        pages += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    if pages != 3:
+        failures.append(f"59 batch-written items came back in {pages} pages of 25, not 3")
+    compare('scan with a filter', 'scan', FilterExpression='Even = :even', ExpressionAttributeValues={':even': True})
+    compare('delete_item', 'delete_item', Key={'Owner': 'driver', 'Item': 0}, ReturnValues='ALL_OLD')
+    return failures
+
+class ThrottledClient:
+    # Stands in for DynamoDB's BatchWriteItem. Calls are throttled in runs:
+    # each call of a run leaves all but --processed-per-call items
+    # unprocessed, and the call after a run processes the whole batch.
+    def __init__(self, processed_per_call, run_length):
+        self.processed_per_call = processed_per_call
+        self.run_length = run_length
+        self.calls = 0
+        self.batch_sizes = []
+        self.partial = []
+        self.written = []
+
+    def batch_write_item(self, RequestItems):
+        (table_name, requests), = RequestItems.items()
+        self.calls += 1
+        self.batch_sizes.append(len(requests))
+        throttled = self.calls % (self.run_length + 1) != 0
+        processed = requests[:self.processed_per_call] if throttled else requests
+        self.written.extend(tables.deserialize_item(request['PutRequest']['Item'])['Item'] for request in processed)
+        unprocessed = requests[len(processed):]
+        self.partial.append(bool(unprocessed))
+        return {'UnprocessedItems': {table_name: unprocessed} if unprocessed else {}}
+
+class RecordingClock:
+    def __init__(self):
+        self.pauses = []
+
+    def sleep(self, seconds):
+        self.pauses.append(seconds)
+
+def backoff_failures(args):
+    failures = []
+    client = ThrottledClient(args.processed_per_call, args.throttled_run)
+    clock = RecordingClock()
+    set_client('dynamodb', client)
+    with mock.patch.object(tables, 'time', clock):
+        with tables.Table(TABLE_NAME).batch_writer() as batch:
+            for i in range(args.items):
+                batch.put_item(Item={'Owner': 'driver', 'Item': i})
+
+    if sorted(client.written) != list(range(args.items)):
+        missing = args.items - len(set(client.written))
+        failures.append(f"{missing} items were not written and {len(client.written) - len(set(client.written))} "
+                        f"were written twice")
+    if max(client.batch_sizes) > tables.BATCH_WRITE_SIZE:
+        failures.append(f"a call sent {max(client.batch_sizes)} requests, more than {tables.BATCH_WRITE_SIZE}")
+    if len(clock.pauses) != sum(client.partial):
+        failures.append(f"{len(clock.pauses)} pauses after {sum(client.partial)} partly processed calls")
+
+    retries = 0
+    pauses = iter(clock.pauses)
+    for partial in client.partial:
+        if not partial:
+            retries = 0
+            continue
+        pause = next(pauses, None)
+        limit = min(tables.BATCH_BACKOFF_CAP, tables.BATCH_BACKOFF_BASE * 2 ** retries)
+        if pause is None or not 0 <= pause <= limit:
+            failures.append(f"paused {pause} after {retries} retries, outside 0 to {limit:g}s")
+            break
+        retries += 1
+    return client, clock, failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=500, help='items batch written in the backoff check')
+    parser.add_argument('--processed-per-call', type=int, default=5, help='items a throttled call processes')
+    parser.add_argument('--throttled-run', type=int, default=10, help='throttled calls before one goes through')
+    parser.add_argument('--seed', type=int, default=1, help='seeds the backoff jitter')
+    args = parser.parse_args()
+
+    try:
+        import boto3
+        from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+        from moto import mock_aws
+    except ImportError:
+        sys.exit('The tables check needs boto3 and moto: pip install moto')
+
+    failures = type_failures(TypeSerializer(), TypeDeserializer())
+    print(f"types: {len(SAMPLE_VALUES)} values converted and {len(REJECTED_VALUES)} rejected")
+
+    with mock_aws():
+        failures += request_failures(boto3)
+    print('requests: get, update, batch write, paged query, scan and delete compared with boto3')
+
+    # BatchWriter's jitter comes from the random module.
+    random.seed(args.seed)
+    client, clock, backoff = backoff_failures(args)
+    failures += backoff
+    print(f"backoff: {args.items} items in {client.calls} calls, {len(clock.pauses)} pauses, "
+          f"longest {max(clock.pauses, default=0):.3f}s")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()
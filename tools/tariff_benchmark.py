@@ -0,0 +1,176 @@
+"""Benchmark per-session pricing and bulk repricing with compiled tariffs.
+
+Two tariffs are compiled: the flat default of £2 an hour, and a banded one
+with a daytime and an evening rate, a grace period, quarter-hour units, a
+daily cap and a UTC offset. For each, --sessions sessions of each length
+(under an hour, up to a day, up to a week and up to a month) are priced one
+at a time with Tariff.price, as s3getpassrek and gateapi price an exit, and
+--bulk sessions of mixed lengths at once with Tariff.price_many, as a
+repricing job would.
+
+The prices of the first --check-sessions sessions of each length are
+checked against a minute-by-minute reference, and as many prices from
+price_many against price. The report gives the time per session at each
+length and the bulk throughput. It exits with status 1 when prices
+disagree by more than a cent, or when pricing a month-long session takes
+more than --max-slowdown times as long as one under an hour.
+
+    python tools/tariff_benchmark.py
+    python tools/tariff_benchmark.py --bulk 10000000 --sessions 100000
+
+Requires numpy for the bulk repricing.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from tariff import DEFAULT_TARIFF, MINUTES_PER_DAY, Tariff, parse_time_of_day
+
+START_TIME = 1767225600  # Thursday 1 January 2026, 00:00 UTC
+BANDED_TARIFF = {
+    'unit_minutes': 15,
+    'grace_minutes': 20,
+    'daily_cap': 18,
+    'utc_offset_minutes': 60,
+    'bands': [
+        {'start': '07:00', 'end': '19:00', 'hourly_rate': 3},
+        {'start': '19:00', 'end': '07:00', 'hourly_rate': 1.2}
+    ]
+}
+TARIFFS = {'flat': DEFAULT_TARIFF, 'banded': BANDED_TARIFF}
+# The longest stay of each length, in seconds.
+LENGTHS = {'hour': 3600, 'day': 86400, 'week': 7 * 86400, 'month': 30 * 86400}
+TOLERANCE = 0.01
+REPEATS = 3
+
+def make_sessions(rng, count, longest):
+    entry_times = [START_TIME + rng.randrange(365 * 86400) for _ in range(count)]
+    exit_times = [entry_time + rng.randrange(longest) for entry_time in entry_times]
+    return entry_times, exit_times
+
+def reference_price(definition, entry_time, exit_time):
+    # Walks every billed minute, capping each day from entry.
+    rates = [0.0] * MINUTES_PER_DAY
+    for band in definition['bands']:
+        start, end = parse_time_of_day(band['start']), parse_time_of_day(band['end'])
+        for minute in range(start, end if start < end else end + MINUTES_PER_DAY):
+            rates[minute % MINUTES_PER_DAY] = band['hourly_rate'] / 60
+
+    duration_seconds = max(exit_time - entry_time, 0)
+    if duration_seconds <= definition.get('grace_minutes', 0) * 60:
+        return 0.0
+    unit = definition.get('unit_minutes', 60)
+    billed = math.ceil(math.ceil(duration_seconds / 60) / unit) * unit
+    start = (entry_time // 60 + definition.get('utc_offset_minutes', 0)) % MINUTES_PER_DAY
+
+    price = 0.0
+    for day_start in range(0, billed, MINUTES_PER_DAY):
+        minutes = range(day_start, min(billed, day_start + MINUTES_PER_DAY))
+        day = sum(rates[(start + minute) % MINUTES_PER_DAY] for minute in minutes)
+        if definition.get('daily_cap') is not None:
+            day = min(day, definition['daily_cap'])
+        price += day
+    return round(price, 2)
+
+def per_session(tariff, entry_times, exit_times):
+    # The fastest of a few passes, so that a pause of the machine is not
+    # mistaken for a slower length.
+    best = None
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        prices = [tariff.price(entry_time, exit_time) for entry_time, exit_time in zip(entry_times, exit_times)]
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(prices), prices
+
+def benchmark(args, name, definition, np):
+    rng = random.Random(args.seed)
+    tariff = Tariff(definition)
+    failures = []
+
+    lengths = {}
+    for length, longest in LENGTHS.items():
+        entry_times, exit_times = make_sessions(rng, args.sessions, longest)
+        seconds, prices = per_session(tariff, entry_times, exit_times)
+        lengths[length] = {'us_per_session': seconds * 1e6, 'sessions_per_second': 1 / seconds}
+        for entry_time, exit_time, price in list(zip(entry_times, exit_times, prices))[:args.check_sessions]:
+            expected = reference_price(definition, entry_time, exit_time)
+            if abs(float(price) - expected) > TOLERANCE + 1e-9:
+                failures.append(f"{name} priced {entry_time} to {exit_time} at {price}, not {expected:.2f}")
+
+    bulk = None
+    if np is not None:
+        entry_times, exit_times = make_sessions(rng, args.bulk, LENGTHS['month'])
+        entry_times, exit_times = np.asarray(entry_times, dtype=np.int64), np.asarray(exit_times, dtype=np.int64)
+        started = time.perf_counter()
+        prices = tariff.price_many(entry_times, exit_times)
+        seconds = time.perf_counter() - started
+        bulk = {'seconds': seconds, 'sessions_per_second': args.bulk / seconds if seconds else 0.0}
+        for i in range(min(args.check_sessions, args.bulk)):
+            single = tariff.price(int(entry_times[i]), int(exit_times[i]))
+            if abs(float(single) - prices[i]) > TOLERANCE + 1e-9:
+                failures.append(f"{name} priced {entry_times[i]} to {exit_times[i]} at {prices[i]:.2f} in bulk "
+                                f"and {single} alone")
+
+    slowdown = lengths['month']['us_per_session'] / lengths['hour']['us_per_session']
+    if slowdown > args.max_slowdown:
+        failures.append(f"{name} took {slowdown:.1f} times as long to price a month-long session as one under an hour")
+    return {'lengths': lengths, 'bulk': bulk}, failures
+
+def print_report(report):
+    config = report['config']
+    print(f"Pricing {config['sessions']} sessions of each length one at a time, "
+          f"and {config['bulk']} at once")
+    for name, result in report['tariffs'].items():
+        print()
+        print(f"{name}:")
+        print(f"  {'length':<8}{'us/session':>12}{'sessions/s':>14}")
+        for length, stats in result['lengths'].items():
+            print(f"  {length:<8}{stats['us_per_session']:>12.2f}{stats['sessions_per_second']:>14,.0f}")
+        if result['bulk']:
+            print(f"  {'bulk':<8}{result['bulk']['seconds'] * 1e6 / config['bulk']:>12.3f}"
+                  f"{result['bulk']['sessions_per_second']:>14,.0f}")
+        else:
+            print('  bulk repricing needs numpy: pip install numpy')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=20000, help='sessions of each length priced one at a time')
+    parser.add_argument('--bulk', type=int, default=1000000, help='sessions repriced at once')
+    parser.add_argument('--check-sessions', type=int, default=1000, help='sessions of each length checked')
+    parser.add_argument('--max-slowdown', type=float, default=2.0,
+                        help='largest allowed ratio of the time to price a month-long session to one under an hour')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+    report = {'config': {key: value for key, value in vars(args).items() if key != 'json'}, 'tariffs': {}}
+    failures = []
+    for name, definition in TARIFFS.items():
+        report['tariffs'][name], tariff_failures = benchmark(args, name, definition, np)
+        failures += tariff_failures
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+if __name__ == '__main__':
+    main()